@@ -31,36 +31,88 @@ ImageMagick_identify_命令 = 'magick identify'
 potrace_命令 = 'potrace'
 potrace_选项 = ''
 
-命令行最长 = 1900  # 命令行长度限制
+查找表最多颜色数 = 64  # 调色板颜色不超过这个数时，预先计算完整的重映射查找表
+查找表最少像素数 = 1 << 22  # 要重映射的像素总数不到这么多时，不值得计算查找表，直接求出现过的颜色的最近颜色
+每图采样像素数 = 65536  # 制作共享调色板时，每个输入图像最多采样的像素数
+序列采样帧数 = 32  # 序列模式下，默认从这么多个均匀挑选的帧中采样制作调色板
+批处理最大字节 = 256 * 1024  # 描摹服务中，小于这个大小的上传才会和其他请求合批
+批处理最大数量 = 16  # 描摹服务每次最多合批的请求数
+批处理等待秒 = 0.005  # 描摹服务收到小请求后，等待同时到达的其他请求的时间
+小图最大字节 = 64 * 1024  # 使用 'mc' 量化时，不超过这个大小的输入会合批，用一次 pngquant 量化
+合批量化最大数量 = 32  # 每批最多的小图数，也限制了命令行的长度
+自动缩放最大倍数 = 4  # --prescale auto 最多放大的倍数
+缩略图边长 = 128  # --prescale auto 估计图像细节时使用的缩略图大小
+边缘阈值 = 32  # 缩略图中相邻像素灰度差超过这个值，就算作边缘
+满细节边缘比例 = 0.15  # 边缘像素达到这个比例时，认为图像细节已满，放大到像素预算允许的倍数
+自动最多颜色数 = 16  # --colors auto 最多选择的颜色数
+无损误差 = 4  # --colors auto 中，平均平方色差小于这个值就认为调色板已经能还原图像
+指标汇报间隔 = 1.0  # --metrics-file 的写入间隔，单位是秒
+指标速率窗口 = 10  # 计算当前吞吐量时，只看最近这么多秒内完成的文件和图层
 汇报级别 = 0  # 不止是一个常数，它也会爱 -v/--verbose 选项影响
 
 版本 = '1.01'
 
+_事件循环 = None  # 使用 --asyncio 时，所有外部程序都由这个事件循环启动
+_外部程序名额 = None  # 限制事件循环同时运行的外部程序数的信号量
+_运行指标 = None  # 使用 --metrics-file 或 --metrics-port 时，记录各阶段耗时的 运行指标
+
 import os, sys
 import shutil
 import subprocess
 import argparse
 from glob import iglob
 import functools
-import multiprocessing
+import importlib
 import queue
 import tempfile
 import time
 import shlex
 import re
-from pprint import pprint
-
+import types
+import threading
+import io
+import fnmatch
+import contextlib
 
 from svg_stack import svg_stack
 
 
+class _延迟导入:
+    """第一次访问属性时才真正导入的模块
+
+    numpy、Pillow、multiprocessing 等模块导入较慢，而很多运行只用到其中一部分，
+    延迟导入可以缩短命令行的启动时间
+"""
+    def __init__(self, 名称):
+        self._名称 = 名称
+        self._模块 = None
+
+    def __getattr__(self, 属性):
+        if self._模块 is None:
+            self._模块 = importlib.import_module(self._名称)
+        return getattr(self._模块, 属性)
+
+
+np = _延迟导入('numpy')
+Image = _延迟导入('PIL.Image')
+multiprocessing = _延迟导入('multiprocessing')
+asyncio = _延迟导入('asyncio')
+futures = _延迟导入('concurrent.futures')
+hashlib = _延迟导入('hashlib')
+json = _延迟导入('json')
+socket = _延迟导入('socket')
+zipfile = _延迟导入('zipfile')
+tarfile = _延迟导入('tarfile')
+urllib = types.SimpleNamespace(parse=_延迟导入('urllib.parse'))  # 只用到 urllib.parse
+
+
 def 汇报(*args, level=1):
     global 汇报级别
     if 汇报级别 >= level:
         print(*args)
 
 
-def 处理命令(命令, stdinput=None, stdout_=False, stderr_=False):
+def 处理命令(命令, stdinput=None, stdout_=False, stderr_=False, cwd=None):
     """在后台 shell 中运行命令，返回 stdout 和/或 stderr
 
     返回 stdout, stderr 或一个数组（stdout, stderr），取决于 stdout, stderr 参数
@@ -70,7 +122,14 @@ def 处理命令(命令, stdinput=None, stdout_=False, stderr_=False):
     stdinput: data (bytes) to send to command's stdin, or None
     stdout_: True to receive command's stdout in the return value
     stderr_: True to receive command's stderr in the return value
+    cwd: 运行命令的工作目录，None 表示当前目录
+
+    使用 --asyncio 时，在工作线程中调用，命令会交给事件循环运行
 """
+    if _事件循环 is not None:
+        return asyncio.run_coroutine_threadsafe(
+            异步处理命令(命令, stdinput, stdout_, stderr_, cwd), _事件循环).result()
+
     stdin_pipe = (subprocess.PIPE if stdinput is not None else None)
     stdout_pipe = (subprocess.PIPE if stdout_ is True else None)
     stderr_pipe = subprocess.PIPE
@@ -80,6 +139,7 @@ def 处理命令(命令, stdinput=None, stdout_=False, stderr_=False):
                           stdin=stdin_pipe,
                           stderr=stderr_pipe,
                           stdout=stdout_pipe,
+                          cwd=cwd,
                           shell=True)
 
     stdoutput, stderror = 进程.communicate(input=stdinput)
@@ -98,20 +158,172 @@ def 处理命令(命令, stdinput=None, stdout_=False, stderr_=False):
         return None
 
 
+async def 异步处理命令(命令, stdinput=None, stdout_=False, stderr_=False, cwd=None):
+    """处理命令 的协程版本，参数和返回值相同
+
+    同时运行的外部程序数由 _外部程序名额 限制。命令不经过 shell，所以不能包含重定向
+"""
+    async with _外部程序名额:
+        汇报(f'命令：{命令}')
+        管道 = dict(stdin=subprocess.PIPE if stdinput is not None else None,
+                  stdout=subprocess.PIPE if stdout_ else None,
+                  stderr=subprocess.PIPE)
+        if os.name == 'nt':
+            进程 = await asyncio.create_subprocess_shell(命令, cwd=cwd, **管道)
+        else:
+            进程 = await asyncio.create_subprocess_exec(*shlex.split(命令), cwd=cwd, **管道)
+        stdoutput, stderror = await 进程.communicate(input=stdinput)
+
+    if 进程.returncode != 0:
+        raise Exception(stderror.decode(encoding=sys.getfilesystemencoding()))
+
+    if stdout_ and stderr_:
+        return (stdoutput, stderror)
+    elif stdout_:
+        return stdoutput
+    elif stderr_:
+        return stderror
+    return None
+
+
 def 重缩放(源, 目标, 缩放, 滤镜='lanczos'):
     """使用 ImageMagick 将图片重新缩放、转为 png 格式
+
+    源是 归档::成员 时，成员的内容通过 stdin 交给 ImageMagick，不解压到临时文件
 """
+    扩展名 = os.path.splitext(源)[1].lower()
+    数据 = None
+    if 拆分归档成员(源) is not None:
+        数据 = 读取归档成员(源)
+        源 = '{0}:-'.format(扩展名[1:])
     if 缩放 == 1.0:  # 不缩放。检查格式
-        if os.path.splitext(源)[1].lower() not in ['.png']: # 非 png 则转格式
+        if 扩展名 not in ['.png']: # 非 png 则转格式
             命令 = f'{ImageMagick_convert_命令} "{源}" "{目标}"'
-            处理命令(命令)
+            处理命令(命令, stdinput=数据)
+        elif 数据 is not None:
+            with open(目标, 'wb') as 文件:
+                文件.write(数据)
         else: # png 格式则直接复制
             shutil.copyfile(源, 目标)
     else:
         命令 = '{convert} "{src}" -filter {filter} -resize {resize}% "{dest}"'.format(
             convert=ImageMagick_convert_命令, src=源, filter=滤镜, resize=缩放 * 100,
             dest=目标)
-        处理命令(命令)
+        处理命令(命令, stdinput=数据)
+
+def 自动缩放倍数(源, 像素预算=4.0):
+    """为 --prescale auto 选择一个图像的放大倍数
+
+    像素预算: 放大后最多的像素数，单位是百万像素
+    先由像素预算得到最多能放大的倍数，再按缩略图中边缘像素的比例决定用到多少：
+    大块平坦的图像放大几乎没有收益，细节多的小图才值得放大。倍数按 0.25 取整，不会缩小
+"""
+    with Image.open(打开输入(源)) as 图像:
+        宽, 高 = 图像.size
+        图像.draft('L', (缩略图边长, 缩略图边长))  # JPEG 可以直接按缩小的尺寸解码
+        缩略图 = 图像.convert('L')
+    缩略图.thumbnail((缩略图边长, 缩略图边长))
+
+    预算倍数 = min((像素预算 * 1e6 / (宽 * 高)) ** 0.5, 自动缩放最大倍数)
+    if 预算倍数 <= 1:
+        return 1.0
+    像素 = np.asarray(缩略图, dtype=np.int16)
+    if min(像素.shape) < 2:
+        return 1.0
+    梯度 = np.abs(np.diff(像素, axis=0))[:, :-1] + np.abs(np.diff(像素, axis=1))[:-1, :]
+    边缘比例 = np.count_nonzero(梯度 > 边缘阈值) / 梯度.size
+    倍数 = 1 + (预算倍数 - 1) * min(1.0, 边缘比例 / 满细节边缘比例)
+    return max(1.0, int(倍数 * 4) / 4)
+
+
+def 缩略图像素(图像):
+    """返回 PIL 图像缩小到 缩略图边长 以内后的 rgb 像素数组
+
+    使用最近邻缩小，不会混合出原图中没有的颜色
+"""
+    缩略图 = 图像.convert('RGB')
+    缩略图.thumbnail((缩略图边长, 缩略图边长), Image.NEAREST)
+    return np.asarray(缩略图)
+
+
+def 中切(像素, 颜色数):
+    """numpy 实现的中切量化，返回 1 到 颜色数 个颜色的调色板数组列表
+
+    每次切分平方误差最大的盒子，所以一次切分就能得到所有较少颜色数的调色板
+    像素: 形状为 (n, 3) 的数组
+    颜色不够切分时，列表会短于 颜色数
+"""
+    盒子列表 = [像素]
+    调色板列表 = []
+    while True:
+        调色板列表.append(np.array([盒子.mean(axis=0) for 盒子 in 盒子列表]))
+        if len(盒子列表) == 颜色数:
+            break
+        平方误差 = [((盒子 - 盒子.mean(axis=0)) ** 2).sum() for 盒子 in 盒子列表]
+        i = int(np.argmax(平方误差))
+        if 平方误差[i] == 0:
+            break
+        盒子 = 盒子列表.pop(i)
+        通道 = int(np.argmax(np.ptp(盒子, axis=0)))
+        # 按中位数的值而不是位置切分，同一个颜色不会被分到两个盒子里
+        值 = 盒子[:, 通道]
+        左边 = 值 <= np.median(值)
+        if 左边.all():
+            左边 = 值 < 值.max()
+        盒子列表 += [盒子[左边], 盒子[~左边]]
+    return 调色板列表
+
+
+def 优化调色板(像素, 调色板数组, 次数=2):
+    """用几次 k-means 迭代改进调色板，返回 (调色板数组, 每个像素的颜色索引)"""
+    for _ in range(次数 + 1):
+        索引 = 最近颜色索引(像素, 调色板数组.round().astype(np.int32))
+        if _ == 次数:
+            break
+        数量 = np.bincount(索引, minlength=len(调色板数组))
+        总和 = np.stack([np.bincount(索引, 像素[:, c], len(调色板数组)) for c in range(3)], axis=1)
+        有像素 = 数量 > 0
+        调色板数组 = 调色板数组.copy()
+        调色板数组[有像素] = 总和[有像素] / 数量[有像素, None]
+    return 调色板数组, 索引
+
+
+def 自动颜色数(像素):
+    """为 --colors auto 选择颜色数
+
+    像素: 缩小后的图像的 rgb 数组，形状为 (高, 宽, 3)
+    用中切和 k-means 得到 1 到 自动最多颜色数 个颜色的调色板，分别计算重建误差 (平均平方色差) 和
+    颜色边界的长度 (估计描摹出的路径数量)。某个颜色数已能还原图像时直接选它，
+    否则选择误差下降的比例减去边界增加的比例最大的拐点
+"""
+    高, 宽 = 像素.shape[:2]
+    像素 = 像素.reshape(-1, 3).astype(np.int32)
+    误差列表 = []
+    边界列表 = []
+    for 调色板数组 in 中切(像素, 自动最多颜色数):
+        调色板数组, 索引 = 优化调色板(像素, 调色板数组)
+        误差 = ((像素 - 调色板数组[索引]) ** 2).sum(axis=1).mean()
+        if len(调色板数组) > 1 and 误差 < 无损误差:
+            return len(调色板数组)
+        索引图 = 索引.reshape(高, 宽)
+        边界 = (np.count_nonzero(索引图[:, 1:] != 索引图[:, :-1]) +
+              np.count_nonzero(索引图[1:] != 索引图[:-1]))
+        误差列表.append(误差)
+        边界列表.append(边界)
+    if len(误差列表) < 3:
+        return max(2, len(误差列表))
+
+    误差下降 = (误差列表[0] - np.array(误差列表)) / max(误差列表[0] - 误差列表[-1], 1e-9)
+    边界增加 = np.array(边界列表) / max(边界列表[-1], 1)
+    得分 = (误差下降 - 边界增加)[1:]  # 至少两个颜色
+    return int(np.argmax(得分)) + 2
+
+
+def 描摹元数据(缩放):
+    """返回记录在输出 svg 的 <metadata> 中的描摹参数"""
+    return ('<ct:settings xmlns:ct="https://github.com/HaujetZhao/color-trace" '
+            'prescale="{0:g}"/>'.format(缩放))
+
 
 def 量化缩减图片颜色(源, 量化目标, 颜色数, 算法='mc', 拟色=None):
     """将源图像量化到指定数量的颜色，保存到量化目标
@@ -145,8 +357,12 @@ def 量化缩减图片颜色(源, 量化目标, 颜色数, 算法='mc', 拟色=N
         else:
             raise ValueError("对 'mc' 量化方法使用了错误的拟色类型：'{0}' ".format(拟色))
         # 因为 pngquant 不能保存到中文路径，所以使用 stdin/stdout 操作 pngquant
-        命令 = f'{pngquant_命令} --force {拟色选项} {颜色数} - < "{源}" > "{量化目标}"'
-        stdoutput = 处理命令(命令)
+        # 由 Python 读写文件而不是 shell 重定向，这样命令也能在不经过 shell 时运行
+        命令 = f'{pngquant_命令} --force {拟色选项} {颜色数} -'
+        with open(源, 'rb') as 源文件:
+            stdoutput = 处理命令(命令, stdinput=源文件.read(), stdout_=True)
+        with open(量化目标, 'wb') as 目标文件:
+            目标文件.write(stdoutput)
 
     elif 算法 == 'as':  # adaptive spatial subdivision 自适应空间细分
         if 拟色 is None:
@@ -179,6 +395,29 @@ def 量化缩减图片颜色(源, 量化目标, 颜色数, 算法='mc', 拟色=N
         raise NotImplementedError('未知的量化算法 "{0}"'.format(算法))
 
 
+def 批量量化(源列表, 量化目标列表, 颜色数, 拟色=None):
+    """用一次 pngquant 把多个源图像量化到同样的颜色数，结果和逐个使用 量化缩减图片颜色 的 'mc' 算法相同
+
+    源列表: 源图像的路径，必须都在同一个文件夹中
+    量化目标列表: 输出图像的路径
+    颜色数、拟色: 同 量化缩减图片颜色
+"""
+    if 拟色 is None:
+        拟色选项 = '--nofs'
+    elif 拟色 == 'floydsteinberg':
+        拟色选项 = ''
+    else:
+        raise ValueError("对 'mc' 量化方法使用了错误的拟色类型：'{0}' ".format(拟色))
+    # 因为 pngquant 不能保存到中文路径，所以在源图像所在的文件夹中运行，只传给它文件名，
+    # 它把结果保存在各个源图像旁边，文件名加上这个后缀
+    后缀 = '~quant.png'
+    文件名 = ' '.join('"{0}"'.format(os.path.basename(源)) for 源 in 源列表)
+    命令 = f'{pngquant_命令} --force {拟色选项} --ext {后缀} {颜色数} {文件名}'
+    处理命令(命令, cwd=os.path.dirname(源列表[0]))
+    for 源, 量化目标 in zip(源列表, 量化目标列表):
+        os.replace(os.path.splitext(源)[0] + 后缀, 量化目标)
+
+
 def 用调色板对图片重映射(源, 重映射目标, 调色板图像, 拟色=None):
     """用调色板图像的颜色重映射源图像，保存到重映射目标
 
@@ -204,41 +443,179 @@ def 用调色板对图片重映射(源, 重映射目标, 调色板图像, 拟色
     处理命令(命令)
 
 
+def 打包颜色(像素):
+    """将形状为 (..., 3) 的 rgb 数组打包为 0xRRGGBB 形式的整数数组"""
+    像素 = 像素.astype(np.uint32)
+    return (像素[..., 0] << 16) | (像素[..., 1] << 8) | 像素[..., 2]
+
+
+def 颜色表转数组(颜色表):
+    """将 #rrggbb 16进制颜色列表转为形状为 (n, 3) 的 rgb 数组"""
+    return np.array([[int(颜色[i:i + 2], 16) for i in (1, 3, 5)] for 颜色 in 颜色表],
+                    dtype=np.int32).reshape(-1, 3)
+
+
+def 读取调色板(调色板图像):
+    """解码调色板图像，返回它包含的所有颜色的 #RRGGBB 16进制列表，按颜色值排序"""
+    if not os.path.exists(调色板图像):  # 确认下调色板图像存在
+        raise IOError("未找到重映射调色板：{0} ".format(调色板图像))
+
+    with Image.open(调色板图像) as 图像:
+        像素 = np.asarray(图像.convert('RGB'))
+    颜色值 = np.unique(打包颜色(像素))
+    if len(颜色值) > 256:
+        raise ValueError("重映射调色板最多只能有 256 个颜色：{0} ".format(调色板图像))
 
-def 制作颜色表(源图像):
-    """从源图像得到特征色，返回 #rrggbb 16进制颜色"""
+    return ['#{0:06X}'.format(值) for 值 in 颜色值]
 
-    命令 = f'{ImageMagick_convert_命令} "{源图像}"  -unique-colors txt:-'
-    stdoutput = 处理命令(命令, stdout_=True) # 这个输出中包含了颜色
 
-    正则模式 = '#[0-9A-F]{6}'
-    IM输出 = stdoutput.decode(sys.getfilesystemencoding())
-    十六进制颜色 = re.findall(正则模式, IM输出)
+def 制作重映射查找表(调色板, 查找表路径):
+    """为调色板预先计算所有 rgb 颜色的最近颜色，保存到查找表路径
 
-    return 十六进制颜色
+    查找表是一个 2^24 字节的文件，第 0xRRGGBB 个字节就是该颜色在调色板中最接近
+    （欧氏距离）的颜色的索引。它在每次运行时只计算一次，各进程以只读方式内存映射共享。
+"""
+    调色板数组 = 颜色表转数组(调色板)
+    分量 = np.arange(256, dtype=np.int32)
+    with open(查找表路径, 'wb') as 文件:
+        # 每次计算 16 个红色分量值的平面，以限制内存占用
+        for 红起点 in range(0, 256, 16):
+            红 = 分量[红起点:红起点 + 16]
+            最小距离 = np.full((16, 256, 256), np.iinfo(np.int32).max, dtype=np.int32)
+            索引 = np.zeros((16, 256, 256), dtype=np.uint8)
+            for i, (r, g, b) in enumerate(调色板数组):
+                距离 = (((红 - r) ** 2)[:, None, None]
+                      + ((分量 - g) ** 2)[None, :, None]
+                      + ((分量 - b) ** 2)[None, None, :])
+                np.putmask(索引, 距离 < 最小距离, i)
+                np.minimum(最小距离, 距离, out=最小距离)
+            文件.write(索引.tobytes())
+
+
+_查找表缓存 = {}
+
+
+def 读取重映射查找表(查找表路径):
+    """以只读方式内存映射查找表，每个进程只映射一次"""
+    if 查找表路径 not in _查找表缓存:
+        _查找表缓存[查找表路径] = np.memmap(查找表路径, dtype=np.uint8, mode='r')
+    return _查找表缓存[查找表路径]
+
+
+def 最近颜色索引(像素, 调色板数组):
+    """返回每个 rgb 颜色在调色板中最接近（欧氏距离）的颜色的索引
+
+    像素: 形状为 (n, 3) 的数组
+    调色板数组: 形状为 (m, 3) 的数组，m 不超过 256
+"""
+    像素 = 像素.astype(np.int32)
+    索引 = np.zeros(len(像素), dtype=np.uint8)
+    最小距离 = np.full(len(像素), np.iinfo(np.int32).max, dtype=np.int32)
+    for i, 调色板颜色 in enumerate(调色板数组):
+        距离 = ((像素 - 调色板颜色) ** 2).sum(axis=1)
+        np.putmask(索引, 距离 < 最小距离, i)
+        np.minimum(最小距离, 距离, out=最小距离)
+    return 索引
 
 
-def 得到调色板外的颜色(调色板, 从黑色开始=True, 规避颜色=None):
-    """return a color hex string not listed in palette
-    返回一个不在调色板内的16进制颜色字符串
+def 用调色板数组重映射(像素, 调色板, 查找表路径=None):
+    """在进程内把 rgb 像素数组映射到调色板，返回同形状的调色板索引图
 
-    从黑色开始: 从黑色开始搜索颜色，否则从白色开始
-    规避颜色: 一个列表, 指定在搜索时需要规避的颜色
+    有查找表时每个像素只查一次表，否则只对图像中出现过的颜色计算最近颜色
 """
-    if 规避颜色 is None:
-        最终调色板 = tuple(调色板)
-    else:
-        最终调色板 = tuple(调色板) + tuple(规避颜色)
-    if 从黑色开始:
-        颜色范围 = range(int('ffffff', 16))
-    else:
-        颜色范围 = range(int('ffffff', 16), 0, -1)
-    for i in 颜色范围:
-        颜色 = "#{0:06x}".format(i)
-        if 颜色 not in 最终调色板:
-            return 颜色
-    # 当调色板加上规避颜色，包含所有颜色 #000000-#ffffff 时，抛出错误
-    raise Exception("未能找到调色板之外的颜色")
+    打包 = 打包颜色(像素)
+    if 查找表路径 is not None:
+        return 读取重映射查找表(查找表路径)[打包]
+    唯一值, 逆索引 = np.unique(打包, return_inverse=True)
+    唯一颜色 = np.stack((唯一值 >> 16, (唯一值 >> 8) & 0xFF, 唯一值 & 0xFF), axis=1)
+    return 最近颜色索引(唯一颜色, 颜色表转数组(调色板))[逆索引].reshape(打包.shape)
+
+
+def 在进程内重映射为索引图(源, 调色板, 查找表路径=None):
+    """不拟色时，在进程内将源图像重映射到调色板
+
+    返回 (索引图, 用到的颜色)。索引图中的值是用到的颜色的索引，用到的颜色顺序与调色板一致
+"""
+    with Image.open(源) as 图像:
+        像素 = np.asarray(图像.convert('RGB'))
+    索引图 = 用调色板数组重映射(像素, 调色板, 查找表路径)
+
+    已用 = np.bincount(索引图.ravel(), minlength=len(调色板)) > 0
+    新索引 = (np.cumsum(已用) - 1).astype(索引图类型(int(已用.sum())))
+    return 新索引[索引图], [调色板[i] for i in np.flatnonzero(已用)]
+
+
+def 均匀挑选(总数, 个数=None):
+    """从 range(总数) 中均匀挑选最多 个数 个序号，个数为 None 表示全部"""
+    if not 个数 or 个数 >= 总数:
+        return list(range(总数))
+    步长 = 总数 / 个数
+    return [int(i * 步长) for i in range(个数)]
+
+
+def 采样像素(像素, 随机数):
+    """从 rgb 像素数组中随机采样最多 每图采样像素数 个像素，返回形状为 (n, 3) 的数组"""
+    像素 = 像素.reshape(-1, 3)
+    if len(像素) > 每图采样像素数:
+        像素 = 像素[随机数.integers(0, len(像素), 每图采样像素数)]
+    return 像素
+
+
+def 由样本制作调色板(样本列表, 临时文件夹, 颜色数, 算法='mc', 前缀='global'):
+    """把采样得到的像素拼成一张样本图像，量化出调色板图像，返回它的路径
+
+    前缀: 样本图像和调色板图像文件名的前缀，同时制作多个调色板时各用一个
+"""
+    样本 = np.concatenate(样本列表)
+
+    # 把样本像素排成一张宽 256 的图像，不足一行的部分循环补齐
+    行数 = -(-len(样本) // 256)
+    样本图像 = np.resize(样本, (行数, 256, 3))
+    样本文件 = os.path.join(临时文件夹, f'{前缀}~sample.png')
+    调色板文件 = os.path.join(临时文件夹, f'{前缀}~palette.png')
+    Image.fromarray(样本图像).save(样本文件)
+
+    汇报(f'从 {len(样本列表)} 个图像中采样了 {len(样本)} 个像素，制作调色板')
+    量化缩减图片颜色(样本文件, 调色板文件, 颜色数, 算法=算法)
+    删除文件(样本文件)
+    return 调色板文件
+
+
+def 制作共享调色板(输入列表, 临时文件夹, 颜色数, 算法='mc', 采样文件数=None):
+    """从多个输入图像中采样像素，量化出一个所有输入共用的调色板图像
+
+    返回调色板图像的路径，之后就像 --remap 的调色板图像一样使用它
+    输入列表: 输入文件列表
+    临时文件夹: 存放样本图像和调色板图像的文件夹
+    颜色数: 调色板的颜色数，'auto' 表示取各采样图像自动选择的颜色数的中位数
+    算法: 量化算法，同 量化缩减图片颜色
+    采样文件数: 只从均匀挑选的这么多个输入中采样，None 表示所有输入
+"""
+    随机数 = np.random.default_rng(0)  # 固定种子，使每次运行得到相同的调色板
+    样本列表 = []
+    选择列表 = []
+    for _, 源 in 逐个打开输入([输入列表[i] for i in 均匀挑选(len(输入列表), 采样文件数)]):
+        with Image.open(源) as 图像:
+            样本列表.append(采样像素(np.asarray(图像.convert('RGB')), 随机数))
+            if 颜色数 == 'auto':
+                选择列表.append(自动颜色数(缩略图像素(图像)))
+    if 颜色数 == 'auto':
+        颜色数 = int(np.median(选择列表))
+        汇报(f'自动选择共享调色板的 {颜色数} 个颜色')
+    return 由样本制作调色板(样本列表, 临时文件夹, 颜色数, 算法)
+
+
+def 透明像素(图像路径):
+    """返回图像中完全透明的像素的掩码，图像没有透明像素时返回 None"""
+    with Image.open(图像路径) as 图像:
+        if 图像.mode not in ('RGBA', 'LA', 'PA') and 'transparency' not in 图像.info:
+            return None
+        透明 = np.asarray(图像.convert('RGBA'))[..., 3] == 0
+    return 透明 if 透明.any() else None
+
+
+class 图层过多(Exception):
+    """输入的颜色多于 --max-layers，并且选择了拒绝这样的输入"""
 
 
 # def isolate_color(src, destlayer, target_color, palette, stack=False):
@@ -285,73 +662,314 @@ def 得到调色板外的颜色(调色板, 从黑色开始=True, 规避颜色=No
 #     process_command(command, stdinput=stdinput)
 
 
-def 孤立颜色(源, 目标临时文件, 目标图层, 目标颜色, 调色板, stack=False):  # new version
-    """将指定颜色区域替换为黑色，其他区域为白色
-
-    源: 源图像路径，必须匹配调色板的颜色
-    目标图层: 输出图像的路径
-    目标颜色: 要孤立的颜色 (来自调色板)
-    调色板: 包含例如 "#010101" 的列表. (从制作调色板输出得到)
-    stack: 如果 True，在颜色索引之前的颜色为白，之后的为黑
-"""
-    颜色索引 = 调色板.index(目标颜色)
-
-    # 为了避免调色板包含纯黑和纯白，背景和前景色都是非调色板的颜色（黑或白）
-    背景白 = "#FFFFFF"
-    前景黑 = "#000000"
-    背景接近白 = 得到调色板外的颜色(调色板, False, (背景白, 前景黑))
-    前景接近黑 = 得到调色板外的颜色(调色板, True, (背景接近白, 背景白, 前景黑))
-
-    # 打开管道 stdin/stdout
-    with open(源, 'rb') as 源文件:
-        stdinput = 源文件.read()
-
-    # 新建一个很长的命令，当它达到足够长度时就执行
-    # 因为分别执行填充命令非常的慢
-    last_iteration = len(调色板) - 1  # new
-    命令前缀 = '{convert} "{src}" '.format(convert=ImageMagick_convert_命令, src=源)
-    命令后缀 = ' "{target}"'.format(target=目标临时文件)
-    命令中间 = ''
-
-    for i, 颜色 in enumerate(调色板):
-        # fill this color with background or foreground?
-        if i == 颜色索引:
-            填充色 = 前景接近黑
-        elif i > 颜色索引 and stack:
-            填充色 = 前景接近黑
-        else:
-            填充色 = 背景接近白
+def 索引图类型(颜色总数):
+    """返回索引图的数据类型，除了颜色的索引，还要留出两个值给不在颜色表中的像素"""
+    if 颜色总数 + 2 <= 1 << 8:
+        return np.uint8
+    elif 颜色总数 + 2 <= 1 << 16:
+        return np.uint16
+    return np.uint32
 
-        命令中间 += ' -fill "{fill}" -opaque "{color}"'.format(fill=填充色, color=颜色)
-        if len(命令中间) >= 命令行最长 or (i == last_iteration and 命令中间):
-            命令 = 命令前缀 + 命令中间 + 命令后缀
 
-            stdoutput = 处理命令(命令, stdinput=stdinput, stdout_=True)
-            stdinput = stdoutput
-            命令中间 = ''  # reset
+def 解码索引图(已缩减图像, 颜色表):
+    """把已缩减颜色的图像解码为索引图，每个像素是它的颜色在颜色表中的索引
 
-    # 现在将前景变黑，背景变白
-    命令 = '{convert} "{src}" -fill "{fillbg}" -opaque "{colorbg}" -fill "{fillfg}" -opaque "{colorfg}" "{dest}"'.format(
-        convert=ImageMagick_convert_命令, src=目标临时文件, fillbg=背景白, colorbg=背景接近白,
-        fillfg=前景黑, colorfg=前景接近黑, dest=目标图层)
-    处理命令(命令, stdinput=stdinput)
+    不在颜色表中的像素，按 potrace 读取彩色位图时的灰度阈值 0.5，
+    暗的 (前景) 记为 len(颜色表)，亮的记为 len(颜色表) + 1
+"""
+    with Image.open(已缩减图像) as 图像:
+        像素 = np.asarray(图像.convert('RGB'))
+    打包 = 打包颜色(像素)
+    颜色值 = 打包颜色(颜色表转数组(颜色表))
+    顺序 = np.argsort(颜色值)
+    位置 = np.minimum(np.searchsorted(颜色值, 打包, sorter=顺序), len(顺序) - 1)
+    索引图 = 顺序[位置].astype(索引图类型(len(颜色表)))
+    未匹配 = 颜色值[索引图] != 打包
+    if 未匹配.any():
+        暗 = 像素.sum(axis=2, dtype=np.int32) < 383
+        索引图[未匹配 & 暗] = len(颜色表)
+        索引图[未匹配 & ~暗] = len(颜色表) + 1
+    return 索引图
+
+
+def 解码并制作颜色表(已缩减图像):
+    """解码已缩减颜色的图像，返回 (索引图, 颜色表)，颜色表是图像中出现的所有 #RRGGBB 颜色
+
+    颜色表的顺序和 ImageMagick 的 -unique-colors 相同，也就是颜色立方体八叉树的遍历顺序：
+    从最高位起，每一位依次由 蓝、绿、红 组成 3 位，按这样的莫顿码排序
+"""
+    with Image.open(已缩减图像) as 图像:
+        像素 = np.asarray(图像.convert('RGB'))
+    打包 = 打包颜色(像素)
+    唯一值, 逆索引 = np.unique(打包, return_inverse=True)
+    键 = np.zeros(len(唯一值), dtype=np.uint32)
+    for 位 in range(8):
+        for 分量, 移位 in enumerate((16, 8, 0)):  # 红、绿、蓝
+            键 |= ((唯一值 >> (移位 + 位)) & 1) << (3 * 位 + 分量)
+    顺序 = np.argsort(键)
+    排名 = np.empty(len(顺序), dtype=索引图类型(len(顺序)))
+    排名[顺序] = np.arange(len(顺序))
+    return 排名[逆索引.ravel()].reshape(打包.shape), ['#{0:06X}'.format(值) for 值 in 唯一值[顺序]]
+
+
+def 保留常用颜色(索引图, 颜色表, 上限):
+    """只保留像素最多的 上限 个颜色，其余颜色的像素改为保留的颜色中最接近的一个，返回 (新的索引图, 新的颜色表)"""
+    颜色总数 = len(颜色表)
+    计数 = np.bincount(索引图.ravel(), minlength=颜色总数 + 2)[:颜色总数]
+    保留 = np.zeros(颜色总数, dtype=bool)
+    保留[np.argsort(-计数, kind='stable')[:上限]] = True
+    调色板数组 = 颜色表转数组(颜色表)
+    映射 = np.arange(颜色总数 + 2, dtype=索引图.dtype)
+    映射[:颜色总数][~保留] = np.flatnonzero(保留)[最近颜色索引(调色板数组[~保留], 调色板数组[保留])]
+    return 去除未用颜色(映射[索引图], 颜色表)
+
+
+def 标记连通区域(索引图):
+    """返回索引图的 4 连通区域标记，同一区域中的像素标记相同
+
+    每一轮先让每一行、再让每一列中连续的同色像素段取段内最小的标记，
+    再做指针跳跃 (标记 = 标记[标记])，直到不再变化。标记是区域中某个像素的扁平索引
+"""
+    高, 宽 = 索引图.shape
+    总数 = 高 * 宽
+    标记 = np.arange(总数, dtype=np.int64 if 总数 > 2 ** 31 else np.int32)
+    段列表 = []
+    for 顺序 in (None, np.arange(总数).reshape(高, 宽).T.ravel()):
+        # 按行 (顺序为 None) 或按列排列的像素中，同色连续段的起点和每个像素所属的段
+        值 = 索引图.ravel() if 顺序 is None else 索引图.ravel()[顺序]
+        起点 = np.ones(总数, dtype=bool)
+        起点[1:] = 值[1:] != 值[:-1]
+        起点[::宽 if 顺序 is None else 高] = True
+        段列表.append((顺序, np.flatnonzero(起点), np.cumsum(起点) - 1))
+    while True:
+        旧标记 = 标记
+        for 顺序, 起点, 段号 in 段列表:
+            if 顺序 is None:
+                标记 = np.minimum.reduceat(标记, 起点)[段号]
+            else:
+                新标记 = np.empty_like(标记)
+                新标记[顺序] = np.minimum.reduceat(标记[顺序], 起点)[段号]
+                标记 = 新标记
+        标记 = 标记[标记]
+        if np.array_equal(标记, 旧标记):
+            return 标记.reshape(高, 宽)
 
 
-def 使用颜色填充(源, 目标):
-    命令 = '{convert} "{src}" -fill "{color}" +opaque none "{dest}"'.format(
-        convert=ImageMagick_convert_命令, src=源, color="#000000", dest=目标)
-    处理命令(命令)
+def 合并小区域(索引图, 最小面积):
+    """把面积小于 最小面积 个像素的连通区域并入周围的颜色，返回新的索引图
+
+    小区域从边缘开始，一圈圈地取相邻的大区域的颜色，直到被填满
+"""
+    标记 = 标记连通区域(索引图)
+    小 = np.bincount(标记.ravel())[标记] < 最小面积
+    if not 小.any() or 小.all():
+        return 索引图
+    结果 = 索引图.copy()
+    while 小.any():
+        新小 = 小.copy()
+        for 目标, 来源 in ((np.s_[:, 1:], np.s_[:, :-1]), (np.s_[:, :-1], np.s_[:, 1:]),
+                         (np.s_[1:], np.s_[:-1]), (np.s_[:-1], np.s_[1:])):
+            可填 = 新小[目标] & ~小[来源]
+            结果[目标][可填] = 结果[来源][可填]
+            新小[目标][可填] = False
+        小 = 新小
+    return 结果
+
+
+def 去除未用颜色(索引图, 颜色表):
+    """从颜色表中去掉索引图没有用到的颜色，返回 (新的索引图, 新的颜色表)"""
+    颜色总数 = len(颜色表)
+    已用 = np.bincount(索引图.ravel(), minlength=颜色总数 + 2)[:颜色总数] > 0
+    if 已用.all():
+        return 索引图, 颜色表
+    新总数 = int(已用.sum())
+    映射 = np.empty(颜色总数 + 2, dtype=索引图类型(新总数))
+    映射[:颜色总数] = np.cumsum(已用) - 1
+    映射[颜色总数:] = (新总数, 新总数 + 1)  # 不在颜色表中的像素
+    return 映射[索引图], [颜色 for 颜色, 用 in zip(颜色表, 已用) if 用]
+
+
+def 去除透明像素(索引图, 颜色表, 缩放文件):
+    """把缩放文件中完全透明的像素在索引图中记为背景，返回 (新的索引图, 新的颜色表)
+
+    透明像素在每个图层中都是背景，只用于透明像素的颜色也从颜色表中去掉，不再描摹
+"""
+    透明 = 透明像素(缩放文件)
+    if 透明 is None:
+        return 索引图, 颜色表
+    索引图[透明] = len(颜色表) + 1
+    if 透明.all():
+        # 整个图像都是透明的，留下一个空的图层，输出空白的 svg
+        return np.full(索引图.shape, 2, dtype=索引图类型(1)), 颜色表[:1]
+    return 去除未用颜色(索引图, 颜色表)
+
+
+def 映射索引图(索引图文件, 形状, 颜色总数):
+    """以只读内存映射打开队列一保存的原始索引图，各个颜色任务共享同一份页缓存，不用复制
+
+    图层直接由索引图得到，和以前用 ImageMagick 替换颜色的分层只有一处不同：调色板中有纯白色时，
+    以前白色图层会盖住整个图像，现在只包含白色的像素
+"""
+    return np.memmap(索引图文件, dtype=索引图类型(颜色总数), mode='r', shape=tuple(形状))
+
+
+def 上层遮挡(索引图, 颜色索引, 颜色总数, stack=False):
+    """返回颜色索引的图层中，之后的某一个图层同样包含的像素；没有之后的图层时返回 None
+
+    堆栈描摹时就是下一个图层的掩码。不堆栈时，之后的图层互不重叠，只有不在颜色表中的暗像素
+    出现在每个图层中
+"""
+    if 颜色索引 >= 颜色总数 - 1:
+        return None
+    if stack:
+        return (索引图 > 颜色索引) & (索引图 != 颜色总数 + 1)
+    return 索引图 == 颜色总数
+
+
+def 去除被遮挡区域(掩码, 遮挡):
+    """去掉掩码中完全落在 遮挡 内的 8 连通区域，返回新的掩码
+
+    这样的区域也是之后某个图层的一个完整的连通区域，potrace 在那里描摹出相同的路径并盖住它。
+    potrace 的路径不会跨越 8 连通区域，所以去掉整个区域不影响其他路径。
+    连通区域按每行的连续段计算：相邻两行中列范围重叠或者对角相接的段连通
+"""
+    高, 宽 = 掩码.shape
+    填充 = np.zeros((高, 宽 + 2), dtype=np.int8)
+    填充[:, 1:-1] = 掩码
+    变化 = np.diff(填充, axis=1)
+    行, 起 = np.nonzero(变化 == 1)
+    _, 止 = np.nonzero(变化 == -1)  # 段是 [起, 止)
+    if len(行) == 0:
+        return 掩码
+
+    # 每段和下一行中 起 <= 本段的止、止 >= 本段的起 的段相连，它们在段列表中是连续的一组
+    跨度 = 宽 + 2
+    起键 = 行 * 跨度 + 起
+    止键 = 行 * 跨度 + 止
+    首 = np.searchsorted(止键, (行 + 1) * 跨度 + 起, side='left')
+    尾 = np.searchsorted(起键, (行 + 1) * 跨度 + 止, side='right')
+    个数 = np.maximum(尾 - 首, 0)
+    甲 = np.repeat(np.arange(len(行)), 个数)
+    乙 = 首[甲] + np.arange(len(甲)) - np.repeat(np.cumsum(个数) - 个数, 个数)
+
+    # 在段组成的图上传播最小的段号，再做指针跳跃，直到每个连通区域的段号相同
+    标记 = np.arange(len(行))
+    while True:
+        旧标记 = 标记.copy()
+        np.minimum.at(标记, 甲, 标记[乙])
+        np.minimum.at(标记, 乙, 标记[甲])
+        标记 = 标记[标记]
+        if np.array_equal(标记, 旧标记):
+            break
+
+    # 含有不在 遮挡 中的像素的区域保留
+    露出 = np.zeros(高 * (宽 + 1) + 1, dtype=np.int64)
+    露出[1:] = np.cumsum(np.pad(掩码 & ~遮挡, ((0, 0), (0, 1))).ravel())
+    段露出 = 露出[行 * (宽 + 1) + 止] > 露出[行 * (宽 + 1) + 起]
+    保留区域 = np.zeros(len(行), dtype=bool)
+    保留区域[标记[段露出]] = True
+    去掉 = ~保留区域[标记]
+    if not 去掉.any():
+        return 掩码
+
+    差分 = np.zeros((高, 宽 + 1), dtype=np.int32)
+    np.add.at(差分, (行[去掉], 起[去掉]), 1)
+    np.add.at(差分, (行[去掉], 止[去掉]), -1)
+    return 掩码 & (np.cumsum(差分, axis=1)[:, :宽] == 0)
+
+
+def 孤立颜色(索引图, 目标图层, 颜色索引, 颜色总数, stack=False, 裁剪=False, 遮挡=None):
+    """把指定颜色的区域保存为黑色 (potrace 的前景)，其他区域为白色的 PBM 位图
+
+    索引图: 解码索引图 得到的索引图
+    目标图层: 输出 PBM 文件的路径
+    颜色索引: 要孤立的颜色在颜色表中的索引，None 表示整个图像都是前景 (-bg 的背景层)
+    颜色总数: 颜色表的颜色数，等于它的是不在颜色表中的暗像素，在每个图层中都是前景
+    stack: 如果 True，颜色索引之后的颜色也为黑，即掩码为 索引 >= 颜色索引。
+        所有堆栈图层都由同一个索引图各比较一次得到，而不用每层把所有颜色重新填充一遍
+    裁剪: 如果 True，只保存前景的外接矩形，并返回它的 (x, y, 宽, 高)；
+        没有前景时保存一个白色像素。否则保存整个图像，返回 None
+    遮挡: 上层遮挡 的结果，如果给出，完全落在其中的连通区域不保存，见 去除被遮挡区域
+"""
+    if 颜色索引 is None:
+        掩码 = np.ones(索引图.shape, dtype=bool)
+    elif stack:
+        掩码 = (索引图 >= 颜色索引) & (索引图 != 颜色总数 + 1)
+    else:
+        掩码 = (索引图 == 颜色索引) | (索引图 == 颜色总数)
+    if 遮挡 is not None:
+        掩码 = 去除被遮挡区域(掩码, 遮挡)
+    区域 = None
+    if 裁剪:
+        行 = np.flatnonzero(掩码.any(axis=1))
+        列 = np.flatnonzero(掩码.any(axis=0))
+        if len(行) == 0:
+            区域 = (0, 0, 1, 1)
+        else:
+            区域 = (int(列[0]), int(行[0]), int(列[-1] - 列[0] + 1), int(行[-1] - 行[0] + 1))
+        x, y, 宽, 高 = 区域
+        掩码 = 掩码[y:y + 高, x:x + 宽]
+    写入PBM(目标图层, np.packbits(掩码, axis=1), 掩码.shape[1])
+    return 区域
+
+
+def 写入PBM(路径, 位图, 宽):
+    """把 np.packbits 按行打包的位图保存为 potrace 可以读取的二进制 PBM 文件
+
+    位为 1 的是黑色，也就是 potrace 要描摹的前景
+"""
+    with open(路径, 'wb') as 文件:
+        文件.write(b'P4\n%d %d\n' % (宽, len(位图)))
+        文件.write(位图.tobytes())
+
 
 
 def 得到宽度(源):
-    """返回头像宽多少像素"""
-    命令 = '{identify} -ping -format "%w" "{src}"'.format(
+    """返回头像宽多少像素
+
+    Pillow 打开图像时只读取文件头，PNG、JPEG、GIF、BMP、WebP 等常见格式不必启动外部程序，
+    Pillow 不认识的格式才使用 ImageMagick identify
+"""
+    try:
+        with Image.open(打开输入(源)) as 图像:
+            return 图像.width
+    except Image.UnidentifiedImageError:
+        pass
+    数据 = None
+    if 拆分归档成员(源) is not None:
+        数据 = 读取归档成员(源)
+        源 = '{0}:-'.format(os.path.splitext(源)[1].lower()[1:])
+    # 多帧图像只取第一帧，否则 identify 会把每一帧的宽度连在一起输出
+    命令 = '{identify} -ping -format "%w" "{src}[0]"'.format(
         identify=ImageMagick_identify_命令, src=源)
-    stdoutput = 处理命令(命令, stdout_=True)
+    stdoutput = 处理命令(命令, stdinput=数据, stdout_=True)
     宽 = int(stdoutput)
     return 宽
 
 
+# potrace 尺寸参数的单位，换算成英寸；没有单位时是英寸
+尺寸单位 = {'': 1, 'in': 1, 'cm': 1 / 2.54, 'mm': 1 / 25.4, 'pt': 1 / 72}
+
+
+def 描摹分辨率(宽度, 高度, 宽, 高):
+    """返回和 potrace 的 --width、--height 等效的 --resolution
+
+    宽度, 高度: 同 描摹，高度可以是 None
+    宽, 高: 位图的像素宽高
+    用这个分辨率描摹位图中裁剪出的一部分，缩放比例和整个位图用 --width、--height 描摹时相同
+"""
+    def 英寸(尺寸):
+        匹配 = re.fullmatch(r'\s*([0-9.]+)\s*([a-z]*)\s*', str(尺寸))
+        if 匹配 is None or 匹配.group(2) not in 尺寸单位:
+            raise ValueError("无法识别的尺寸: {0}".format(尺寸))
+        return float(匹配.group(1)) * 尺寸单位[匹配.group(2)]
+
+    分辨率 = '{0:.10g}'.format(宽 / 英寸(宽度))
+    if 高度 is not None:
+        分辨率 += 'x{0:.10g}'.format(高 / 英寸(高度))
+    return 分辨率
+
+
 def 描摹(源, 描摹目标, 输出颜色, 抑制斑点像素数=2, 平滑转角=1.0, 优化路径=0.2, 宽度=None, 高度=None, 分辨率=None):
     """在指定的颜色、选项下，运行 potrace
 
@@ -378,6 +996,41 @@ def 描摹(源, 描摹目标, 输出颜色, 抑制斑点像素数=2, 平滑转
     处理命令(命令)
 
 
+def 批量描摹(源列表, 描摹目标列表, 输出颜色列表, 抑制斑点像素数=2, 平滑转角=1.0, 优化路径=0.2,
+         宽度=None, 高度=None, 分辨率=None):
+    """用一个 potrace 进程描摹多个 PBM 位图，参数同 描摹，只是 源、描摹目标、输出颜色 都是列表
+
+    所有位图首尾相接，从 stdin 送给 potrace，它会依次输出各个 svg 文档。
+    输出按 xml 声明切分后，把每个文档的填充色从默认的黑色换成相应的颜色，保存到描摹目标。
+    切分出的文档数和位图数不同，或者有文档不完整时，改为每个位图单独运行一次 potrace
+"""
+    宽度参数 = f'--width {宽度}' if 宽度 is not None else ''
+    高度参数 = f'--height {高度}' if 高度 is not None else ''
+    分辨率参数 = f'--resolution {分辨率}' if 分辨率 is not None else ''
+
+    命令 = f'''{potrace_命令} --svg -t {抑制斑点像素数} -a {平滑转角} -O {优化路径} 
+                {宽度参数} {高度参数} {分辨率参数}'''
+    汇报(命令)
+
+    位图流 = bytearray()
+    for 源 in 源列表:
+        with open(源, 'rb') as 文件:
+            位图流 += 文件.read()
+    stdoutput = 处理命令(命令, stdinput=bytes(位图流), stdout_=True)
+
+    文档列表 = [b'<?xml' + 文档 for 文档 in stdoutput.split(b'<?xml')[1:]]
+    if len(文档列表) != len(源列表) or not all(文档.rstrip().endswith(b'</svg>') for 文档 in 文档列表):
+        # 切分出的文档和图层对不上时，不知道哪个文档是哪个颜色，改为每个图层单独运行 potrace
+        汇报("potrace 输出了 {0} 个 svg 文档，应该是 {1} 个，改为逐个描摹".format(len(文档列表), len(源列表)),
+            level=0)
+        for 源, 描摹目标, 输出颜色 in zip(源列表, 描摹目标列表, 输出颜色列表):
+            描摹(源, 描摹目标, 输出颜色, 抑制斑点像素数, 平滑转角, 优化路径, 宽度, 高度, 分辨率)
+        return
+    for 文档, 描摹目标, 输出颜色 in zip(文档列表, 描摹目标列表, 输出颜色列表):
+        with open(描摹目标, 'wb') as 文件:
+            文件.write(文档.replace(b'fill="#000000"', 'fill="{0}"'.format(输出颜色).encode(), 1))
+
+
 def 检查范围(min, max, typefunc, typename, strval):
     """对 argparse 的参数，检查参数是否符合范围
 
@@ -401,6 +1054,63 @@ def 检查范围(min, max, typefunc, typename, strval):
     return val
 
 
+变体选项 = {
+    'stack': None,
+    'background': None,
+    'despeckle': functools.partial(检查范围, 0, None, int, "an integer"),
+    'smoothcorners': functools.partial(检查范围, 0, 1.334, float, "a floating-point number"),
+    'optimizepaths': functools.partial(检查范围, 0, 5, float, "a floating-point number"),
+}
+
+
+def 解析变体(strval):
+    """对 argparse 的 --variant 参数，把 名称:键=值,键=值 解析为 (名称, 参数字典)"""
+    名称, 分隔符, 参数文本 = strval.partition(':')
+    if not 名称 or not 分隔符 or re.search(r'[\\/:*?"<>|]', 名称):
+        raise argparse.ArgumentTypeError("must be name:key=value,... with a name usable in file names")
+    参数 = {}
+    for 项 in filter(None, 参数文本.split(',')):
+        键, _, 值 = 项.partition('=')
+        if 键 not in 变体选项:
+            raise argparse.ArgumentTypeError(
+                "unknown key '{0}', expected one of: {1}".format(键, ', '.join(变体选项)))
+        if 变体选项[键] is None:
+            if 值.lower() not in ('', '1', 'true', 'yes', '0', 'false', 'no'):
+                raise argparse.ArgumentTypeError("{0} must be true or false".format(键))
+            参数[键] = 值.lower() in ('', '1', 'true', 'yes')
+        else:
+            try:
+                参数[键] = 变体选项[键](值)
+            except argparse.ArgumentTypeError as e:
+                raise argparse.ArgumentTypeError("{0} {1}".format(键, e))
+    return 名称, 参数
+
+
+def 检查颜色数(strval):
+    """对 argparse 的 --colors 参数，接受 'auto' 或者 0 到 256 的整数"""
+    if strval == 'auto':
+        return strval
+    return 检查范围(0, 256, int, "an integer or 'auto'", strval)
+
+
+def 解析分片(strval):
+    """对 argparse 的 --shard 参数，把 i/N 解析为 (i, N)，1 <= i <= N"""
+    匹配 = re.fullmatch(r'(\d+)/(\d+)', strval.strip())
+    if 匹配 is None:
+        raise argparse.ArgumentTypeError("must be i/N, e.g. 3/20")
+    序号, 总数 = int(匹配.group(1)), int(匹配.group(2))
+    if not 1 <= 序号 <= 总数:
+        raise argparse.ArgumentTypeError("i must be between 1 and N")
+    return 序号, 总数
+
+
+def 检查缩放(strval):
+    """对 argparse 的 --prescale 参数，接受 'auto' 或者不小于 0 的浮点数"""
+    if strval == 'auto':
+        return strval
+    return 检查范围(0, None, float, "a floating-point number or 'auto'", strval)
+
+
 
 def 转义括号(string):
     '''使用 [[] 换替 [，使用 []] 换替 ]  (i.e. escapes [ and ] for globbing)'''
@@ -413,10 +1123,200 @@ def 转义括号(string):
     return ''.join(letters)
 
 
+# 输入中归档和成员之间的分隔符，例如 assets.tar::icons/*.png
+归档分隔符 = '::'
+# 归档的扩展名 -> (格式, 压缩方式)
+归档扩展名 = {'.zip': ('zip', None), '.tar': ('tar', ''), '.tar.gz': ('tar', 'gz'), '.tgz': ('tar', 'gz'),
+          '.tar.bz2': ('tar', 'bz2'), '.tbz2': ('tar', 'bz2'), '.tar.xz': ('tar', 'xz'), '.txz': ('tar', 'xz')}
+# 每个进程各自打开的归档，(进程号, 路径) -> (ZipFile 或 TarFile, 锁)。
+# 依次读取同一个 tar 中靠后的成员时可以接着解压，不必每次从头开始
+_已打开归档 = {}
+# 每个进程最近读取的成员，进程号 -> (输入, 内容)。一个队列一任务的缩放、选择倍数和得到宽度
+# 读取的是同一个成员，只解压一次；压缩的 tar 向回读取时要从头重新解压
+_最近读取成员 = {}
+
+
+def 归档格式(路径):
+    """按扩展名返回归档的 (格式, 压缩方式)，不是归档时返回 None"""
+    小写 = 路径.lower()
+    for 扩展名, 格式 in 归档扩展名.items():
+        if 小写.endswith(扩展名):
+            return 格式
+    return None
+
+
+def 拆分归档成员(输入):
+    """把 归档::成员 形式的输入拆分为 (归档, 成员)，普通文件返回 None"""
+    归档, 分隔符, 成员 = 输入.partition(归档分隔符)
+    if not 分隔符 or 归档格式(归档) is None:
+        return None
+    return 归档, 成员
+
+
+def 打开归档(归档):
+    """返回当前进程中打开的 (归档对象, 锁)；fork 出的工作进程不会沿用父进程的文件位置"""
+    键 = (os.getpid(), os.path.abspath(归档))
+    if 键 not in _已打开归档:
+        if 归档格式(归档)[0] == 'zip':
+            _已打开归档[键] = (zipfile.ZipFile(归档), threading.Lock())
+        else:
+            _已打开归档[键] = (tarfile.open(归档, 'r:*'), threading.Lock())
+    return _已打开归档[键]
+
+
+def 归档成员列表(归档):
+    """返回归档中所有文件成员的 (名称, 大小)"""
+    对象, 锁 = 打开归档(归档)
+    with 锁:
+        if isinstance(对象, zipfile.ZipFile):
+            return [(信息.filename, 信息.file_size) for 信息 in 对象.infolist() if not 信息.is_dir()]
+        return [(信息.name, 信息.size) for 信息 in 对象.getmembers() if 信息.isfile()]
+
+
+def 读取归档成员(输入):
+    """返回 归档::成员 形式的输入的内容，连续读取同一个成员时只解压一次"""
+    最近 = _最近读取成员.get(os.getpid())
+    if 最近 is not None and 最近[0] == 输入:
+        return 最近[1]
+    归档, 成员 = 拆分归档成员(输入)
+    对象, 锁 = 打开归档(归档)
+    with 锁:
+        try:
+            if isinstance(对象, zipfile.ZipFile):
+                内容 = 对象.read(成员)
+            else:
+                文件 = 对象.extractfile(成员)
+                if 文件 is None:
+                    raise Exception("{0} 中的 {1} 不是文件".format(归档, 成员))
+                内容 = 文件.read()
+        except KeyError:
+            raise Exception("{0} 中没有 {1}".format(归档, 成员))
+    _最近读取成员[os.getpid()] = (输入, 内容)
+    return 内容
+
+
+def 打开输入(输入):
+    """返回可以交给 Image.open 的输入：普通文件原样返回路径，归档成员返回它的内容"""
+    if 拆分归档成员(输入) is None:
+        return 输入
+    return io.BytesIO(读取归档成员(输入))
+
+
+def 逐个打开输入(输入列表):
+    """依次生成 (输入, 可以交给 Image.open 的对象)，结果和逐个调用 打开输入 相同
+
+    压缩的 tar 只能从头解压，随机读取其中的成员会一次次重新解压前面的内容。
+    连续几个输入是同一个压缩 tar 的成员时，用流模式 'r|*' 按成员顺序只解压一遍，
+    顺序和归档中不同的成员先暂存起来，找不到的成员交给 打开输入 报错
+"""
+    i = 0
+    while i < len(输入列表):
+        拆分 = 拆分归档成员(输入列表[i])
+        if 拆分 is None or not 归档格式(拆分[0])[1]:
+            yield 输入列表[i], 打开输入(输入列表[i])
+            i += 1
+            continue
+        归档 = 拆分[0]
+        结束 = i
+        while 结束 < len(输入列表) and (拆分归档成员(输入列表[结束]) or (None,))[0] == 归档:
+            结束 += 1
+        剩余 = {拆分归档成员(输入)[1] for 输入 in 输入列表[i:结束]}
+        已读 = {}
+        with tarfile.open(归档, 'r|*') as 流:
+            for 信息 in 流:
+                if i == 结束:
+                    break
+                if 信息.isfile() and 信息.name in 剩余:
+                    剩余.discard(信息.name)
+                    已读[信息.name] = 流.extractfile(信息).read()
+                while i < 结束 and 拆分归档成员(输入列表[i])[1] in 已读:
+                    yield 输入列表[i], io.BytesIO(已读.pop(拆分归档成员(输入列表[i])[1]))
+                    i += 1
+        while i < 结束:
+            yield 输入列表[i], 打开输入(输入列表[i])
+            i += 1
+
+
+def 输入大小(输入):
+    """返回输入的字节数，归档成员是解压后的大小"""
+    拆分 = 拆分归档成员(输入)
+    if 拆分 is None:
+        return os.path.getsize(输入)
+    归档, 成员 = 拆分
+    对象, 锁 = 打开归档(归档)
+    with 锁:
+        if isinstance(对象, zipfile.ZipFile):
+            return 对象.getinfo(成员).file_size
+        return 对象.getmember(成员).size
+
+
+def 展开归档(归档, 成员模式='*'):
+    """返回归档中名称匹配 成员模式 的图像成员，每个都是 归档::成员 形式的输入"""
+    图像扩展名 = Image.registered_extensions()
+    return [归档 + 归档分隔符 + 名称 for 名称, _ in 归档成员列表(归档)
+            if os.path.splitext(名称)[1].lower() in 图像扩展名 and fnmatch.fnmatchcase(名称, 成员模式)]
+
+
+def 输入基本名(输入):
+    """返回输入不含扩展名的文件名，归档成员只取成员的文件名"""
+    拆分 = 拆分归档成员(输入)
+    if 拆分 is not None:
+        输入 = 拆分[1]
+    return os.path.basename(os.path.splitext(输入)[0])
+
+
+def 归档成员名(输出):
+    """把输出路径转为 --output-archive 中的成员名称"""
+    路径 = os.path.splitdrive(os.path.normpath(输出))[1]
+    return 路径.replace(os.sep, '/').lstrip('/')
+
+
+class 归档写入器:
+    """把完成的 svg 依次追加到一个 zip 或 tar 归档中
+
+    只在主进程中使用，工作进程把 (成员名称, 数据) 交给它的 put，或者放入一个由主进程取出的队列，
+    所以方法名和队列相同。多个线程可以同时调用 put
+"""
+    def __init__(self, 路径):
+        格式, 压缩方式 = 归档格式(路径)
+        目标文件夹 = os.path.dirname(os.path.abspath(路径))
+        os.makedirs(目标文件夹, exist_ok=True)
+        if 格式 == 'zip':
+            self.归档 = zipfile.ZipFile(路径, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.归档 = tarfile.open(路径, 'w:' + 压缩方式)
+        self.锁 = threading.Lock()
+
+    def put(self, 项):
+        名称, 数据 = 项
+        with self.锁:
+            if isinstance(self.归档, zipfile.ZipFile):
+                self.归档.writestr(名称, 数据)
+            else:
+                信息 = tarfile.TarInfo(名称)
+                信息.size = len(数据)
+                信息.mtime = time.time()
+                self.归档.addfile(信息, io.BytesIO(数据))
+
+    def 取出(self, 队列):
+        """写入队列中现有的所有项"""
+        while True:
+            try:
+                self.put(队列.get_nowait())
+            except queue.Empty:
+                return
+
+    def 关闭(self):
+        with self.锁:
+            self.归档.close()
+
+
 def 得到输入输出(arg_inputs, output_pattern="{0}.svg", ignore_duplicates=True):
     """使用 *? shell 通配符展开，得到 (input, matching output) 的遍历器
 
     arg_inputs: command-line-given inputs, can include *? wildcards
+        zip、tar 归档展开为其中的每个图像，得到 归档::成员 形式的输入；
+        归档::模式 只取名称匹配模式的成员，例如 assets.tar::icons/*.png
     output_pattern: pattern to rename output file, with {0} for input's base
         name without extension e.g. pic.png + {0}.svg = pic.svg
     ignore_duplicates: don't process or return inputs that have been returned already.
@@ -424,6 +1324,10 @@ def 得到输入输出(arg_inputs, output_pattern="{0}.svg", ignore_duplicates=T
 """
     old_inputs = set()
     for arg_input in arg_inputs:
+        if 拆分归档成员(arg_input) is not None:
+            arg_input, _, 成员模式 = arg_input.partition(归档分隔符)
+        else:
+            成员模式 = '*'
         if '*' in arg_input or '?' in arg_input:
             # preventing [] expansion here because glob has problems with legal [] filenames
             # ([] expansion still works in a Unix shell, it happens before Python even executes)
@@ -434,20 +1338,416 @@ def 得到输入输出(arg_inputs, output_pattern="{0}.svg", ignore_duplicates=T
             # ensures non-existing file paths are included so they are reported as such
             # (glob silently skips over non-existing files, but we want to know about them)
             inputs_ = (arg_input,)
-        for input_ in inputs_:
-            if ignore_duplicates:
-                if input_ not in old_inputs:
-                    old_inputs.add(input_)
-                    basename = os.path.basename(os.path.splitext(input_)[0])
+        for archive_input in inputs_:
+            if 归档格式(archive_input) is not None and os.path.isfile(archive_input):
+                成员列表 = 展开归档(archive_input, 成员模式)
+            else:
+                成员列表 = (archive_input,)
+            for input_ in 成员列表:
+                if ignore_duplicates:
+                    if input_ not in old_inputs:
+                        old_inputs.add(input_)
+                        basename = 输入基本名(input_)
+                        output = output_pattern.format(basename)
+                        yield input_, output
+                else:
+                    basename = 输入基本名(input_)
                     output = output_pattern.format(basename)
                     yield input_, output
-            else:
-                basename = os.path.basename(os.path.splitext(input_)[0])
-                output = output_pattern.format(basename)
-                yield input_, output
 
 
-def 队列1_任务(队列2, 总数, 图层, 设置, findex, 输入文件, output):
+def 分片(输入列表, 输出列表, 序号, 总数):
+    """返回第 序号 个 (从 1 开始) 分片的 (输入列表, 输出列表)，所有输入平均分为 总数 个分片
+
+    按输入路径排序后轮流分配，每个节点展开通配符的顺序不同也会得到相同的划分
+"""
+    排序 = sorted(range(len(输入列表)), key=lambda k: 输入列表[k])
+    选中 = set(排序[序号 - 1::总数])
+    return ([输入 for k, 输入 in enumerate(输入列表) if k in 选中],
+            [输出 for k, 输出 in enumerate(输出列表) if k in 选中])
+
+
+class 认领目录:
+    """在多台主机共享的文件夹中用租约文件认领输入，不需要额外的消息服务
+
+    每个输入对应一个以它的绝对路径的哈希命名的文件，所以各主机要把共享存储挂载在相同的路径：
+    .lease 是租约，用 O_EXCL 创建，持有者定期更新它的修改时间；超过 租期 秒没有更新的租约
+    视为持有者已经崩溃，可以被别人抢走。.done 表示这个输入已经完成，谁都不再认领
+"""
+    def __init__(self, 文件夹, 租期=600):
+        os.makedirs(文件夹, exist_ok=True)
+        self.文件夹 = 文件夹
+        self.租期 = 租期
+        # 写在租约里，抢租约时用来确认抢到的是原来那份过期的租约
+        self.标识 = '{0} {1} {2}'.format(socket.gethostname(), os.getpid(), os.urandom(8).hex())
+        self.持有 = set()
+        self.锁 = threading.Lock()
+        self.停止 = threading.Event()
+        self.续期线程 = None
+
+    def 路径(self, 输入, 后缀):
+        键 = hashlib.sha1(os.path.abspath(输入).encode()).hexdigest()
+        return os.path.join(self.文件夹, 键 + 后缀)
+
+    def 已完成(self, 输入):
+        return os.path.exists(self.路径(输入, '.done'))
+
+    def 认领(self, 输入):
+        """尝试认领一个输入，成功时返回 True；已完成或者别人持有未过期的租约时返回 False"""
+        if self.已完成(输入):
+            return False
+        租约 = self.路径(输入, '.lease')
+        for _ in range(2):
+            try:
+                描述符 = os.open(租约, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.抢过期租约(租约):
+                    return False
+                continue
+            with os.fdopen(描述符, 'w') as 文件:
+                文件.write(self.标识)
+            if self.已完成(输入):
+                # 检查之后、创建之前，别人刚好完成了它
+                删除文件(租约)
+                return False
+            with self.锁:
+                self.持有.add(租约)
+            return True
+        return False
+
+    def 抢过期租约(self, 租约):
+        """租约已经过期时删除它并返回 True，之后可以重新用 O_EXCL 创建"""
+        try:
+            if time.time() - os.path.getmtime(租约) < self.租期:
+                return False
+            with open(租约) as 文件:
+                旧标识 = 文件.read()
+            # 改名是原子的，同时抢同一份租约的主机只有一个能成功
+            暂存 = '{0}.{1}'.format(租约, os.urandom(8).hex())
+            os.rename(租约, 暂存)
+        except FileNotFoundError:
+            return True  # 持有者刚刚完成或者释放了它
+        with open(暂存) as 文件:
+            抢到的标识 = 文件.read()
+        if 抢到的标识 != 旧标识:
+            # 在读取和改名之间，别人已经抢走并创建了新的租约，把它放回去
+            try:
+                os.link(暂存, 租约)
+            except FileExistsError:
+                pass
+            删除文件(暂存)
+            return False
+        汇报("收回过期的租约：{0} ({1})".format(租约, 旧标识))
+        删除文件(暂存)
+        return True
+
+    def 完成(self, 输入):
+        """把认领的输入标记为完成，并放弃租约"""
+        with open(self.路径(输入, '.done'), 'w') as 文件:
+            文件.write(self.标识)
+        self.释放(输入)
+
+    def 释放(self, 输入):
+        """放弃租约，别人可以立即认领这个输入"""
+        租约 = self.路径(输入, '.lease')
+        with self.锁:
+            self.持有.discard(租约)
+        self.删除租约(租约)
+
+    def 删除租约(self, 租约):
+        """租约仍然是自己的才删除；过期后被别人抢走的租约留给新的持有者"""
+        try:
+            with open(租约) as 文件:
+                if 文件.read() != self.标识:
+                    return
+            os.remove(租约)
+        except FileNotFoundError:
+            pass
+
+    def 续期(self):
+        """在后台线程中定期更新持有的租约，直到调用 关闭"""
+        while not self.停止.wait(self.租期 / 3):
+            with self.锁:
+                持有 = list(self.持有)
+            for 租约 in 持有:
+                try:
+                    os.utime(租约)
+                except FileNotFoundError:
+                    pass
+
+    def __enter__(self):
+        self.续期线程 = threading.Thread(target=self.续期, name='color_trace lease renewal', daemon=True)
+        self.续期线程.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.停止.set()
+        self.续期线程.join()
+        with self.锁:
+            持有 = list(self.持有)
+            self.持有.clear()
+        for 租约 in 持有:
+            self.删除租约(租约)
+
+
+def 认领描摹(输入列表, 文件夹, 租期, 每批数量, 描摹函数):
+    """和其他主机一起处理输入：每次认领最多 每批数量 个输入，把它们在 输入列表 中的索引列表交给 描摹函数，
+    它返回时这些输入都已完成
+
+    一轮认领不到新输入时，如果还有别人持有的未完成输入，就等待它们完成或者租约过期，
+    所以崩溃的主机认领的输入最终会被别的主机重新处理。出错时放弃本批的租约，让别人重试
+"""
+    剩余 = list(range(len(输入列表)))
+    with 认领目录(文件夹, 租期) as 目录:
+        while 剩余:
+            本批 = []
+            for 索引 in 剩余:
+                if len(本批) >= 每批数量:
+                    break
+                if 目录.认领(输入列表[索引]):
+                    本批.append(索引)
+            if 本批:
+                汇报("认领了 {0} 个输入".format(len(本批)))
+                try:
+                    描摹函数(本批)
+                except BaseException:
+                    for 索引 in 本批:
+                        目录.释放(输入列表[索引])
+                    raise
+                for 索引 in 本批:
+                    目录.完成(输入列表[索引])
+            剩余 = [索引 for 索引 in 剩余 if not 目录.已完成(输入列表[索引])]
+            if 剩余 and not 本批:
+                # 剩下的都在别人手里，等它们完成或者租约过期
+                time.sleep(min(目录.租期 / 3, 5))
+
+
+# 记录耗时的各个阶段，名称也用在指标输出中
+指标阶段 = ('rescale', 'quantize', 'index', 'isolate', 'trace', 'assemble')
+# 耗时直方图各个桶的上限，单位是秒
+指标桶 = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class 运行指标:
+    """各阶段的耗时直方图和已完成的文件数
+
+    共享时数据放在共享内存中，工作进程记录，主进程读取；
+    否则只在当前进程的各个线程间共享
+"""
+    def __init__(self, 共享=False):
+        # 每个阶段依次是各个桶的计数、超出所有桶的计数、耗时总和，最后一项是已完成的文件数
+        self.每阶段长度 = len(指标桶) + 2
+        长度 = len(指标阶段) * self.每阶段长度 + 1
+        if 共享:
+            self.数据 = multiprocessing.Array('d', 长度)
+            self.锁 = self.数据.get_lock()
+        else:
+            self.数据 = [0.0] * 长度
+            self.锁 = threading.Lock()
+
+    def 记录(self, 阶段, 秒数):
+        起点 = 指标阶段.index(阶段) * self.每阶段长度
+        桶 = next((i for i, 上限 in enumerate(指标桶) if 秒数 <= 上限), len(指标桶))
+        with self.锁:
+            self.数据[起点 + 桶] += 1
+            self.数据[起点 + self.每阶段长度 - 1] += 秒数
+
+    def 完成文件(self):
+        with self.锁:
+            self.数据[-1] += 1
+
+    def 快照(self):
+        """返回 (已完成文件数, {阶段: (各桶计数列表, 耗时总和)})"""
+        with self.锁:
+            数据 = list(self.数据)
+        阶段 = {}
+        for i, 名称 in enumerate(指标阶段):
+            起点 = i * self.每阶段长度
+            阶段[名称] = (数据[起点:起点 + len(指标桶) + 1], 数据[起点 + self.每阶段长度 - 1])
+        return int(数据[-1]), 阶段
+
+
+@contextlib.contextmanager
+def 计时(阶段):
+    """如果启用了运行指标，就把 with 块的耗时记入这个阶段"""
+    开始 = time.perf_counter()
+    yield
+    if _运行指标 is not None:
+        _运行指标.记录(阶段, time.perf_counter() - 开始)
+
+
+class 指标汇报:
+    """在主进程中汇总运行指标，定期写入文件，或者在本地 HTTP 端口上提供
+
+    状态: 一个函数，返回包含 files_total、layers_done、layers_total、queue_depth 键的字典，
+        queue_depth 是 {队列名: 排队的任务数}
+    文件: 指标文件的路径，以 .json 结尾时写入 json，否则写入 Prometheus 文本格式
+    地址: [host:]port，GET /metrics 返回 Prometheus 文本，GET /metrics.json 返回 json
+"""
+    def __init__(self, 指标, 状态, 文件=None, 地址=None):
+        self.指标 = 指标
+        self.状态 = 状态
+        self.文件 = 文件
+        self.开始时间 = time.monotonic()
+        self.历史 = []  # [(时间, 已完成文件数, 已完成图层数), ...]，用于计算当前吞吐量
+        self.历史锁 = threading.Lock()  # 定期写入和 HTTP 请求可能同时汇总
+        self.停止 = threading.Event()
+        self.httpd = None
+        if 地址 is not None:
+            主机, _, 端口 = 地址.rpartition(':')
+            import http.server
+            处理类 = type('指标请求处理', (指标请求处理, http.server.BaseHTTPRequestHandler), {})
+            self.httpd = http.server.ThreadingHTTPServer((主机 or '127.0.0.1', int(端口)), 处理类)
+            self.httpd.指标汇报 = self
+            threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+            汇报('指标服务运行于 http://{0}:{1}/metrics'.format(*self.httpd.server_address[:2]))
+        self.线程 = threading.Thread(target=self.定期写入, daemon=True)
+        self.线程.start()
+
+    def 汇总(self):
+        """返回当前所有指标的字典"""
+        现在 = time.monotonic()
+        已完成文件数, 阶段 = self.指标.快照()
+        状态 = self.状态()
+        已完成图层数 = 状态['layers_done']
+        with self.历史锁:
+            self.历史.append((现在, 已完成文件数, 已完成图层数))
+            while len(self.历史) > 2 and 现在 - self.历史[1][0] >= 指标速率窗口:
+                del self.历史[0]
+            起点时间, 起点文件数, 起点图层数 = self.历史[0]
+        时长 = 现在 - 起点时间
+        每秒文件数 = (已完成文件数 - 起点文件数) / 时长 if 时长 > 0 else 0.0
+        每秒图层数 = (已完成图层数 - 起点图层数) / 时长 if 时长 > 0 else 0.0
+        剩余图层数 = max(状态['layers_total'] - 已完成图层数, 0)
+        return {
+            'elapsed_seconds': 现在 - self.开始时间,
+            'files_done': 已完成文件数,
+            'files_total': 状态['files_total'],
+            'layers_done': 已完成图层数,
+            # 量化后才知道每个文件实际的颜色数，在此之前这只是一个估计值
+            'layers_total': 状态['layers_total'],
+            'files_per_second': 每秒文件数,
+            'layers_per_second': 每秒图层数,
+            'eta_seconds': 剩余图层数 / 每秒图层数 if 每秒图层数 > 0 else None,
+            'queue_depth': 状态['queue_depth'],
+            'stage_seconds': {
+                名称: {'buckets': dict(zip([*map(str, 指标桶), '+Inf'], map(int, 计数))),
+                       'sum': 总和, 'count': int(sum(计数))}
+                for 名称, (计数, 总和) in 阶段.items()},
+        }
+
+    def 定期写入(self):
+        while not self.停止.wait(指标汇报间隔):
+            self.写入文件()
+
+    def 写入文件(self):
+        if self.文件 is None:
+            return
+        指标 = self.汇总()
+        if self.文件.endswith('.json'):
+            内容 = json.dumps(指标, ensure_ascii=False)
+        else:
+            内容 = Prometheus文本(指标)
+        # 先写入临时文件再替换，读取方不会读到写了一半的文件
+        临时路径 = self.文件 + '.tmp'
+        with open(临时路径, 'w', encoding='utf-8') as f:
+            f.write(内容)
+        os.replace(临时路径, self.文件)
+
+    def 关闭(self):
+        """停止定期写入，写入最终的指标，关闭 HTTP 服务"""
+        self.停止.set()
+        self.线程.join()
+        self.写入文件()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+def Prometheus文本(指标):
+    """把 指标汇报.汇总 返回的字典转为 Prometheus 文本格式"""
+    行 = []
+
+    def 添加(名称, 类型, 值, 标签=''):
+        if 类型 is not None:
+            行.append('# TYPE color_trace_{0} {1}'.format(名称, 类型))
+        if 值 is not None:
+            行.append('color_trace_{0}{1} {2}'.format(名称, 标签, 值))
+
+    for 名称, 类型 in (('files_done', 'counter'), ('files_total', 'gauge'), ('layers_done', 'counter'),
+                     ('layers_total', 'gauge'), ('files_per_second', 'gauge'),
+                     ('layers_per_second', 'gauge'), ('eta_seconds', 'gauge'),
+                     ('elapsed_seconds', 'gauge')):
+        添加(名称, 类型, 指标[名称])
+    添加('queue_depth', 'gauge', None)
+    for 队列名, 深度 in 指标['queue_depth'].items():
+        添加('queue_depth', None, 深度, '{{queue="{0}"}}'.format(队列名))
+    添加('stage_seconds', 'histogram', None)
+    for 阶段, 直方图 in 指标['stage_seconds'].items():
+        累计 = 0
+        for 上限, 计数 in 直方图['buckets'].items():
+            累计 += 计数
+            添加('stage_seconds_bucket', None, 累计, '{{stage="{0}",le="{1}"}}'.format(阶段, 上限))
+        添加('stage_seconds_sum', None, 直方图['sum'], '{{stage="{0}"}}'.format(阶段))
+        添加('stage_seconds_count', None, 直方图['count'], '{{stage="{0}"}}'.format(阶段))
+    return '\n'.join(行) + '\n'
+
+
+class 指标请求处理:
+    """GET /metrics 返回 Prometheus 文本，GET /metrics.json 返回 json
+
+    和 http.server.BaseHTTPRequestHandler 一起使用，见 指标汇报
+"""
+    def do_GET(self):
+        路径 = urllib.parse.urlsplit(self.path).path
+        状态码 = 200
+        if 路径 == '/metrics':
+            内容, 类型 = Prometheus文本(self.server.指标汇报.汇总()), 'text/plain; version=0.0.4'
+        elif 路径 == '/metrics.json':
+            内容, 类型 = json.dumps(self.server.指标汇报.汇总(), ensure_ascii=False), 'application/json'
+        else:
+            状态码, 内容, 类型 = 404, 'not found\n', 'text/plain; charset=utf-8'
+        内容 = 内容.encode()
+        self.send_response(状态码)
+        self.send_header('Content-Type', 类型)
+        self.send_header('Content-Length', str(len(内容)))
+        self.end_headers()
+        self.wfile.write(内容)
+
+    def log_message(self, format, *args):
+        汇报(self.address_string(), format % args, level=2)
+
+
+def 队列1临时文件(设置, findex):
+    """返回队列一的任务为第 findex 个输入使用的 (缩放文件, 减色文件, 索引图文件)"""
+    return tuple(os.path.abspath(os.path.join(设置['临时文件'], '{0}~{1}'.format(findex, 名称)))
+                 for 名称 in ('scaled.png', 'reduced.png', 'index.raw'))
+
+
+def 缩放并选择颜色数(设置, 输入文件, 缩放文件):
+    """按设置放大输入图像，保存到缩放文件，返回 (缩放倍数, 要缩减到的颜色数)"""
+    颜色数 = 设置['颜色数']
+    # 如果跳过了量化，则必须使用不会增加颜色数量的缩放方法
+    if 颜色数 == 0:
+        滤镜 = 'point'
+    else:
+        滤镜 = 'lanczos'
+    缩放 = 设置['prescale']
+    with 计时('rescale'):
+        if 缩放 == 'auto':
+            缩放 = 自动缩放倍数(输入文件, 设置['pixel_budget'])
+            汇报(f'{输入文件} 自动放大 {缩放:g} 倍')
+        重缩放(输入文件, 缩放文件, 缩放, 滤镜=滤镜)
+
+    if 颜色数 == 'auto':
+        with 计时('quantize'):
+            with Image.open(缩放文件) as 图像:
+                颜色数 = 自动颜色数(缩略图像素(图像))
+        汇报(f'{输入文件} 自动选择 {颜色数} 个颜色')
+    return 缩放, 颜色数
+
+
+def 队列1_任务(队列2, 总数, 图层, 设置, findex, 输入文件, output, 已量化=None):
     """ 初始化文件、重新缩放、缩减颜色
 
     队列2: 第二个任务列表 (颜色孤立 + 临摹)
@@ -459,42 +1759,98 @@ def 队列1_任务(队列2, 总数, 图层, 设置, findex, 输入文件, output
     输入索引: 输入文件的整数索引 findex
     输入: 输入 png 文件
     输出: 输出 svg 路径
+    已量化: 由 队列1_批量任务 给出的 (缩放倍数, 颜色数)，表示已经缩放并缩减了颜色，
+        直接从减色文件继续；None 表示从头处理
 """
     # 如果输出目录不存在，则创建
     目标文件夹 = os.path.dirname(os.path.abspath(output))
-    if not os.path.exists(目标文件夹):
+    if 设置['输出归档'] is None and not os.path.exists(目标文件夹):
         os.makedirs(目标文件夹)
 
     # 临时文件会放置在各个输出文件的旁边
-    缩放文件 = os.path.abspath(os.path.join(设置['临时文件'], '{0}~scaled.png'.format(findex)))
-    减色文件 = os.path.abspath(os.path.join(设置['临时文件'], '{0}~reduced.png'.format(findex)))
+    缩放文件, 减色文件, 索引图文件 = 队列1临时文件(设置, findex)
 
     try:
-        # 如果跳过了量化，则必须使用不会增加颜色数量的缩放方法
-        if 设置['颜色数'] == 0:
-            滤镜 = 'point'
-        else:
-            滤镜 = 'lanczos'
-        重缩放(输入文件, 缩放文件, 设置['prescale'], 滤镜=滤镜)
-
-
-        if 设置['颜色数'] is not None: # 如果设置了颜色数量，就将原图缩减颜色
-            量化缩减图片颜色(缩放文件, 减色文件, 设置['颜色数'], 算法=设置['quantization'], 拟色=设置['拟色'])
-        elif 设置['remap'] is not None: # 如果设置了调色板图片，就将原图按调色板进行重映射
-            用调色板对图片重映射(缩放文件, 减色文件, 设置['remap'], 拟色=设置['拟色'])
-        else:
-            # argparse 应该已经抛出这个错误
-            raise Exception("至少应该设置 'colors' 、 'remap' 中最少一个参数")
-        if 设置['颜色数'] == 1:
-            颜色表 = ['#000000']
+        if 已量化 is not None:
+            缩放, 颜色数 = 已量化
         else:
-            颜色表 = 制作颜色表(减色文件)
+            缩放, 颜色数 = 缩放并选择颜色数(设置, 输入文件, 缩放文件)
+
+        颜色表 = None
+        索引图 = None
+        # 使用 队列1_批量任务 时，减色文件已经生成
+        if 已量化 is None:
+            with 计时('quantize'):
+                透明 = None
+                if 设置['alpha'] and 颜色数 is not None and 2 <= 颜色数 <= 设置['max_layers']:
+                    透明 = 透明像素(缩放文件)
+                if 透明 is not None and not 透明.all():
+                    # 只由不透明的像素量化出调色板，透明像素不占用调色板中的颜色，再把整个图像重映射到它
+                    with Image.open(缩放文件) as 图像:
+                        不透明像素 = np.asarray(图像.convert('RGB'))[~透明]
+                    调色板文件 = 由样本制作调色板([不透明像素], 设置['临时文件'], 颜色数,
+                                       设置['quantization'], 前缀=findex)
+                    if 设置['拟色'] is None:
+                        索引图, 颜色表 = 在进程内重映射为索引图(缩放文件, 读取调色板(调色板文件))
+                    else:
+                        用调色板对图片重映射(缩放文件, 减色文件, 调色板文件, 拟色=设置['拟色'])
+                    删除文件(调色板文件)
+                elif 颜色数 is not None: # 如果设置了颜色数量，就将原图缩减颜色
+                    量化缩减图片颜色(缩放文件, 减色文件, 颜色数, 算法=设置['quantization'], 拟色=设置['拟色'])
+                elif 设置['remap'] is not None: # 如果设置了调色板图片，就将原图按调色板进行重映射
+                    if 设置['拟色'] is None:
+                        # 不拟色时在进程内重映射，直接得到索引图和用到的颜色
+                        索引图, 颜色表 = 在进程内重映射为索引图(缩放文件, 设置['调色板'], 设置['重映射查找表'])
+                    else:
+                        用调色板对图片重映射(缩放文件, 减色文件, 设置['remap'], 拟色=设置['拟色'])
+                else:
+                    # argparse 应该已经抛出这个错误
+                    raise Exception("至少应该设置 'colors' 、 'remap' 中最少一个参数")
+
+        with 计时('index'):
+            # 只解码一次已缩减颜色的图像，把索引图保存为原始数据，队列二的任务直接映射它
+            if 颜色数 == 1:
+                颜色表 = ['#000000']
+                索引图 = 解码索引图(减色文件, 颜色表)
+            elif 索引图 is None:
+                索引图, 颜色表 = 解码并制作颜色表(减色文件)
+
+        # 跳过量化或者使用固定的调色板时，图层数不受 -c 限制，一张照片就有几十万个颜色，每个颜色都会成为一个图层
+        最多图层数 = 设置['max_layers']
+        if len(颜色表) > 最多图层数:
+            if 设置['max_layers_action'] == 'refuse':
+                删除文件(缩放文件, 减色文件)
+                # 这个文件不会再有队列二的任务
+                总数.value -= 设置['估计颜色数']
+                raise 图层过多('{0} 的颜色多于 {1} 个，超过了图层数上限，已跳过'.format(输入文件, 最多图层数))
+            if 颜色数 is not None:
+                汇报('{0} 的颜色多于 {1} 个，超过了图层数上限，自动量化到 {2} 个颜色'.format(
+                    输入文件, 最多图层数, min(最多图层数, 256)), level=0)
+                with 计时('quantize'):
+                    量化缩减图片颜色(缩放文件, 减色文件, min(最多图层数, 256),
+                             算法=设置['quantization'], 拟色=设置['拟色'])
+                with 计时('index'):
+                    索引图, 颜色表 = 解码并制作颜色表(减色文件)
+            else:
+                # 固定的调色板 (-r、-g) 不重新量化，输出仍然只用调色板中的颜色
+                汇报('{0} 用到了调色板中的 {1} 个颜色，超过了图层数上限，只保留最常用的 {2} 个'.format(
+                    输入文件, len(颜色表), 最多图层数), level=0)
+                with 计时('index'):
+                    索引图, 颜色表 = 保留常用颜色(索引图, 颜色表, 最多图层数)
+        删除文件(减色文件)
+
+        with 计时('index'):
+            if 设置['alpha']:
+                索引图, 颜色表 = 去除透明像素(索引图, 颜色表, 缩放文件)
+            if 设置['merge_speckles']:
+                # 在切分图层前合并小斑点，斑点消失后不再用到的颜色也不必描摹
+                索引图, 颜色表 = 去除未用颜色(合并小区域(索引图, 设置['merge_speckles']), 颜色表)
+            索引图.tofile(索引图文件)
+            索引图形状 = 索引图.shape
+            del 索引图
 
         # 基于调色板中颜色的数量更新总数
-        if 设置['颜色数'] is not None:
-            总数.value -= 设置['颜色数'] - len(颜色表)
-        else:
-            总数.value -= 设置['调色板颜色数'] - len(颜色表)
+        总数.value -= 设置['估计颜色数'] - len(颜色表)
         # 初始化输入索引所指文件的图层
         图层[findex] += [False] * len(颜色表)
 
@@ -505,18 +1861,23 @@ def 队列1_任务(队列2, 总数, 图层, 设置, findex, 输入文件, output
         分辨率 = 设置['resolution']
 
 
-        # 添加任务到第二个任务队列
-        for i, 颜色 in enumerate(颜色表):
+        # 添加任务到第二个任务队列，每个颜色一个任务；批量描摹时整个文件一个任务
+        if 设置['batch_potrace']:
+            分组 = [list(range(len(颜色表)))]
+        else:
+            分组 = [[i] for i in range(len(颜色表))]
+        for 颜色索引列表 in 分组:
             队列2.put(
                 {'宽度': 宽度,
                  '高度': 高度,
                  '分辨率': 分辨率,
-                 '颜色': 颜色,
                  '调色板': 颜色表,
-                 '已缩减图像': 减色文件,
+                 '索引图文件': 索引图文件,
+                 '索引图形状': 索引图形状,
                  '输出路径': output,
                  '文件索引': findex,
-                 '颜色索引': i})
+                 '颜色索引列表': 颜色索引列表,
+                 '缩放': 缩放 if 设置['prescale'] == 'auto' else None})
 
     except (Exception, KeyboardInterrupt) as e:
         # 发生错误时删除临时文件
@@ -527,76 +1888,178 @@ def 队列1_任务(队列2, 总数, 图层, 设置, findex, 输入文件, output
         删除文件(缩放文件)
 
 
-def 队列2_任务(图层, 图层锁, 设置, 宽度, 高度, 分辨率, 颜色, 调色板, 文件索引, 颜色索引, 已缩减图像, 输出路径):
+def 队列1_批量任务(队列2, 总数, 图层, 设置, 文件列表):
+    """ 处理一组小图像的队列一任务：分别缩放后，颜色数相同的图像只运行一次 pngquant
+
+    小图像量化得很快，大部分时间花在启动 pngquant 上，合批后每组只启动一次
+    文件列表: [{'findex': ..., '输入文件': ..., 'output': ...}, ...]，只用于 'mc' 量化
+    其余参数同 队列1_任务
+"""
+    已量化列表 = []
+    分组 = {}  # 颜色数 -> [(缩放文件, 减色文件), ...]
+    for 文件 in 文件列表:
+        缩放文件, 减色文件, _ = 队列1临时文件(设置, 文件['findex'])
+        缩放, 颜色数 = 缩放并选择颜色数(设置, 文件['输入文件'], 缩放文件)
+        已量化列表.append((缩放, 颜色数))
+        分组.setdefault(颜色数, []).append((缩放文件, 减色文件))
+
+    for 颜色数, 文件对 in 分组.items():
+        with 计时('quantize'):
+            if len(文件对) == 1 or 颜色数 in (0, 1):
+                for 缩放文件, 减色文件 in 文件对:
+                    量化缩减图片颜色(缩放文件, 减色文件, 颜色数, 拟色=设置['拟色'])
+            else:
+                批量量化(*zip(*文件对), 颜色数, 拟色=设置['拟色'])
+
+    for 文件, 已量化 in zip(文件列表, 已量化列表):
+        try:
+            队列1_任务(队列2, 总数, 图层, 设置, 已量化=已量化, **文件)
+        except 图层过多 as e:
+            汇报(e, level=0)
+
+
+def 变体输出路径(输出路径, 名称):
+    """返回变体的输出路径：在输出文件名后面加上 -名称；名称为 None 时就是输出路径"""
+    if 名称 is None:
+        return 输出路径
+    根, 扩展名 = os.path.splitext(输出路径)
+    return f'{根}-{名称}{扩展名}'
+
+
+def 保存svg(设置, 临摹图层, 输出, **参数):
+    """用 svg_stack.composite_layers 叠加临摹图层并保存到输出，参数同 composite_layers
+
+    使用 output_archive 时，在内存中叠加，把 (成员名称, svg) 交给 设置['输出归档']
+"""
+    if 设置['输出归档'] is None:
+        svg_stack.composite_layers(临摹图层, 输出, **参数)
+        return
+    缓冲 = io.BytesIO()
+    svg_stack.composite_layers(临摹图层, 缓冲, **参数)
+    设置['输出归档'].put((归档成员名(输出), 缓冲.getvalue()))
+
+
+def 队列2_任务(图层, 图层锁, 设置, 宽度, 高度, 分辨率, 调色板, 文件索引, 颜色索引列表, 索引图文件, 索引图形状,
+           输出路径, 缩放=None):
     """ 分离颜色并描摹
 
     图层: 一个有序列表，包含了 svg 文件的临摹图层
     图层锁: 读取和写入图层对象时必须获取的锁
     设置: 一个字典，必须有以下键值:
-        stack, despeckle, smoothcorners, optimizepaths, tmp
+        stack, despeckle, smoothcorners, optimizepaths, tmp, 变体
         See color_trace_multi for details of the values
     宽度: 输入图像的宽度
-    颜色: 要孤立的颜色
+    调色板: 这个文件的颜色表
     文件索引: 输入文件的整数索引
-    颜色索引: 颜色的整数索引
-    已缩减图像: 已经缩减颜色的输入图像
+    颜色索引列表: 这个任务要描摹的颜色的整数索引。通常只有一个，使用 batch_potrace 时
+        是文件的所有颜色，它们的位图由同一个 potrace 进程描摹
+    索引图文件: 队列一保存的原始索引图，每个像素是它的颜色在调色板中的索引
+    索引图形状: 索引图的 (高, 宽)
     输出路径: 输出路径，svg 文件
+    缩放: 自动选择的放大倍数，会记录在输出的元数据中；None 表示不记录
+
+    有多个变体时，孤立出的位图在 stack、background 相同的变体间共用，每个变体各描摹一次。
+    使用 crop_layers 时，每个位图只包含颜色的外接矩形，图层中记录的是各变体中的这个矩形，
+    组装时再把描摹结果移回原来的位置
 """
+    变体列表 = 设置['变体'] or [(None, {})]
     # 临时文件放在每个输出文件的旁边
-    该文件孤立颜色图像 = os.path.abspath(os.path.join(设置['临时文件'], '{0}-{1}~isolated.png'.format(文件索引, 颜色索引)))
-    该文件图层 = os.path.abspath(os.path.join(设置['临时文件'], '{0}-{1}~layer.ppm'.format(文件索引, 颜色索引)))
-    描摹格式 = '{0}-{1}~trace.svg'
-    描摹文件 = os.path.abspath(os.path.join(设置['临时文件'], 描摹格式.format(文件索引, 颜色索引)))
+    描摹格式 = '{0}-{1}-{2}~trace.svg'
+    孤立图层 = {}  # (颜色索引, stack, 是否填充背景) -> (孤立出的位图, 裁剪区域)
+    区域 = {颜色索引: [] for 颜色索引 in 颜色索引列表}
+    临时文件列表 = []
+    描摹文件列表 = []
+    if 设置['crop_layers']:
+        # 裁剪后的位图大小各不相同，改用和整个图像的宽度、高度等效的分辨率
+        宽度, 高度, 分辨率 = None, None, 描摹分辨率(宽度, 高度, 索引图形状[1], 索引图形状[0])
 
     try:
-        # 如果颜色索引是 0 并且 -bg 选项被激活
-        # 直接用匹配的颜色填充图像，否则使用孤立颜色
-        if 颜色索引 == 0 and 设置['background']:
-            汇报("Index {}".format(颜色))
-            使用颜色填充(已缩减图像, 该文件图层)
-        else:
-            孤立颜色(已缩减图像, 该文件孤立颜色图像, 该文件图层, 颜色, 调色板, stack=设置['stack'])
-        # 描摹这个颜色，添加到 svg 栈
-        描摹(该文件图层, 描摹文件, 颜色, 设置['despeckle'], 设置['smoothcorners'], 设置['optimizepaths'], 宽度, 高度, 分辨率)
+        索引图 = 映射索引图(索引图文件, 索引图形状, len(调色板))
+        for 变体序号, (名称, 参数) in enumerate(变体列表):
+            变体设置 = dict(设置, **参数)
+            位图列表 = []
+            for 颜色索引 in 颜色索引列表:
+                # 如果颜色索引是 0 并且 -bg 选项被激活
+                # 直接用匹配的颜色填充图像，否则使用孤立颜色
+                填充背景 = 颜色索引 == 0 and 变体设置['background']
+                键 = (颜色索引, 变体设置['stack'], 填充背景)
+                if 键 not in 孤立图层:
+                    该文件图层 = os.path.abspath(os.path.join(
+                        设置['临时文件'], '{0}-{1}-{2}~layer.pbm'.format(文件索引, 颜色索引, len(孤立图层))))
+                    临时文件列表.append(该文件图层)
+                    if 填充背景:
+                        汇报("Index {}".format(调色板[颜色索引]))
+                    with 计时('isolate'):
+                        遮挡 = None
+                        if 设置['cull_hidden']:
+                            # 背景层也是第一层，之后的图层同样从颜色 1 开始
+                            遮挡 = 上层遮挡(索引图, 颜色索引, len(调色板), stack=变体设置['stack'])
+                        if 填充背景 and 设置['alpha']:
+                            # 背景只填满不透明的区域，也就是堆栈描摹的第一层
+                            裁剪区域 = 孤立颜色(索引图, 该文件图层, 0, len(调色板), stack=True,
+                                            裁剪=设置['crop_layers'], 遮挡=遮挡)
+                        else:
+                            裁剪区域 = 孤立颜色(索引图, 该文件图层, None if 填充背景 else 颜色索引,
+                                            len(调色板), stack=变体设置['stack'],
+                                            裁剪=设置['crop_layers'], 遮挡=遮挡)
+                    孤立图层[键] = (该文件图层, 裁剪区域)
+                位图列表.append(孤立图层[键][0])
+                区域[颜色索引].append(孤立图层[键][1])
+            # 描摹这些颜色，添加到 svg 栈
+            目标列表 = [os.path.abspath(os.path.join(设置['临时文件'], 描摹格式.format(文件索引, 颜色索引, 变体序号)))
+                    for 颜色索引 in 颜色索引列表]
+            描摹文件列表 += 目标列表
+            描摹参数 = (变体设置['despeckle'], 变体设置['smoothcorners'], 变体设置['optimizepaths'], 宽度, 高度, 分辨率)
+            with 计时('trace'):
+                if len(颜色索引列表) > 1:
+                    批量描摹(位图列表, 目标列表, [调色板[i] for i in 颜色索引列表], *描摹参数)
+                else:
+                    描摹(位图列表[0], 目标列表[0], 调色板[颜色索引列表[0]], *描摹参数)
     except (Exception, KeyboardInterrupt) as e:
         # 若出错，则先删掉临时文件
-        删除文件(已缩减图像, 该文件孤立颜色图像, 该文件图层, 描摹文件)
+        索引图 = None  # 先解除映射，Windows 上才能删除文件
+        删除文件(索引图文件, *临时文件列表, *描摹文件列表)
         raise e
     else:
+        索引图 = None
         # 完成任务后删除临时文件
-        删除文件(该文件孤立颜色图像, 该文件图层)
+        删除文件(*临时文件列表)
 
     图层锁.acquire()
     try:
-        # 添加图层
-        图层[文件索引][颜色索引] = True
+        # 添加图层，裁剪时记下各变体的裁剪区域，组装时使用
+        for 颜色索引 in 颜色索引列表:
+            图层[文件索引][颜色索引] = tuple(区域[颜色索引]) if 设置['crop_layers'] else True
 
         # 检查这个文件所有的图层是否都被临摹了
-        是最后一个 = False not in 图层[文件索引]
+        已描摹图层 = list(图层[文件索引])
+        是最后一个 = False not in 已描摹图层
     finally:
         图层锁.release()
 
     # 如果已经就绪，则保存 svg 文档
     if 是最后一个:
-        # 开始 svg 堆栈
-        布局 = svg_stack.CBoxLayout()
-
-        临摹图层 = [os.path.abspath(os.path.join(设置['临时文件'], 描摹格式.format(文件索引, l))) for l in range(len(图层[文件索引]))]
-
-        # 添加图层到 svg
-        for t in 临摹图层:
-            布局.addSVG(t)
-
-        # 保存堆栈好的 svg 输出
-        文档 = svg_stack.Document()
-        文档.setLayout(布局)
-        with open(输出路径, 'w') as 文件:
-            文档.save(文件)
-
-        删除文件(已缩减图像, *临摹图层)
-
-
-def 进程处理(第一个任务队列, 第二个任务队列, 已完成任务数, 任务总数, 图层, 图层锁, 设置):
+        元数据 = 描摹元数据(缩放) if 缩放 is not None else None
+        for 变体序号, (名称, _) in enumerate(变体列表):
+            临摹图层 = [os.path.abspath(os.path.join(设置['临时文件'], 描摹格式.format(文件索引, l, 变体序号)))
+                    for l in range(len(已描摹图层))]
+
+            # 直接按顺序叠加各图层，保存堆栈好的 svg 输出；裁剪过的图层先移回原来的位置
+            with 计时('assemble'):
+                if 设置['crop_layers']:
+                    保存svg(设置, 临摹图层, 变体输出路径(输出路径, 名称), metadata=元数据,
+                          boxes=[区域列表[变体序号] for 区域列表 in 已描摹图层],
+                          canvas=(索引图形状[1], 索引图形状[0]))
+                else:
+                    保存svg(设置, 临摹图层, 变体输出路径(输出路径, 名称), metadata=元数据)
+            删除文件(*临摹图层)
+
+        删除文件(索引图文件)
+        if _运行指标 is not None:
+            _运行指标.完成文件()
+
+
+def 进程处理(第一个任务队列, 第二个任务队列, 已完成任务数, 任务总数, 图层, 图层锁, 设置, 指标=None, 停止=None):
     """ 处理 process 任务的函数
 
     q1: 第一个任务队列 (缩放 + 颜色缩减)
@@ -610,7 +2073,11 @@ def 进程处理(第一个任务队列, 第二个任务队列, 已完成任务
         quantization, dither, remap, stack, prescale, despeckle, smoothcorners,
         optimizepaths, colors, tmp
         See color_trace_multi for details of the values
+    指标: 共享的 运行指标，None 表示不记录
+    停止: 可选的 multiprocessing.Event，主进程还会继续放入任务时不设置，工作进程在队列空了之后也不退出
 """
+    global _运行指标
+    _运行指标 = 指标
     while True:
         # 在第一个任务队列之前，从第二个人队列取一个工作，以节省临时文件和内存
         while not 第二个任务队列.empty():
@@ -618,7 +2085,7 @@ def 进程处理(第一个任务队列, 第二个任务队列, 已完成任务
                 工作参数 = 第二个任务队列.get(block=False)
                 队列2_任务(图层, 图层锁, 设置, **工作参数)
                 第二个任务队列.task_done()
-                已完成任务数.value += 1
+                已完成任务数.value += len(工作参数['颜色索引列表'])
             except queue.Empty:
                 break
 
@@ -626,24 +2093,236 @@ def 进程处理(第一个任务队列, 第二个任务队列, 已完成任务
         try:
             工作参数 = 第一个任务队列.get(block=False)
 
-            队列1_任务(第二个任务队列, 任务总数, 图层, 设置, **工作参数)
+            if '文件列表' in 工作参数:
+                队列1_批量任务(第二个任务队列, 任务总数, 图层, 设置, **工作参数)
+            else:
+                try:
+                    队列1_任务(第二个任务队列, 任务总数, 图层, 设置, **工作参数)
+                except 图层过多 as e:
+                    汇报(e, level=0)
             第一个任务队列.task_done()
         except queue.Empty:
             time.sleep(.01)
 
-        if 第二个任务队列.empty() and 第一个任务队列.empty():
+        # 刚放入队列的任务可能还在后台线程中，empty() 看不到，所以不能只看两个队列是否为空。
+        # 所有文件的队列一任务完成后，任务总数就是准确的
+        if (第一个任务队列.empty() and 已完成任务数.value >= 任务总数.value
+                and (停止 is None or 停止.is_set())):
             break
 
 
+_调色板缓存 = {}
+_调色板缓存锁 = threading.Lock()  # 描摹服务的各请求线程会同时解码调色板
+
+
+def 估计像素总数(输入列表, 缩放=1, 像素预算=4.0, 上限=None, 含所有帧=False):
+    """只读取图像头，估计输入缩放后的像素总数
+
+    缩放为 'auto' 时，按像素预算允许的最大倍数估计
+    上限: 若指定，总数达到它就不再读取其余的输入
+    含所有帧: 动图的每一帧都计入
+"""
+    总数 = 0
+    for _, 源 in 逐个打开输入(输入列表):
+        with Image.open(源) as 图像:
+            宽, 高 = 图像.size
+            帧数 = getattr(图像, 'n_frames', 1) if 含所有帧 else 1
+        if 缩放 == 'auto':
+            像素数 = max(宽 * 高, min(宽 * 高 * 自动缩放最大倍数 ** 2, 像素预算 * 1e6))
+        else:
+            像素数 = 宽 * 高 * 缩放 ** 2
+        总数 += 像素数 * 帧数
+        if 上限 is not None and 总数 >= 上限:
+            break
+    return 总数
+
+
+def 解码调色板(remap, 临时文件夹, 拟色=None, 像素总数=None):
+    """解码调色板图像，不拟色且颜色不多时再制作重映射查找表，返回 (调色板, 查找表路径)
+
+    像素总数: 将要重映射的像素总数，不到 查找表最少像素数 时不制作查找表。
+        None 表示事先不知道，例如常驻的描摹服务，查找表会在各请求间复用
+    结果按调色板图像的路径和修改时间缓存，常驻的描摹服务对同一个调色板只解码一次
+"""
+    if not os.path.exists(remap):  # 确认下调色板图像存在
+        raise IOError("未找到重映射调色板：{0} ".format(remap))
+    键 = (os.path.abspath(remap), os.path.getmtime(remap), 临时文件夹, 拟色 is None)
+    with _调色板缓存锁:
+        if 键 not in _调色板缓存:
+            调色板 = 读取调色板(remap)
+            # 颜色不多时，预先计算重映射查找表，供所有进程只读共享
+            if (拟色 is None and len(调色板) <= 查找表最多颜色数
+                    and (像素总数 is None or 像素总数 >= 查找表最少像素数)):
+                # 每个查找表用唯一的文件名，先写入临时文件，写完再换到最终的路径，
+                # 工作进程不会映射到写了一半的查找表
+                描述符, 查找表路径 = tempfile.mkstemp(suffix='.lut', prefix='remap', dir=临时文件夹)
+                os.close(描述符)
+                正在写入 = 查找表路径 + '~partial'
+                制作重映射查找表(调色板, 正在写入)
+                os.replace(正在写入, 查找表路径)
+            else:
+                查找表路径 = None
+            _调色板缓存[键] = (调色板, 查找表路径)
+        return _调色板缓存[键]
+
+
+def 生成设置(临时文件, 颜色数, quantization='mc', 拟色=None, remap=None, stack=False,
+         prescale=1, despeckle=2, smoothcorners=1.0, optimizepaths=0.2, background=False,
+         width=None, height=None, resolution=None, pixel_budget=4.0, variants=None,
+         merge_speckles=0, batch_potrace=False, max_layers=256, max_layers_action='quantize',
+         alpha=False, crop_layers=False, cull_hidden=False, 像素总数=None):
+    """生成两个任务队列共用的设置字典，参数同 彩色描摹
+
+    临时文件: 存放临时文件的文件夹
+    使用 remap 时，在这里解码一次调色板，各进程通过设置共享
+    像素总数: 传给 解码调色板，决定是否制作重映射查找表
+"""
+    设置 = {'临时文件': 临时文件, '颜色数': 颜色数, 'quantization': quantization,
+          '拟色': 拟色, 'remap': remap, 'stack': stack, 'prescale': prescale,
+          'despeckle': despeckle, 'smoothcorners': smoothcorners,
+          'optimizepaths': optimizepaths, 'background': background,
+          'width': width, 'height': height, 'resolution': resolution,
+          'pixel_budget': pixel_budget, 'merge_speckles': merge_speckles,
+          'batch_potrace': batch_potrace,
+          'max_layers': max_layers, 'max_layers_action': max_layers_action, 'alpha': alpha,
+          'crop_layers': crop_layers, 'cull_hidden': cull_hidden,
+          # 使用 output_archive 时由 彩色描摹 设为 归档写入器 或者交给它的队列，svg 不写到磁盘
+          '输出归档': None,
+          # 有变体时，第一个总是命令行参数本身，输出到原来的路径
+          '变体': [(None, {})] + list(variants) if variants else None}
+    if 颜色数 is None:
+        if remap is None:
+            # argparse 应当已经提前捕获这个错误
+            raise Exception("应当提供 'colors' 和 'remap' 至少一个参数")
+        设置['调色板'], 设置['重映射查找表'] = 解码调色板(remap, 临时文件, 拟色, 像素总数)
+        设置['估计颜色数'] = len(设置['调色板'])
+    elif 颜色数 == 'auto':
+        设置['估计颜色数'] = 自动最多颜色数
+    else:
+        设置['估计颜色数'] = 颜色数
+    return 设置
+
+
+def 描摹单个文件(设置, 输入文件, 输出, 进度=None, 线程数=1):
+    """不使用进程池和管理器，在当前进程内完成一个文件的两个队列的任务
+
+    进度: 可选，有 已完成 和 总数 两个属性，总数.value 是估计的图层总数
+    线程数: 同时运行队列二任务的线程数。potrace 是外部程序，各图层可以在线程中并行描摹
+"""
+    if 进度 is None:
+        进度 = types.SimpleNamespace(已完成=0, 总数=types.SimpleNamespace(value=0))
+    第二个任务队列 = queue.Queue()
+    图层 = [[]]
+    图层锁 = threading.Lock()
+    队列1_任务(第二个任务队列, 进度.总数, 图层, 设置, 0, 输入文件, 输出)
+    工作参数列表 = []
+    while not 第二个任务队列.empty():
+        工作参数列表.append(第二个任务队列.get())
+    if 线程数 <= 1 or len(工作参数列表) <= 1:
+        for 工作参数 in 工作参数列表:
+            队列2_任务(图层, 图层锁, 设置, **工作参数)
+            进度.已完成 += len(工作参数['颜色索引列表'])
+        return
+    with futures.ThreadPoolExecutor(线程数, thread_name_prefix='color_trace') as 执行器:
+        未来列表 = {执行器.submit(functools.partial(队列2_任务, 图层, 图层锁, 设置, **工作参数)):
+                len(工作参数['颜色索引列表']) for 工作参数 in 工作参数列表}
+        for 未来 in futures.as_completed(未来列表):
+            未来.result()
+            进度.已完成 += 未来列表[未来]
+            sys.stdout.write("\r%.1f%%" % (进度.已完成 / 进度.总数.value * 100))
+            sys.stdout.flush()
+
+
+async def 异步描摹文件(设置, 执行器, 文件名额, 进度, 图层, 图层锁, findex, 输入文件, output):
+    """在事件循环中完成一个文件：先运行队列一的任务，再并发运行它产生的所有队列二的任务
+
+    Python 部分在线程池中运行，外部程序由事件循环启动
+"""
+    循环 = asyncio.get_running_loop()
+    async with 文件名额:
+        进度.等待文件 -= 1
+        第二个任务队列 = queue.Queue()
+        try:
+            await 循环.run_in_executor(执行器, 队列1_任务, 第二个任务队列, 进度.总数,
+                                   图层, 设置, findex, 输入文件, output)
+        except 图层过多 as e:
+            汇报(e, level=0)
+            return
+        工作参数列表 = []
+        while not 第二个任务队列.empty():
+            工作参数列表.append(第二个任务队列.get())
+        进度.等待任务 += len(工作参数列表)
+
+        async def 运行任务(工作参数):
+            await 循环.run_in_executor(执行器, functools.partial(队列2_任务, 图层, 图层锁, 设置, **工作参数))
+            进度.已完成 += len(工作参数['颜色索引列表'])
+            进度.等待任务 -= 1
+            sys.stdout.write("\r%.1f%%" % (进度.已完成 / 进度.总数.value * 100))
+            sys.stdout.flush()
+
+        await asyncio.gather(*map(运行任务, 工作参数列表))
+
+
+async def 异步彩色描摹(设置, 输入列表, 输出列表, 进程数, 进度):
+    """用一个事件循环描摹所有输入，最多同时运行 进程数 个外部程序
+
+    进度: 有 已完成、总数、等待文件、等待任务 属性，由各个文件的协程更新
+"""
+    global _事件循环, _外部程序名额
+    _事件循环 = asyncio.get_running_loop()
+    _外部程序名额 = asyncio.Semaphore(进程数)
+    # 同时处理的文件数有限，以免所有文件的临时图像同时存在
+    文件名额 = asyncio.Semaphore(进程数 * 2)
+    执行器 = futures.ThreadPoolExecutor(进程数 * 2, thread_name_prefix='color_trace')
+    图层 = [[] for _ in 输入列表]
+    图层锁 = threading.Lock()
+    try:
+        await asyncio.gather(*(
+            异步描摹文件(设置, 执行器, 文件名额, 进度, 图层, 图层锁, 索引, 输入, 输出)
+            for 索引, (输入, 输出) in enumerate(zip(输入列表, 输出列表))))
+    finally:
+        _事件循环 = None
+        执行器.shutdown()
+
+
+def 合批小图(任务列表, 设置, 进程数):
+    """使用 'mc' 量化时，把小输入的队列一任务合为几批，每批由 队列1_批量任务 处理
+
+    每批的大小使各个进程分到的批数大致相同，返回新的任务列表
+"""
+    if 设置['quantization'] != 'mc' or 设置['颜色数'] in (None, 0, 1) or 设置['alpha']:
+        # 使用 --alpha 时，有透明像素的图像只由不透明的像素量化，不能和其他图像一起量化
+        return 任务列表
+
+    def 是小图(任务):
+        try:
+            return 输入大小(任务['输入文件']) <= 小图最大字节
+        except (OSError, KeyError):  # 不存在的输入留给队列一的任务报错
+            return False
+
+    小图 = [任务 for 任务 in 任务列表 if 是小图(任务)]
+    每批数量 = min(合批量化最大数量, -(-len(小图) // 进程数))
+    if 每批数量 < 2:
+        return 任务列表
+    小图索引 = {任务['findex'] for 任务 in 小图}
+    return ([{'文件列表': 小图[i:i + 每批数量]} for i in range(0, len(小图), 每批数量)]
+            + [任务 for 任务 in 任务列表 if 任务['findex'] not in 小图索引])
+
+
 def 彩色描摹(输入列表, 输出列表, 颜色数, 进程数, quantization='mc', 拟色=None,
          remap=None, stack=False, prescale=2, despeckle=2, smoothcorners=1.0,
          optimizepaths=0.2, background=False,
-         width=None, height=None, resolution=None):
+         width=None, height=None, resolution=None,
+         global_palette=False, sample_files=None, use_asyncio=False, pixel_budget=4.0,
+         variants=None, merge_speckles=0, batch_potrace=False, max_layers=256,
+         max_layers_action='quantize', alpha=False, crop_layers=False, cull_hidden=False,
+         output_archive=None, sprite=None, metrics_file=None, metrics_port=None,
+         claim_dir=None, lease=600):
     """用指定选项彩色描摹输入图片
 
     输入列表: 输入文件列表，源 png 文件
     输出列表: 输出文件列表，目标 svg 文件
-    颜色数: 要亮化缩减到的颜色质量，0 表示不量化
+    颜色数: 要亮化缩减到的颜色质量，0 表示不量化，'auto' 表示为每个输入自动选择
     进程数: 图像处理进程数
     quantization: 要使用的量化算法:
         - 'mc' = median-cut 中切 (默认值, 只有少量颜色, 使用 pngquant)
@@ -661,9 +2340,111 @@ def 彩色描摹(输入列表, 输出列表, 颜色数, 进程数, quantization=
     optimizepaths: 贝塞尔曲线优化: 0 最小, 5 最大
         (等同于 potrace --opttolerance)
     background：设置第一个颜色为整个 svg 背景，以减小 svg 体积
+    prescale: 描摹前先放大的倍数，'auto' 表示根据每个图像的大小和细节自动选择
+    pixel_budget: prescale 为 'auto' 时，放大后最多的像素数，单位是百万像素
+    variants: [(名称, 参数字典), ...]，每个变体用自己的参数覆盖
+        stack、background、despeckle、smoothcorners、optimizepaths，输出到 输出-名称.svg。
+        所有变体共用缩放、量化和孤立颜色的结果，只分别描摹
+    merge_speckles: 切分图层前，把面积小于这么多像素的同色连通区域并入周围的颜色，0 表示不合并
+    batch_potrace: 每个图像的所有图层由一个 potrace 进程描摹，而不是每个颜色启动一个，
+        适合图层很小、启动进程的开销占了大部分时间的情况
+    max_layers: 每个输入最多的图层数。颜色多于这个数的输入 (颜色数为 0，或者使用 remap、global_palette 时)
+        按 max_layers_action 处理：'quantize' 自动量化到这么多个颜色 (最多 256 个)，使用调色板时
+        只保留最常用的这么多个颜色；'refuse' 跳过这个输入
+    alpha: 完全透明的像素不属于任何图层，只出现在透明像素中的颜色也不描摹；
+        background 的背景层只填满不透明的区域
+    crop_layers: 每个图层只描摹颜色的外接矩形，组装时再移回原来的位置。
+        颜色只占图像一小部分时，描摹的位图小得多
+    cull_hidden: 描摹前去掉之后的图层会原样盖住的连通区域，在索引图上计算。
+        堆栈描摹时，较高的颜色在每个较低的图层中都有一份相同的路径，只保留最上面的一份
+    output_archive: 把输出写入这个 zip 或 tar 归档 (按扩展名，可以是 .tar.gz 等)，
+        输出列表中的路径是归档中的成员名称。工作进程只在内存中组装 svg，由主进程写入
+    sprite: 描摹完成后，再把所有输出 (包括变体) 合为一个 svg 精灵图保存到这个路径，
+        每个输出是一个 <symbol>，id 是它的文件名；多次出现的路径只存一次，见 保存精灵图
+    global_palette: 从所有输入中采样，量化出一个共享调色板，再把每个输入重映射到它，
+        使所有输出的图层颜色一致
+    sample_files: 使用 global_palette 时，只从这么多个输入中采样，None 表示全部
+    use_asyncio: 不启动工作进程，而是在一个进程中用事件循环并发调用外部程序，
+        此时 进程数 是同时运行的外部程序数
+    metrics_file: 定期把吞吐量、队列深度、各阶段耗时直方图和预计剩余时间写入这个文件，
+        以 .json 结尾时写入 json，否则写入 Prometheus 文本格式
+    metrics_port: [host:]port，在这个本地端口上提供同样的指标，见 指标汇报
+    claim_dir: 和其他主机通过这个共享文件夹认领输入，见 认领描摹。每次认领 进程数 个，
+        放入同一组工作进程的队列，临时文件夹和指标在整个运行期间共用
+    lease: claim_dir 中租约的有效期，单位是秒
 """
+    global _运行指标
 
     临时文件 = tempfile.mkdtemp()
+    数量 = min(len(输入列表), len(输出列表))
+
+    if global_palette and 颜色数 not in (None, 0, 1):
+        # 共享调色板做好后，就和 --remap 指定的调色板图像一样使用
+        remap = 制作共享调色板(输入列表, 临时文件, 颜色数, quantization, sample_files)
+        颜色数 = None
+
+    if remap is not None and 拟色 is None:
+        像素总数 = 估计像素总数(输入列表[:数量], prescale, pixel_budget, 上限=查找表最少像素数)
+    else:
+        像素总数 = None
+    设置 = 生成设置(临时文件, 颜色数, quantization=quantization, 拟色=拟色, remap=remap,
+               stack=stack, prescale=prescale, despeckle=despeckle,
+               smoothcorners=smoothcorners, optimizepaths=optimizepaths,
+               background=background, width=width, height=height, resolution=resolution,
+               pixel_budget=pixel_budget, variants=variants, merge_speckles=merge_speckles,
+               batch_potrace=batch_potrace, max_layers=max_layers,
+               max_layers_action=max_layers_action, alpha=alpha, crop_layers=crop_layers,
+               cull_hidden=cull_hidden, 像素总数=像素总数)
+
+    启用指标 = metrics_file is not None or metrics_port is not None
+    单进程 = use_asyncio or 数量 == 1
+    if 启用指标:
+        # 单进程时各线程直接记录到同一个对象，否则放在共享内存中由工作进程记录
+        _运行指标 = 运行指标(共享=not 单进程)
+    写入器 = 归档写入器(output_archive) if output_archive is not None else None
+
+    # 已经放入的文件数，认领输入时逐批增加
+    文件数 = 0
+
+    if 单进程:
+        设置['输出归档'] = 写入器
+        进度 = types.SimpleNamespace(已完成=0, 总数=types.SimpleNamespace(value=0), 等待文件=0, 等待任务=0)
+
+        def 描摹一批(索引列表):
+            nonlocal 文件数
+            文件数 += len(索引列表)
+            进度.总数.value += len(索引列表) * 设置['估计颜色数']
+            if use_asyncio:
+                进度.等待文件 += len(索引列表)
+                asyncio.run(异步彩色描摹(设置, [输入列表[i] for i in 索引列表],
+                                        [输出列表[i] for i in 索引列表], 进程数, 进度))
+                return
+            # 只有一个文件时，不必启动工作进程和管理器，直接在当前进程内完成，各图层由线程并行描摹
+            for i in 索引列表:
+                汇报(输入列表[i], ' -> ', 输出列表[i])
+                描摹单个文件(设置, 输入列表[i], 输出列表[i], 进度, max(进程数, 1))
+
+        if 启用指标:
+            汇报器 = 指标汇报(_运行指标, lambda: {
+                'files_total': 文件数, 'layers_done': 进度.已完成, 'layers_total': 进度.总数.value,
+                'queue_depth': {'q1': 进度.等待文件, 'q2': 进度.等待任务}},
+                metrics_file, metrics_port)
+        try:
+            if claim_dir is not None:
+                认领描摹(输入列表[:数量], claim_dir, lease, max(进程数, 1), 描摹一批)
+            else:
+                描摹一批(range(数量))
+            sys.stdout.write("\rTracing complete!\n")
+        finally:
+            if 启用指标:
+                汇报器.关闭()
+                _运行指标 = None
+            if 写入器 is not None:
+                写入器.关闭()
+            shutil.rmtree(临时文件)
+        if sprite is not None:
+            保存精灵图(输出列表[:数量], 设置['变体'], sprite)
+        return
 
     # 新建两个任务队列
     # 第一个任务队列 = 缩放和颜色缩减
@@ -678,78 +2459,473 @@ def 彩色描摹(输入列表, 输出列表, 颜色数, 进程数, quantization=
         图层.append(管理器.list())
     # 创建一个读取和修改图层的锁
     图层锁 = multiprocessing.Lock()
+    if 写入器 is not None:
+        # 工作进程把组装好的 svg 放入这个队列，只由主进程写入归档
+        设置['输出归档'] = 管理器.Queue()
 
 
     # 创建一个共享内存计数器，表示任务总数和已完成任务数
     已完成任务数 = multiprocessing.Value('i', 0)
-    if 颜色数 is not None:
-        # 这只是一个估计值，因为量化可能会生成更少的颜色
-        # 该值由第一个任务队列校正以收敛于实际总数
-        总任务数 = multiprocessing.Value('i', len(图层) * 颜色数)
-    elif remap is not None:
-        # 得到调色板图像的银色数量
-        调色板颜色数 = len(制作颜色表(remap))
-        # this is only an estimate because remapping can result in less colors
-        # than in the remap variable. This value is corrected by q1 tasks to converge
-        # on the real total.
-        # 这只是一个估计值，因为量化可能会生成更少的颜色
-        # 该值由第一个任务队列校正以收敛于实际总数
-        总任务数 = multiprocessing.Value('i', len(图层) * 调色板颜色数)
-    else:
-        # argparse 应当已经提前捕获这个错误
-        raise Exception("应当提供 'colors' 和 'remap' 至少一个参数")
+    # 这只是一个估计值，因为量化或重映射可能会生成更少的颜色
+    # 该值在放入文件时增加，由第一个任务队列校正以收敛于实际总数
+    总任务数 = multiprocessing.Value('i', 0)
+    # 不再放入新的任务后设置，工作进程才在队列空了之后退出
+    停止 = multiprocessing.Event()
 
     # 创建和开始进程
     进程列表 = []
     for i in range(进程数):
-
-        本地 = locals()
-        本地.pop('图层')
-        本地.pop('图层锁')
-        本地.pop('已完成任务数')
-        本地.pop('总任务数')
-        本地.pop('第一个任务队列')
-        本地.pop('第二个任务队列')
-        本地.pop('管理器')
-        本地['本地'] = None
-        本地['进程'] = None
-        本地['进程列表'] = None
-
-        进程 = multiprocessing.Process(target=进程处理, args=(第一个任务队列, 第二个任务队列, 已完成任务数, 总任务数, 图层, 图层锁, 本地))
+        进程 = multiprocessing.Process(target=进程处理, args=(第一个任务队列, 第二个任务队列, 已完成任务数, 总任务数, 图层, 图层锁, 设置, _运行指标, 停止))
         进程.name = "color_trace worker #" + str(i)
         进程.start()
         进程列表.append(进程)
 
-    try:
+    def 描摹一批(索引列表):
+        """把这些输入放入第一个任务队列，等到它们全部完成"""
+        nonlocal 文件数
+        文件数 += len(索引列表)
+        with 总任务数.get_lock():
+            总任务数.value += len(索引列表) * 设置['估计颜色数']
         # 对每个收入和相应的输出
-        for 索引, (输入, 输出) in enumerate(zip(输入列表, 输出列表)):
-            汇报(输入, ' -> ', 输出)
+        任务列表 = []
+        for 索引 in 索引列表:
+            汇报(输入列表[索引], ' -> ', 输出列表[索引])
+            任务列表.append({'输入文件': 输入列表[索引], 'output': 输出列表[索引], 'findex': 索引})
 
-            # add a job to the first job queue
-            第一个任务队列.put({'输入文件': 输入, 'output': 输出, 'findex': 索引})
+        # add jobs to the first job queue
+        for 工作参数 in 合批小图(任务列表, 设置, 进程数):
+            第一个任务队列.put(工作参数)
 
         # show progress until all jobs have been completed
         while 已完成任务数.value < 总任务数.value:
             sys.stdout.write("\r%.1f%%" % (已完成任务数.value / 总任务数.value * 100))
             sys.stdout.flush()
+            if 写入器 is not None:
+                写入器.取出(设置['输出归档'])
             time.sleep(0.25)
 
-        sys.stdout.write("\rTracing complete!\n")
-
         # join the queues just in case progress is wrong
         第一个任务队列.join()
         第二个任务队列.join()
+        if 写入器 is not None:
+            写入器.取出(设置['输出归档'])
+
+    汇报器 = None
+    try:
+        if 启用指标:
+            def 队列深度(队列):
+                try:
+                    return 队列.qsize()
+                except NotImplementedError:  # macOS 上没有实现 qsize
+                    return None
+
+            汇报器 = 指标汇报(_运行指标, lambda: {
+                'files_total': 文件数, 'layers_done': 已完成任务数.value, 'layers_total': 总任务数.value,
+                'queue_depth': {'q1': 队列深度(第一个任务队列), 'q2': 队列深度(第二个任务队列)}},
+                metrics_file, metrics_port)
+
+        if claim_dir is not None:
+            # 整个运行期间共用这组工作进程，每认领一批就放入第一个任务队列
+            认领描摹(输入列表[:数量], claim_dir, lease, max(进程数, 1), 描摹一批)
+        else:
+            描摹一批(range(数量))
+        停止.set()
+
+        sys.stdout.write("\rTracing complete!\n")
     except (Exception, KeyboardInterrupt) as e:
         # shut down subproesses
         for 进程 in 进程列表:
             进程.terminate()
         shutil.rmtree(临时文件)
         raise e
+    finally:
+        if 汇报器 is not None:
+            汇报器.关闭()
+        _运行指标 = None
+        if 写入器 is not None:
+            写入器.关闭()
 
     # close all processes
     for 进程 in 进程列表:
         进程.terminate()
     shutil.rmtree(临时文件)
+    if sprite is not None:
+        保存精灵图(输出列表[:数量], 设置['变体'], sprite)
+
+
+def 保存精灵图(输出列表, 变体列表, 路径):
+    """把描摹好的输出合为一个 svg 精灵图，见 svg_stack.composite_sprite
+
+    图标集中相同的路径 (共同的轮廓、-bg 的背景矩形等) 只在 <defs> 中存一次，各处用 <use> 引用。
+    每个输出的 <symbol> 的 id 是它不含扩展名的文件名，不合法的字符换成 _，重复时加上序号；
+    因为图层过多而跳过的输入没有输出，不包括在内
+"""
+    文件列表 = []
+    标识列表 = []
+    已用 = set()
+    for 输出 in 输出列表:
+        for 名称, _ in 变体列表 or [(None, {})]:
+            文件 = 变体输出路径(输出, 名称)
+            if not os.path.exists(文件):
+                continue
+            标识 = re.sub(r'[^\w.-]', '_', os.path.splitext(os.path.basename(文件))[0])
+            if not (标识[:1].isalpha() or 标识[:1] == '_'):
+                标识 = '_' + 标识
+            基本标识, 序号 = 标识, 1
+            while 标识 in 已用:
+                序号 += 1
+                标识 = f'{基本标识}-{序号}'
+            已用.add(标识)
+            文件列表.append(文件)
+            标识列表.append(标识)
+    目标文件夹 = os.path.dirname(os.path.abspath(路径))
+    os.makedirs(目标文件夹, exist_ok=True)
+    svg_stack.composite_sprite(文件列表, 标识列表, 路径)
+    汇报(f'精灵图 {路径} 包含 {len(文件列表)} 个图标')
+
+def 得到序列帧(输入列表, 输出列表, 缩放=1.0, 帧时长=100, 只取=None):
+    """依次解码输入中的所有帧，生成 (RGB 像素数组, 输出路径, 帧时长)
+
+    动图 (GIF、APNG 等) 的每一帧单独输出，输出文件名后面加上帧序号
+    缩放: 在描摹前，先把每一帧缩放这么多倍
+    帧时长: 输入没有记录帧时长时使用的时长，单位是毫秒
+    只取: 若指定，只解码序号 (所有输入的帧连续编号，从 0 开始) 在其中的帧
+"""
+    序号 = -1
+    for (_, 源), 输出 in zip(逐个打开输入(输入列表), 输出列表):
+        with Image.open(源) as 图像:
+            帧数 = getattr(图像, 'n_frames', 1)
+            for i in range(帧数):
+                序号 += 1
+                if 只取 is not None and 序号 not in 只取:
+                    continue
+                图像.seek(i)
+                帧 = 图像.convert('RGB')
+                if 缩放 != 1.0:
+                    帧 = 帧.resize((max(1, round(帧.width * 缩放)), max(1, round(帧.height * 缩放))),
+                                 Image.LANCZOS)
+                if 帧数 > 1:
+                    根, 扩展名 = os.path.splitext(输出)
+                    帧输出 = f'{根}-{i:04d}{扩展名}'
+                else:
+                    帧输出 = 输出
+                yield np.asarray(帧), 帧输出, 图像.info.get('duration') or 帧时长
+
+
+def 序列描摹(输入列表, 输出列表, 颜色数, 进程数, quantization='mc', remap=None,
+         stack=False, prescale=1, despeckle=2, smoothcorners=1.0, optimizepaths=0.2,
+         background=False, width=None, height=None, resolution=None,
+         sample_files=None, animate=None, frame_duration=100, pixel_budget=4.0,
+         merge_speckles=0):
+    """把输入当作一段动画的各帧，彩色描摹
+
+    所有帧共用一个调色板。每一帧的每个颜色图层都和之前的帧比较，位图完全相同的
+    图层直接复用之前的描摹结果，只有变化了的图层才运行 potrace。
+
+    输入列表: 输入文件列表，按帧的顺序排列，其中的动图会展开为多帧
+    输出列表: 输出文件列表，每一帧一个 svg 文件
+    颜色数: 共享调色板的颜色数，'auto' 表示自动选择，使用 remap 时为 None
+    sample_files: 只从均匀挑选的这么多帧中采样制作调色板
+    animate: 若指定，不再每帧输出，而是把所有帧保存为这一个 SMIL 动画 svg
+    frame_duration: 输入没有记录帧时长时，每帧的时长，单位是毫秒
+    其余参数同 彩色描摹。prescale 为 'auto' 时，由第一个输入选择倍数，所有帧共用
+"""
+    元数据 = None
+    if prescale == 'auto':
+        prescale = 自动缩放倍数(输入列表[0], pixel_budget)
+        元数据 = 描摹元数据(prescale)
+    临时文件 = tempfile.mkdtemp()
+    进程池 = multiprocessing.Pool(进程数)
+    try:
+        像素总数 = 估计像素总数(输入列表, prescale, 上限=查找表最少像素数, 含所有帧=True)
+        if remap is not None:
+            调色板, 重映射查找表 = 解码调色板(remap, 临时文件, 像素总数=像素总数)
+        else:
+            帧数 = 0
+            for _, 源 in 逐个打开输入(输入列表):
+                with Image.open(源) as 图像:
+                    帧数 += getattr(图像, 'n_frames', 1)
+            采样帧 = set(均匀挑选(帧数, sample_files or 序列采样帧数))
+            随机数 = np.random.default_rng(0)
+            样本列表 = []
+            选择列表 = []
+            for 帧, _, _ in 得到序列帧(输入列表, 输出列表, prescale, 只取=采样帧):
+                样本列表.append(采样像素(帧, 随机数))
+                if 颜色数 == 'auto':
+                    选择列表.append(自动颜色数(缩略图像素(Image.fromarray(帧))))
+            if 颜色数 == 'auto':
+                颜色数 = int(np.median(选择列表))
+                汇报(f'自动选择共享调色板的 {颜色数} 个颜色')
+            调色板, 重映射查找表 = 解码调色板(
+                由样本制作调色板(样本列表, 临时文件, 颜色数, quantization), 临时文件, 像素总数=像素总数)
+
+        已描摹 = {}  # (颜色, 宽度, (高, 宽), 位图哈希) -> 描摹文件
+        描摹结果 = []
+        帧列表 = []  # (输出路径, 帧时长, 描摹文件列表)
+        图层总数 = 0
+        for 帧, 输出, 时长 in 得到序列帧(输入列表, 输出列表, prescale, frame_duration):
+            索引图 = 用调色板数组重映射(帧, 调色板, 重映射查找表)
+            if merge_speckles:
+                索引图 = 合并小区域(索引图, merge_speckles)
+            高, 宽 = 索引图.shape
+            宽度 = width if width else f'{宽 / prescale:g}pt'
+            描摹文件列表 = []
+            for i, 颜色 in enumerate(调色板):
+                if i == 0 and background:
+                    掩码 = np.ones((高, 宽), dtype=bool)
+                elif stack:
+                    掩码 = 索引图 >= i
+                else:
+                    掩码 = 索引图 == i
+                if not 掩码.any():
+                    continue
+                图层总数 += 1
+                位图 = np.packbits(掩码, axis=1)
+                # 不同尺寸的位图打包后可能字节相同，例如 16x2 和 8x4，所以键中包括形状
+                键 = (颜色, 宽度, (高, 宽), hashlib.blake2b(位图.tobytes()).digest())
+                if 键 not in 已描摹:
+                    # 这个图层和之前所有帧的都不同，需要描摹
+                    序号 = len(已描摹)
+                    图层文件 = os.path.join(临时文件, f'{序号}~layer.pbm')
+                    描摹文件 = os.path.join(临时文件, f'{序号}~trace.svg')
+                    写入PBM(图层文件, 位图, 宽)
+                    描摹结果.append(进程池.apply_async(描摹, (
+                        图层文件, 描摹文件, 颜色, despeckle, smoothcorners, optimizepaths,
+                        宽度, height, resolution)))
+                    已描摹[键] = 描摹文件
+                描摹文件列表.append(已描摹[键])
+            帧列表.append((输出, 时长, 描摹文件列表))
+
+        汇报(f'共 {len(帧列表)} 帧、{图层总数} 个图层，其中 {图层总数 - len(已描摹)} 个复用了之前的描摹')
+        for i, 结果 in enumerate(描摹结果):
+            sys.stdout.write("\r%.1f%%" % (i / len(描摹结果) * 100))
+            sys.stdout.flush()
+            结果.get()
+
+        if animate is not None:
+            目标文件夹 = os.path.dirname(os.path.abspath(animate))
+            os.makedirs(目标文件夹, exist_ok=True)
+            svg_stack.composite_frames([文件列表 for _, _, 文件列表 in 帧列表], animate,
+                                       [时长 for _, 时长, _ in 帧列表], metadata=元数据)
+        else:
+            for 输出, _, 文件列表 in 帧列表:
+                os.makedirs(os.path.dirname(os.path.abspath(输出)), exist_ok=True)
+                svg_stack.composite_layers(文件列表, 输出, metadata=元数据)
+        sys.stdout.write("\rTracing complete!\n")
+    finally:
+        进程池.terminate()
+        shutil.rmtree(临时文件)
+
+
+
+def 处理请求批次(批次):
+    """在进程池的工作进程中，依次描摹一批上传的图像
+
+    批次: [(图像数据, 扩展名, 设置), ...]
+    返回 [(True, svg 数据) 或 (False, 错误信息), ...]，顺序与批次一致
+"""
+    结果 = []
+    for 数据, 扩展名, 设置 in 批次:
+        临时文件 = tempfile.mkdtemp()
+        try:
+            输入文件 = os.path.join(临时文件, 'upload' + 扩展名)
+            输出 = os.path.join(临时文件, 'upload.svg')
+            with open(输入文件, 'wb') as 文件:
+                文件.write(数据)
+            描摹单个文件(dict(设置, 临时文件=临时文件), 输入文件, 输出)
+            with open(输出, 'rb') as 文件:
+                结果.append((True, 文件.read()))
+        except Exception as e:
+            结果.append((False, str(e)))
+        finally:
+            shutil.rmtree(临时文件)
+    return 结果
+
+
+class 描摹服务:
+    """常驻的描摹服务，所有请求共用一个进程池和解码好的调色板
+
+    同时到达的小请求会合为几批再交给进程池，排队和处理中的请求数有上限
+"""
+    服务选项 = ('colors', 'quantization', 'floydsteinberg', 'riemersma', 'remap', 'stack',
+            'prescale', 'despeckle', 'smoothcorners', 'optimizepaths', 'background',
+            'width', 'height', 'pixel-budget', 'merge-speckles', 'batch-potrace', 'alpha',
+            'crop-layers', 'cull-hidden')
+
+    def __init__(self, 进程数, 队列上限=64, 调色板文件夹=None):
+        self.进程数 = 进程数
+        self.队列上限 = 队列上限
+        self.调色板文件夹 = 调色板文件夹
+        self.临时文件 = tempfile.mkdtemp()
+        self.进程池 = multiprocessing.Pool(进程数)
+        self.请求队列 = queue.Queue()
+        self.名额 = threading.BoundedSemaphore(队列上限)
+        self.待处理数 = 0
+        self.计数锁 = threading.Lock()
+        threading.Thread(target=self.分派, name='color_trace dispatcher', daemon=True).start()
+
+    def 解析选项(self, 查询):
+        """把查询字符串解析为设置字典，选项不合理时抛出 ValueError"""
+        参数列表 = ['-i', 'upload']
+        for 键, 值 in urllib.parse.parse_qsl(查询, keep_blank_values=True):
+            if 键 not in self.服务选项:
+                raise ValueError("不支持的选项：{0}".format(键))
+            参数列表.append('--' + 键)
+            if 值 != '':
+                参数列表.append(值)
+
+        def 参数错误(消息):
+            raise ValueError(消息)
+        解析器 = 创建参数解析器()
+        解析器.error = 参数错误
+        参数 = 解析器.parse_args(参数列表)
+        if 参数.colors is None and 参数.remap is None:
+            raise ValueError("one of the arguments colors remap is required")
+        if 参数.cull_hidden and not 参数.stack:
+            raise ValueError("cull-hidden requires stack")
+
+        remap = None
+        if 参数.remap is not None:
+            if self.调色板文件夹 is None:
+                raise ValueError("服务启动时没有指定 --palette-dir，不能使用 remap")
+            remap = os.path.join(self.调色板文件夹, os.path.basename(参数.remap))
+        拟色 = 'floydsteinberg' if 参数.floydsteinberg else ('riemersma' if 参数.riemersma else None)
+        return 生成设置(self.临时文件, 参数.colors, quantization=参数.quantization, 拟色=拟色,
+                    remap=remap, stack=参数.stack, prescale=参数.prescale,
+                    despeckle=参数.despeckle, smoothcorners=参数.smoothcorners,
+                    optimizepaths=参数.optimizepaths, background=参数.background,
+                    width=参数.width, height=参数.height, pixel_budget=参数.pixel_budget,
+                    merge_speckles=参数.merge_speckles, batch_potrace=参数.batch_potrace,
+                    max_layers=参数.max_layers, max_layers_action=参数.max_layers_action,
+                    alpha=参数.alpha, crop_layers=参数.crop_layers, cull_hidden=参数.cull_hidden)
+
+    def 提交(self, 数据, 扩展名, 设置):
+        """提交一个描摹请求，返回 futures.Future；已达到队列上限时返回 None"""
+        if not self.名额.acquire(blocking=False):
+            return None
+        with self.计数锁:
+            self.待处理数 += 1
+        未来 = futures.Future()
+        未来.add_done_callback(self.完成一个)
+        self.请求队列.put((数据, 扩展名, 设置, 未来))
+        return 未来
+
+    def 完成一个(self, 未来):
+        with self.计数锁:
+            self.待处理数 -= 1
+        self.名额.release()
+
+    def 分派(self):
+        """收集同时到达的小请求，分成最多 进程数 批交给进程池"""
+        while True:
+            请求列表 = [self.请求队列.get()]
+            截止 = time.monotonic() + 批处理等待秒
+            while len(请求列表) < 批处理最大数量 * self.进程数:
+                剩余 = 截止 - time.monotonic()
+                if 剩余 <= 0:
+                    break
+                try:
+                    请求列表.append(self.请求队列.get(timeout=剩余))
+                except queue.Empty:
+                    break
+
+            小请求 = [请求 for 请求 in 请求列表 if len(请求[0]) <= 批处理最大字节]
+            for 请求 in 请求列表:
+                if len(请求[0]) > 批处理最大字节:
+                    self.提交批次([请求])
+            批数 = min(len(小请求), self.进程数)
+            for i in range(批数):
+                self.提交批次(小请求[i::批数])
+
+    def 提交批次(self, 批次):
+        未来列表 = [请求[3] for 请求 in 批次]
+
+        def 完成(结果):
+            for 未来, (成功, 内容) in zip(未来列表, 结果):
+                if 成功:
+                    未来.set_result(内容)
+                else:
+                    未来.set_exception(Exception(内容))
+
+        def 失败(e):
+            for 未来 in 未来列表:
+                未来.set_exception(e)
+
+        self.进程池.apply_async(处理请求批次, ([请求[:3] for 请求 in 批次],),
+                             callback=完成, error_callback=失败)
+
+    def 状态(self):
+        return {'pending': self.待处理数, 'queue_limit': self.队列上限, 'workers': self.进程数}
+
+    def 关闭(self):
+        self.进程池.terminate()
+        shutil.rmtree(self.临时文件)
+
+
+class 描摹请求处理:
+    """POST /trace 上传图像，返回 svg；GET /status 返回服务状态的 json
+
+    和 http.server.BaseHTTPRequestHandler 一起使用，见 启动描摹服务
+"""
+
+    def 回复(self, 状态码, 内容, 类型='text/plain; charset=utf-8', 额外头=()):
+        if isinstance(内容, str):
+            内容 = 内容.encode()
+        self.send_response(状态码)
+        self.send_header('Content-Type', 类型)
+        self.send_header('Content-Length', str(len(内容)))
+        for 键, 值 in 额外头:
+            self.send_header(键, 值)
+        self.end_headers()
+        self.wfile.write(内容)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != '/status':
+            return self.回复(404, 'not found\n')
+        self.回复(200, json.dumps(self.server.描摹服务.状态()), 'application/json')
+
+    def do_POST(self):
+        地址 = urllib.parse.urlsplit(self.path)
+        if 地址.path != '/trace':
+            return self.回复(404, 'not found\n')
+        数据 = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        服务 = self.server.描摹服务
+        try:
+            设置 = 服务.解析选项(地址.query)
+            with Image.open(io.BytesIO(数据)) as 图像:
+                扩展名 = '.' + 图像.format.lower()
+        except (ValueError, IOError) as e:
+            return self.回复(400, '{0}\n'.format(e))
+
+        未来 = 服务.提交(数据, 扩展名, 设置)
+        if 未来 is None:
+            return self.回复(503, 'queue full\n', 额外头=[('Retry-After', '1')])
+        try:
+            svg = 未来.result()
+        except Exception as e:
+            return self.回复(500, '{0}\n'.format(e))
+        self.回复(200, svg, 'image/svg+xml')
+
+    def log_message(self, format, *args):
+        汇报(self.address_string(), format % args)
+
+
+def 启动描摹服务(地址, 进程数, 队列上限=64, 调色板文件夹=None):
+    """在 [host:]port 上启动描摹服务，直到按下 Ctrl+C"""
+    主机, _, 端口 = 地址.rpartition(':')
+    import http.server
+    处理类 = type('描摹请求处理', (描摹请求处理, http.server.BaseHTTPRequestHandler), {})
+    服务 = 描摹服务(进程数, 队列上限, 调色板文件夹)
+    httpd = http.server.ThreadingHTTPServer((主机 or '127.0.0.1', int(端口)), 处理类)
+    httpd.描摹服务 = 服务
+    print('描摹服务运行于 http://{0}:{1}/trace'.format(*httpd.server_address[:2]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        服务.关闭()
 
 
 def 删除文件(*filepaths):
@@ -759,11 +2935,8 @@ def 删除文件(*filepaths):
             os.remove(f)
 
 
-def 获得参数(cmdargs=None):
-    """返回从命令行得到的参数
-
-    cmdargs: 如果指定了，则使用这些参数，而不使用提供的脚本的参数
-"""
+def 创建参数解析器():
+    """返回命令行参数解析器"""
     parser = argparse.ArgumentParser(description="使用 potrace 将位图转化为彩色 svg 矢量图",
                                      add_help=False, prefix_chars='-/')
     # 也可以通过 /? 获得帮助
@@ -773,19 +2946,43 @@ def 获得参数(cmdargs=None):
         help="显示帮助")
     # 文件输入输出参数
     parser.add_argument('-i',
-                        '--input', metavar='src', nargs='+', required=True,
-                        help="输入文件，支持 * 和 ? 通配符")
+                        '--input', metavar='src', nargs='+',
+                        help="输入文件，支持 * 和 ? 通配符 [除非使用 --serve，否则必须指定]。"
+                             "zip、tar 归档 (包括 .tar.gz 等) 直接读取其中的每个图像，"
+                             "归档::模式 只读取名称匹配的成员，例如 assets.tar::icons/*.png")
     parser.add_argument('-o',
                         '--output', metavar='dest',
                         help="输出保存路径，支持 * 通配符")
     parser.add_argument('-d',
                         '--directory', metavar='destdir',
                         help="输出保存的文件夹")
+    parser.add_argument('--output-archive', metavar='archive',
+                        help="把所有输出写入这个 zip 或 tar 归档 (按扩展名，可以是 .tar.gz 等)，"
+                             "-o、-d 得到的路径是归档中的成员名称")
+    parser.add_argument('--sprite', metavar='dest',
+                        help="描摹完成后，再把所有输出合为一个 svg 精灵图，每个输出是一个 id 为文件名的 <symbol>，"
+                             "多次出现的路径只保存一次")
     # 处理参数
     parser.add_argument('-C',
                         '--cores', metavar='N',
                         type=functools.partial(检查范围, 0, None, int, "an integer"),
                         help="多进程处理的进程数 (默认使用全部核心)")
+    parser.add_argument('-A',
+                        '--asyncio', action='store_true',
+                        help="只用一个进程，由事件循环并发调用外部程序，-C 是同时运行的外部程序数，"
+                             "适合核心很多的机器")
+    # 多主机参数
+    parser.add_argument('--shard', metavar='i/N', type=解析分片,
+                        help="只处理输入平均分成 N 份后的第 i 份 (从 1 开始)，用于把一批文件分给多台主机，"
+                             "各主机的 -i 参数应当相同")
+    parser.add_argument('--claim-dir', metavar='dir',
+                        help="和其他主机通过这个共享文件夹中的租约文件认领输入，每次认领 -C 个，"
+                             "处理完再认领，直到全部完成；各主机要把输入挂载在相同的路径")
+    parser.add_argument('--lease', metavar='seconds',
+                        type=functools.partial(检查范围, 1, None, float, "a floating-point number"),
+                        default=600,
+                        help="--claim-dir 中租约的有效期，主机崩溃后超过这么久，它认领的输入由别的主机重新处理"
+                             "(默认值：600)")
     # 尺寸参数
     parser.add_argument('--width', metavar='<dim>',
                         help="输出 svg 图像宽度，例如：6.5in、 15cm、100pt，默认单位是 inch")
@@ -797,13 +2994,14 @@ def 获得参数(cmdargs=None):
 
     # 彩色描摹选项
     # 颜色数和调色板互斥
-    颜色数调色板组 = parser.add_mutually_exclusive_group(required=True)
+    颜色数调色板组 = parser.add_mutually_exclusive_group()
     颜色数调色板组.add_argument('-c',
                                      '--colors', metavar='N',
-                                     type=functools.partial(检查范围, 0, 256, int, "an integer"),
+                                     type=检查颜色数,
                                      help="[若未使用 -p 参数，则必须指定该参数] "
                                           "表示在描摹前，先缩减到多少个颜色。最多 256 个。"
-                                          "0表示跳过缩减颜色 (除非你的图片已经缩减过颜色，否则不推荐0)。")
+                                          "0表示跳过缩减颜色 (除非你的图片已经缩减过颜色，否则不推荐0)。"
+                                          "auto 表示在缩小的图像上比较不同颜色数的误差和路径数，为每个图像自动选择")
     parser.add_argument('-q',
                         '--quantization', metavar='algorithm',
                         choices=('mc', 'as', 'nq'), default='mc',
@@ -811,6 +3009,14 @@ def 获得参数(cmdargs=None):
                              "'mc' (Median-Cut，中切，由 pngquant 实现，产生较少的颜色，这是默认); "
                              "'as' (Adaptive Spatial Subdivision 自适应空间细分，由 ImageMagick 实现，产生的颜色更少); "
                              "'nq' (NeuQuant 神经量化, 可以生成更多的颜色，由 pnqng 实现)。 如果 --colors 0 则不启用量化。")
+    parser.add_argument('--max-layers', metavar='N',
+                        type=functools.partial(检查范围, 2, None, int, "an integer"), default=256,
+                        help="每个输入最多的图层数 (默认值：256)。颜色多于这个数的输入 (例如使用 -c 0、-r、-g 时) 按 "
+                             "--max-layers-action 处理，以免一张照片产生几十万个图层")
+    parser.add_argument('--max-layers-action', metavar='action',
+                        choices=('quantize', 'refuse'), default='quantize',
+                        help="输入的颜色多于 --max-layers 时：quantize 自动量化到这么多个颜色 (最多 256 个，这是默认)，"
+                             "使用 -r、-g 的调色板时只保留其中最常用的这么多个颜色；refuse 跳过这个输入，继续描摹其他输入")
 
 
     # make --floydsteinberg and --riemersma dithering mutually exclusive
@@ -826,20 +3032,45 @@ def 获得参数(cmdargs=None):
                                      '--remap', metavar='paletteimg',
                                      help=("使用一个自定义调色板图像，用于颜色缩减 [覆盖 -c 和 -q 选项]"))
     # image options
+    parser.add_argument('-g',
+                        '--global-palette', action='store_true',
+                        help="所有输入共用一个调色板：先从所有输入中采样量化出调色板，"
+                             "再把每个输入重映射到它，使各输出的图层颜色一致 [需要 -c 选项]")
+    parser.add_argument('--sample-files', metavar='N',
+                        type=functools.partial(检查范围, 1, None, int, "an integer"),
+                        help="使用 -g 时，只从均匀挑选的 N 个输入中采样 (默认使用全部输入)")
+    # 序列选项
+    parser.add_argument('--sequence', action='store_true',
+                        help="把所有输入当作一段动画的各帧 (GIF、APNG 等动图会展开为多帧)，"
+                             "所有帧共用一个调色板，和之前的帧相同的图层直接复用描摹结果")
+    parser.add_argument('--animate', metavar='dest',
+                        help="把序列的所有帧保存为这一个 SMIL 动画 svg，而不是每帧一个 svg [隐含 --sequence]")
+    parser.add_argument('--frame-duration', metavar='ms',
+                        type=functools.partial(检查范围, 1, None, int, "an integer"), default=100,
+                        help="输入没有记录帧时长时，每帧的时长，单位是毫秒 (默认值：100)")
     parser.add_argument('-s',
                         '--stack',
                         action='store_true',
                         help="堆栈描摹 (若要更精确的输出，推荐用这个)")
     parser.add_argument('-p',
                         '--prescale', metavar='size',
-                        type=functools.partial(检查范围, 0, None, float, "a floating-point number"), default=1,
+                        type=检查缩放, default=1,
                         help="为得到更多的细节，在描摹前，先将图片进行缩放 (默认值: 1)。"
-                             "例如使用 2，描摹前先预放大两倍")
+                             "例如使用 2，描摹前先预放大两倍。使用 auto 则根据每个图像的大小和细节自动选择，"
+                             "所选的倍数记录在输出 svg 的元数据中")
+    parser.add_argument('--pixel-budget', metavar='MP',
+                        type=functools.partial(检查范围, 0.01, None, float, "a floating-point number"), default=4.0,
+                        help="使用 --prescale auto 时，放大后图像最多的像素数，单位是百万像素 (默认值：4)")
     # potrace options
     parser.add_argument('-D',
                         '--despeckle', metavar='size',
                         type=functools.partial(检查范围, 0, None, int, "an integer"), default=2,
                         help='抑制斑点的大小（单位是像素） (默认值：2)')
+    parser.add_argument('-M',
+                        '--merge-speckles', metavar='size',
+                        type=functools.partial(检查范围, 0, None, int, "an integer"), default=0,
+                        help="切分图层前，把面积小于这么多像素的同色区域并入周围的颜色 (默认值：0，不合并)。"
+                             "和 -D 不同，斑点在所有图层中一起去除，拟色产生的零散颜色也会随之减少")
     parser.add_argument('-S',
                         '--smoothcorners', metavar='threshold',
                         type=functools.partial(检查范围, 0, 1.334, float, "a floating-point number"), default=1.0,
@@ -852,18 +3083,87 @@ def 获得参数(cmdargs=None):
     parser.add_argument('-bg',
                         '--background', action='store_true',
                         help=("将第一个颜色这背景色，并尽可能优化最终的 svg"))
+    parser.add_argument('--alpha', action='store_true',
+                        help="透明感知：完全透明的像素不属于任何图层，量化时不占用调色板中的颜色，"
+                             "-bg 的背景也只填满不透明的区域")
+    parser.add_argument('--batch-potrace', action='store_true',
+                        help="每个图像的所有图层通过 stdin 交给同一个 potrace 进程描摹，而不是每个颜色启动一个，"
+                             "适合图层很小、图像很多的情况")
+    parser.add_argument('--crop-layers', action='store_true',
+                        help="每个图层只描摹颜色的外接矩形，组装时再移回原来的位置；"
+                             "颜色只占图像一小部分时，描摹快得多")
+    parser.add_argument('--cull-hidden', action='store_true',
+                        help="[需要 -s 选项] 描摹前去掉之后的图层会原样盖住的区域，在索引图上计算，不改变外观；"
+                             "每个颜色的路径只保留最上面的一份，svg 小得多")
+    parser.add_argument('--variant', metavar='name:key=val,...', dest='variants',
+                        type=解析变体, action='append',
+                        help="额外输出一个变体 输出-name.svg，可以多次使用。键可以是 stack、background、"
+                             "despeckle、smoothcorners、optimizepaths，未指定的键使用命令行中的值。"
+                             "所有变体共用缩放、量化和孤立颜色的结果，例如 --variant soft:smoothcorners=1.3,despeckle=8")
     # other options
     parser.add_argument('-v',
                         '--verbose', action='store_true',
                         help="打印出运行时的细节")
     parser.add_argument('--version', action='version',
                         version='%(prog)s {ver}'.format(ver=版本), help='显示程序版本')
+    parser.add_argument('--metrics-file', metavar='path',
+                        help="每秒把吞吐量、队列深度、各阶段耗时直方图和预计剩余时间写入这个文件，"
+                             "以 .json 结尾时写入 json，否则写入 Prometheus 文本格式")
+    parser.add_argument('--metrics-port', metavar='[host:]port',
+                        help="在本地端口上提供同样的指标：GET /metrics 返回 Prometheus 文本，"
+                             "GET /metrics.json 返回 json")
+    # 服务选项
+    parser.add_argument('--serve', metavar='[host:]port',
+                        help="启动本地描摹服务：POST /trace?colors=4&stack 上传图像，返回 svg。"
+                             "查询参数与命令行选项同名，不带值的是开关选项")
+    parser.add_argument('--queue-limit', metavar='N',
+                        type=functools.partial(检查范围, 1, None, int, "an integer"), default=64,
+                        help="描摹服务最多同时排队和处理的请求数，超出时返回 503 (默认值：64)")
+    parser.add_argument('--palette-dir', metavar='dir',
+                        help="描摹服务中 remap 参数所指调色板图像所在的文件夹")
+    return parser
+
+
+# 序列描摹不支持的选项：(参数名, 选项名)，不是默认值时报错
+序列不支持的选项 = (
+    ('floydsteinberg', '-fs/--floydsteinberg'),
+    ('riemersma', '-ri/--riemersma'),
+    ('asyncio', '-A/--asyncio'),
+    ('variants', '--variant'),
+    ('metrics_file', '--metrics-file'),
+    ('metrics_port', '--metrics-port'),
+    ('batch_potrace', '--batch-potrace'),
+    ('max_layers', '--max-layers'),
+    ('max_layers_action', '--max-layers-action'),
+    ('alpha', '--alpha'),
+    ('crop_layers', '--crop-layers'),
+    ('cull_hidden', '--cull-hidden'),
+    ('shard', '--shard'),
+    ('claim_dir', '--claim-dir'),
+    ('lease', '--lease'),
+    ('output_archive', '--output-archive'),
+    ('sprite', '--sprite'),
+)
 
+
+def 获得参数(cmdargs=None):
+    """返回从命令行得到的参数
+
+    cmdargs: 如果指定了，则使用这些参数，而不使用提供的脚本的参数
+"""
+    parser = 创建参数解析器()
     if cmdargs is None:
         args = parser.parse_args()
     else:
         args = parser.parse_args(cmdargs)
 
+    if args.serve is not None:
+        return args
+    if not args.input:
+        parser.error("the following arguments are required: -i/--input")
+    if args.colors is None and args.remap is None:
+        parser.error("one of the arguments -c/--colors -r/--remap is required")
+
     # with multiple inputs, --output must use at least one * wildcard
     multi_inputs = False
     for i, input_ in enumerate(得到输入输出(args.input)):
@@ -873,6 +3173,44 @@ def 获得参数(cmdargs=None):
     if multi_inputs and args.output is not None and '*' not in args.output:
         parser.error("argument -o/--output: must contain '*' wildcard when using multiple input files")
 
+    if args.variants:
+        名称列表 = [名称 for 名称, _ in args.variants]
+        if len(set(名称列表)) != len(名称列表):
+            parser.error("argument --variant: names must be unique")
+
+    if args.global_palette and args.colors is None:
+        parser.error("argument -g/--global-palette: requires -c/--colors")
+
+    if args.sequence or args.animate is not None:
+        if args.colors is not None and args.colors != 'auto' and args.colors < 2:
+            parser.error("argument --sequence: requires -c/--colors of at least 2, or -r/--remap")
+        for 参数名, 选项名 in 序列不支持的选项:
+            if getattr(args, 参数名) != parser.get_default(参数名):
+                parser.error(f"argument {选项名}: not supported with --sequence")
+
+    if args.cull_hidden and not args.stack and not any(参数.get('stack') for _, 参数 in args.variants or ()):
+        # 不堆栈时各图层互不重叠，只有不在颜色表中的暗像素会被原样盖住，几乎去不掉什么
+        parser.error("argument --cull-hidden: requires -s/--stack or a --variant with stack")
+
+    if args.sprite is not None:
+        if args.output_archive is not None:
+            parser.error("argument --sprite: not supported with --output-archive")
+        if args.claim_dir is not None:
+            # 每批都会重写精灵图，并且只包含本机的输出
+            parser.error("argument --sprite: not supported with --claim-dir")
+
+    if args.output_archive is not None:
+        if 归档格式(args.output_archive) is None:
+            parser.error("argument --output-archive: must end with one of " + ", ".join(归档扩展名))
+        if args.claim_dir is not None:
+            # 各主机、各批不能追加到同一个归档
+            parser.error("argument --output-archive: not supported with --claim-dir")
+
+    if args.global_palette and (args.shard is not None or args.claim_dir is not None):
+        # 每个分片或者每批只从自己的输入中采样，各主机的调色板会不同
+        parser.error("argument --shard/--claim-dir: not supported with -g/--global-palette, "
+                     "make a palette image once and use -r/--remap")
+
     # 'riemersma' dithering is only allowed with 'as' quantization or --palette option
     if args.riemersma:
         if args.quantization != 'as' and args.palette is None:
@@ -907,20 +3245,25 @@ def main(参数=None):
 
     # 如果参数没有指定的话，设置进程数
     if 参数.cores is None:
-        try:
-            进程数 = multiprocessing.cpu_count()
-        except NotImplementedError:
+        进程数 = os.cpu_count()
+        if 进程数 is None:
             汇报("无法确定CPU核心数，因此假定为 1")
             进程数 = 1
     else:
         进程数 = 参数.cores
 
+    if 参数.serve is not None:
+        启动描摹服务(参数.serve, 进程数, 参数.queue_limit, 参数.palette_dir)
+        return
+
     # 只收集彩色描摹需要的参数
     输入输出 = zip(*得到输入输出(参数.input, 输出形式))
     try:
         输入列表, 输出列表 = 输入输出
     except ValueError:  # nothing to unpack
         输入列表, 输出列表 = [], []
+    if 参数.shard is not None:
+        输入列表, 输出列表 = 分片(输入列表, 输出列表, *参数.shard)
 
     if 参数.floydsteinberg:
         拟色 = 'floydsteinberg'
@@ -931,11 +3274,24 @@ def main(参数=None):
 
     颜色数 = 参数.colors
 
+    if 参数.sequence or 参数.animate is not None:
+        # 序列总是共用一个调色板，-g 不需要传递
+        序列描摹(输入列表, 输出列表, 颜色数, 进程数, quantization=参数.quantization, remap=参数.remap,
+             stack=参数.stack, prescale=参数.prescale, despeckle=参数.despeckle,
+             smoothcorners=参数.smoothcorners, optimizepaths=参数.optimizepaths,
+             background=参数.background, width=参数.width, height=参数.height,
+             sample_files=参数.sample_files, animate=参数.animate,
+             frame_duration=参数.frame_duration, pixel_budget=参数.pixel_budget,
+             merge_speckles=参数.merge_speckles)
+        return
+
     彩色描摹参数 = vars(参数)
 
-    for k in ('colors', 'directory', 'input', 'output', 'cores', 'floydsteinberg', 'riemersma', 'verbose'):
+    for k in ('colors', 'directory', 'input', 'output', 'cores', 'floydsteinberg', 'riemersma', 'verbose',
+              'serve', 'queue_limit', 'palette_dir', 'shard', 'sequence', 'animate', 'frame_duration'):
         彩色描摹参数.pop(k)
 
+    彩色描摹参数['use_asyncio'] = 彩色描摹参数.pop('asyncio')
     彩色描摹(输入列表, 输出列表, 颜色数, 进程数, 拟色=拟色, **彩色描摹参数)
 
 if __name__ == '__main__':
@@ -24,10 +24,24 @@
 # Composite mode stacks images atop each other like layers. Not intended for
 # use with the --margin option, and might be buggy so beware.
 
-from lxml import etree # Ubuntu Karmic package: python-lxml
 import sys, re, io
 from optparse import OptionParser
 
+class _LazyEtree(object):
+    """Stands in for lxml.etree and imports it on first use.
+
+    The text-level compositing functions never need lxml, so scripts that
+    only composite layers do not pay for importing it.
+    """
+    _module = None
+    def __getattr__(self, name):
+        if _LazyEtree._module is None:
+            from lxml import etree as module # Ubuntu Karmic package: python-lxml
+            _LazyEtree._module = module
+        return getattr(_LazyEtree._module, name)
+
+etree = _LazyEtree()
+
 VERSION = '0.0.1 py32 composite' # keep in sync with setup.py
 
 UNITS = ['pt','px','in']
@@ -36,7 +50,15 @@ IN2PT = 72.0
 PT2PX = 1.25
 PX2PT = 1.0/1.25
 
-relIRI_re = re.compile(r'url\(#(.*)\)')
+relIRI_re = re.compile(r'url\(#([^)]*)\)')
+
+SVG_NS = '{http://www.w3.org/2000/svg}'
+HREF_ATTRS = frozenset(['href', '{http://www.w3.org/1999/xlink}href'])
+# presentation attributes that may hold a url(#...) reference
+# (See http://www.w3.org/TR/SVG11/propidx.html )
+RELIRI_ATTRS = frozenset(['clip-path', 'color-profile', 'cursor', 'fill',
+                          'filter', 'marker', 'marker-end', 'marker-mid',
+                          'marker-start', 'mask', 'stroke', 'style'])
 
 def get_unit_attr(value):
     # coordinate handling from http://www.w3.org/TR/SVG11/coords.html#Units
@@ -60,41 +82,29 @@ def convert_to_pixels( val, units):
         raise ValueError('unsupport unit conversion to pixels: %s'%units)
     return val_px
 
-def fix_ids( elem, prefix, level=0 ):
-    ns = '{http://www.w3.org/2000/svg}'
-
-    if isinstance(elem.tag,str) and elem.tag.startswith(ns):
-
-        tag = elem.tag[len(ns):]
-
-        if 'id' in elem.attrib:
-            elem.attrib['id'] = prefix + elem.attrib['id']
-
-        # fix references (See http://www.w3.org/TR/SVGTiny12/linking.html#IRIReference )
-
-        for attrib in list(elem.attrib.keys()):
-            value = elem.attrib.get(attrib,None)
-
-            if value is not None:
-
-                if attrib.startswith('{http://www.w3.org/1999/xlink}'):
-                    relIRI = False
-                else:
-                    relIRI = True
-
-                if (not relIRI) and value.startswith('#'): # local IRI, change
-                    iri = value[1:]
-                    value = '#' + prefix + iri
-                    elem.attrib[attrib] = value
-                elif relIRI:
-                    newvalue = re.sub( relIRI_re, r'url(#'+prefix+r'\1)', value)
+def fix_ids( elem, prefix ):
+    """prefix ids in elem and its descendants, and the references to them
+
+    The tree is walked iteratively and only attributes that can hold an id
+    or a local reference are looked at, so path data is never scanned.
+    """
+    iri_repl = 'url(#%s\\1)'%prefix.replace('\\','\\\\')
+    for child in elem.iter(SVG_NS+'*'):
+        attrib = child.attrib
+        for attrib_name in attrib.keys():
+            if attrib_name == 'id':
+                attrib['id'] = prefix + attrib['id']
+            elif attrib_name in HREF_ATTRS:
+                # fix references (See http://www.w3.org/TR/SVGTiny12/linking.html#IRIReference )
+                value = attrib[attrib_name]
+                if value.startswith('#'): # local IRI, change
+                    attrib[attrib_name] = '#' + prefix + value[1:]
+            elif attrib_name in RELIRI_ATTRS:
+                value = attrib[attrib_name]
+                if 'url(' in value:
+                    newvalue = relIRI_re.sub(iri_repl, value)
                     if newvalue != value:
-                        elem.attrib[attrib] = newvalue
-
-        # Do same for children
-
-    for child in elem:
-        fix_ids(child,prefix,level=level+1)
+                        attrib[attrib_name] = newvalue
 
 header_str = """<?xml version="1.0" standalone="no"?>
 <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN"
@@ -175,7 +185,9 @@ class SVGFileNoLayout(SVGFileBase):
         return 'SVGFileNoLayout(%s)'%repr(self._fname)
 
 class LayoutAccumulator(object):
-    def __init__(self):
+    def __init__(self, rename_ids=True):
+        # rename_ids=False skips fix_ids, for inputs known not to share ids
+        self._rename_ids = rename_ids
         self._svgfiles = []
         self._svgfiles_no_layout = []
         self._raw_elements = []
@@ -256,7 +268,8 @@ class LayoutAccumulator(object):
                     if child.tag == '{http://www.w3.org/2000/svg}defs':
                         # copy into root_defs, not into sub-group
                         for subchild in child:
-                            fix_ids( subchild, fix_id_prefix )
+                            if self._rename_ids:
+                                fix_ids( subchild, fix_id_prefix )
                             root_defs.append( subchild )
                         continue
                     elif child.tag == '{http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd}:namedview':
@@ -267,7 +280,8 @@ class LayoutAccumulator(object):
                         continue
                 elem.append(child)
 
-            fix_ids( elem, fix_id_prefix )
+            if self._rename_ids:
+                fix_ids( elem, fix_id_prefix )
 
             translate_x = svgfile._coord[0]
             translate_y = svgfile._coord[1]
@@ -632,6 +646,271 @@ class CBoxLayout(BoxLayout):
     def __init__(self, parent=None):
         super(CBoxLayout,self).__init__(Composite,parent=parent)
 
+# ------------------------------------------------------------------
+# Fast path for stacking layers that all share one size, such as the
+# per-color outputs of potrace. The files are handled as bytes: the root
+# start tag of the first layer becomes the header and the bodies of all
+# layers are appended in order, so no layout is computed and no element
+# tree is built.
+
+svg_start_re = re.compile(br'<svg\b[^>]*>')
+svg_attr_re = re.compile(br'''([^\s=<>]+)\s*=\s*("[^"]*"|'[^']*')''')
+metadata_re = re.compile(br'\s*<metadata\b.*?</metadata>', re.S)
+path_re = re.compile(br'<path\s+d="([^"]*)"\s*/>')
+# id attributes and local references, as written by composite_layers and
+# composite_frames
+id_ref_re = re.compile(br'(\sid="|\shref="#|\sxlink:href="#)')
+
+def _split_svg(data):
+    """return (attributes of the root element, body bytes) of an svg file"""
+    match = svg_start_re.search(data)
+    if match is None:
+        raise ValueError('expected file to have root element <svg:svg>')
+    end = data.rfind(b'</svg>')
+    if end < match.end():
+        raise ValueError('expected file to close root element <svg:svg>')
+    attrs = [(name, value[1:-1]) for name, value in
+             svg_attr_re.findall(match.group(0))]
+    body = data[match.end():end]
+    metadata = metadata_re.match(body)
+    if metadata is not None:
+        body = body[metadata.end():]
+    return attrs, body
+
+def _read_layers(fnames, sized=True):
+    """return (root attributes for the output, list of layer bodies)
+
+    If sized is False, the layers may differ in size and the list of
+    layer bodies is a list of (root attributes, body) instead.
+    """
+    header_attrs = None
+    size_attrs = None
+    layers = []
+    for fname in fnames:
+        with open(fname, mode='rb') as fd:
+            attrs, body = _split_svg(fd.read())
+        attr_dict = dict(attrs)
+        sizes = tuple(attr_dict.get(key) for key in
+                      (b'width', b'height', b'viewBox'))
+        if not sized:
+            body = (attr_dict, body)
+        if header_attrs is None:
+            header_attrs = [(name, value) for name, value in attrs
+                            if name != b'version']
+            size_attrs = sizes
+        elif sized and sizes != size_attrs:
+            raise ValueError('cannot composite %s: size differs from first '
+                             'layer'%(fname,))
+        else:
+            # keep namespace declarations found only on later layers
+            known = set(name for name, value in header_attrs)
+            header_attrs.extend((name, value) for name, value in attrs
+                                if name.startswith(b'xmlns') and
+                                name not in known)
+        layers.append(body)
+    if header_attrs is None:
+        raise ValueError('No layers, cannot save.')
+    return header_attrs, layers
+
+def _start_chunks(header_attrs, metadata=None):
+    chunks = [header_str.encode(), b'<svg']
+    for name, value in header_attrs:
+        chunks.append(b' %s="%s"'%(name, value))
+    chunks.append(b' version="1.1">\n')
+    if metadata is not None:
+        chunks.append(b'<metadata>%s</metadata>\n'%metadata.encode())
+    return chunks
+
+def _write_chunks(chunks, fileobj):
+    if isinstance(fileobj, io.TextIOBase):
+        fileobj.write(b''.join(chunks).decode())
+    elif isinstance(fileobj, io.IOBase):
+        fileobj.writelines(chunks)
+    else:
+        with open(fileobj, mode='wb') as fd:
+            fd.writelines(chunks)
+
+def _view_box(attr_dict):
+    return [float(v) for v in
+            attr_dict[b'viewBox'].replace(b',', b' ').split()]
+
+def _place_boxes(header_attrs, layers, boxes, canvas):
+    """return the canvas root attributes and each layer's translation
+
+    Every layer is taken to be traced from the part boxes[i] of a bitmap
+    of size canvas, so that its width, height and viewBox span just that
+    part. The scale is taken from the layer with the largest part, where
+    the rounding of its size attributes matters least.
+    """
+    canvas_w, canvas_h = canvas
+    boxes = [(0, 0, canvas_w, canvas_h) if box is None else box
+             for box in boxes]
+    ref = max(range(len(boxes)), key=lambda i: boxes[i][2]*boxes[i][3])
+    attr_dict, body = layers[ref]
+    x, y, w, h = boxes[ref]
+    min_x, min_y, view_w, view_h = _view_box(attr_dict)
+    scale_x = view_w / w
+    scale_y = view_h / h
+    width, width_units = get_unit_attr(attr_dict[b'width'].decode())
+    height, height_units = get_unit_attr(attr_dict[b'height'].decode())
+    canvas_attrs = {
+        b'width': b'%f%s'%(width/w*canvas_w, (width_units or '').encode()),
+        b'height': b'%f%s'%(height/h*canvas_h, (height_units or '').encode()),
+        b'viewBox': b'0 0 %f %f'%(scale_x*canvas_w, scale_y*canvas_h)}
+    header_attrs = [(name, canvas_attrs.get(name, value))
+                    for name, value in header_attrs]
+    offsets = []
+    for (attr_dict, body), (x, y, w, h) in zip(layers, boxes):
+        min_x, min_y = _view_box(attr_dict)[:2]
+        offsets.append((x*scale_x - min_x, y*scale_y - min_y))
+    return header_attrs, offsets
+
+def composite_layers(fnames, fileobj, metadata=None, boxes=None, canvas=None):
+    """stack svg files of identical size atop each other
+
+    This gives the same picture as a CBoxLayout holding the files, but
+    skips layout, unit conversion and id fixing. The width, height and
+    viewBox of every file must match those of the first one. The files
+    must not define ids, as they are copied verbatim. metadata, if given,
+    is an XML fragment stored in the output's <metadata> element.
+
+    If boxes is given, the files are instead traced from parts of one
+    bitmap of size canvas = (width, height): boxes[i] is the
+    (x, y, width, height) of the part file i spans, or None for the whole
+    bitmap. All files must have the same scale; each is moved to the
+    place of its part, and the output spans the whole bitmap.
+    """
+    if boxes is None:
+        header_attrs, layers = _read_layers(fnames)
+        offsets = [None]*len(layers)
+    else:
+        header_attrs, layers = _read_layers(fnames, sized=False)
+        header_attrs, offsets = _place_boxes(header_attrs, layers, boxes,
+                                             canvas)
+        layers = [body for attr_dict, body in layers]
+    chunks = _start_chunks(header_attrs, metadata)
+    for layer_num, (body, offset) in enumerate(zip(layers, offsets)):
+        if offset is None or offset == (0, 0):
+            chunks.append(b'<g id="id%d">'%layer_num)
+        else:
+            chunks.append(b'<g id="id%d" transform="translate(%f,%f)">'%(
+                (layer_num,) + offset))
+        chunks.append(body)
+        chunks.append(b'</g>\n')
+    chunks.append(b'</svg>\n')
+    _write_chunks(chunks, fileobj)
+
+def composite_frames(frames, fileobj, durations, metadata=None):
+    """animate frames made of stacked svg layers, one frame after another
+
+    frames is a list of frames, each a list of layer files as taken by
+    composite_layers. A layer file used by several frames is stored once
+    in <defs> and referenced with <use>. durations gives the display time
+    of each frame in milliseconds; the animation loops forever (SMIL).
+    metadata is as for composite_layers.
+    """
+    layer_ids = {}
+    fnames = []
+    for frame in frames:
+        for fname in frame:
+            if fname not in layer_ids:
+                layer_ids[fname] = len(fnames)
+                fnames.append(fname)
+    header_attrs, layers = _read_layers(fnames)
+    if b'xmlns:xlink' not in dict(header_attrs):
+        header_attrs.append((b'xmlns:xlink', b'http://www.w3.org/1999/xlink'))
+
+    chunks = _start_chunks(header_attrs, metadata)
+    chunks.append(b'<defs>\n')
+    for layer_num, body in enumerate(layers):
+        chunks.append(b'<g id="layer%d">'%layer_num)
+        chunks.append(body)
+        chunks.append(b'</g>\n')
+    chunks.append(b'</defs>\n')
+
+    total = float(sum(durations))
+    start = 0
+    for frame_num, (frame, duration) in enumerate(zip(frames, durations)):
+        end = start + duration
+        if len(frames) == 1:
+            chunks.append(b'<g id="frame%d">\n'%frame_num)
+        else:
+            # discrete animation: visible between start and end only
+            values = [b'hidden', b'visible', b'hidden']
+            key_times = [0, start/total, end/total]
+            if start == 0:
+                del values[0], key_times[0]
+            if end >= total:
+                del values[-1], key_times[-1]
+            chunks.append(b'<g id="frame%d" visibility="%s">\n'%(
+                frame_num, values[0]))
+            chunks.append(b'<animate attributeName="visibility" '
+                          b'values="%s" keyTimes="%s" dur="%gms" '
+                          b'calcMode="discrete" repeatCount="indefinite"/>\n'%(
+                b';'.join(values),
+                b';'.join(b'%g'%t for t in key_times), total))
+        for fname in frame:
+            chunks.append(b'<use xlink:href="#layer%d"/>\n'%layer_ids[fname])
+        chunks.append(b'</g>\n')
+        start = end
+    chunks.append(b'</svg>\n')
+    _write_chunks(chunks, fileobj)
+
+def composite_sprite(fnames, ids, fileobj, metadata=None):
+    """store svg files as <symbol> elements of one sprite sheet
+
+    File fnames[i] becomes <symbol id="ids[i]"> with the file's viewBox,
+    to be shown with <use xlink:href="sheet.svg#ids[i]"/>. Path data
+    that occurs more than once, across files or within one, is stored
+    once in <defs> and each occurrence is replaced by a <use> of it,
+    which inherits the fill of the group it is in. Ids inside a file are
+    prefixed with its symbol id. The shared path data has the ids _p0,
+    _p1, ..., which ids must not use. The files are read twice, first to
+    count the path data and then to write the symbols, so they are never
+    all held in memory.
+    """
+    counts = {}
+    for fname in fnames:
+        with open(fname, mode='rb') as fd:
+            attrs, body = _split_svg(fd.read())
+        for d in path_re.findall(body):
+            counts[d] = counts.get(d, 0) + 1
+    shared = {}
+    for d, count in counts.items():
+        if count > 1:
+            shared[d] = len(shared)
+    del counts
+
+    header_attrs = [(b'xmlns', b'http://www.w3.org/2000/svg'),
+                    (b'xmlns:xlink', b'http://www.w3.org/1999/xlink')]
+    chunks = _start_chunks(header_attrs, metadata)
+    if shared:
+        chunks.append(b'<defs>\n')
+        for d, path_num in shared.items():
+            chunks.append(b'<path id="_p%d" d="%s"/>\n'%(path_num, d))
+        chunks.append(b'</defs>\n')
+
+    def replace_path(match):
+        path_num = shared.get(match.group(1))
+        if path_num is None:
+            return match.group(0)
+        return b'<use xlink:href="#_p%d"/>'%path_num
+
+    for fname, symbol_id in zip(fnames, ids):
+        with open(fname, mode='rb') as fd:
+            attrs, body = _split_svg(fd.read())
+        symbol_id = symbol_id.encode()
+        body = id_ref_re.sub(lambda match: match.group(1) + symbol_id + b'-', body)
+        chunks.append(b'<symbol id="%s"'%symbol_id)
+        view_box = dict(attrs).get(b'viewBox')
+        if view_box is not None:
+            chunks.append(b' viewBox="%s"'%view_box)
+        chunks.append(b'>')
+        chunks.append(path_re.sub(replace_path, body))
+        chunks.append(b'</symbol>\n')
+    chunks.append(b'</svg>\n')
+    _write_chunks(chunks, fileobj)
+
 # ------------------------------------------------------------------
 
 def main():
@@ -0,0 +1,18 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+源文件夹 = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+# color-trace.py 和测试都从这里导入 svg_stack
+sys.path.insert(0, 源文件夹)
+
+
+@pytest.fixture(scope='session')
+def color_trace():
+    """src/color-trace.py 的文件名带连字符，不能直接导入，按路径加载"""
+    规格 = importlib.util.spec_from_file_location('color_trace', os.path.join(源文件夹, 'color-trace.py'))
+    模块 = importlib.util.module_from_spec(规格)
+    规格.loader.exec_module(模块)
+    return 模块
@@ -0,0 +1,67 @@
+import re
+import shutil
+
+import numpy as np
+import pytest
+
+
+def 写入pbm(路径, 掩码):
+    高, 宽 = 掩码.shape
+    with open(路径, 'wb') as 文件:
+        文件.write('P4\n{0} {1}\n'.format(宽, 高).encode() + np.packbits(掩码, axis=1).tobytes())
+
+
+def 读取svg(路径):
+    with open(路径) as 文件:
+        文本 = 文件.read()
+    填充 = re.search(r'<g [^>]*fill="([^"]+)"', 文本).group(1)
+    尺寸 = re.search(r'<svg [^>]*width="([^"]+)" height="([^"]+)"', 文本).groups()
+    return 填充, 尺寸, re.findall(r' d="([^"]+)"', 文本)
+
+
+@pytest.fixture
+def 位图列表(tmp_path):
+    # 大小和形状各不相同，切错了文档就对不上
+    掩码列表 = [np.zeros((12, 16), bool), np.zeros((20, 10), bool), np.zeros((9, 9), bool)]
+    掩码列表[0][2:8, 3:12] = True
+    掩码列表[1][4:16, 2:5] = True
+    掩码列表[1][4:6, 2:9] = True
+    掩码列表[2][1:8, 1:8] = True
+    掩码列表[2][3:6, 3:6] = False
+    路径列表 = []
+    for i, 掩码 in enumerate(掩码列表):
+        路径 = str(tmp_path / 'layer{0}.pbm'.format(i))
+        写入pbm(路径, 掩码)
+        路径列表.append(路径)
+    return 路径列表
+
+
+颜色列表 = ['#ff0000', '#00ff00', '#0000ff']
+
+
+@pytest.mark.skipif(shutil.which('potrace') is None, reason='potrace not installed')
+def test_批量描摹按图层切分(color_trace, 位图列表, tmp_path):
+    批量目标 = [str(tmp_path / 'batch{0}.svg'.format(i)) for i in range(len(位图列表))]
+    单独目标 = [str(tmp_path / 'single{0}.svg'.format(i)) for i in range(len(位图列表))]
+    color_trace.批量描摹(位图列表, 批量目标, 颜色列表, 0)
+    # 每个位图单独送给 potrace 的结果作为对照
+    for 源, 目标, 颜色 in zip(位图列表, 单独目标, 颜色列表):
+        color_trace.批量描摹([源], [目标], [颜色], 0)
+
+    for 批量, 单独, 颜色 in zip(批量目标, 单独目标, 颜色列表):
+        填充, 尺寸, 路径 = 读取svg(批量)
+        assert 填充 == 颜色
+        assert 路径
+        assert (填充, 尺寸, 路径) == 读取svg(单独)
+
+
+def test_批量描摹切分不符时逐个描摹(color_trace, 位图列表, tmp_path, monkeypatch):
+    文档 = (b'<?xml version="1.0" standalone="no"?>\n<svg width="16pt" height="12pt">'
+          b'<g fill="#000000"><path d="M0 0"/></g></svg>\n')
+    # 一个文档缺失，另一个被截断
+    monkeypatch.setattr(color_trace, '处理命令', lambda 命令, **kwargs: 文档 + 文档[:60])
+    调用 = []
+    monkeypatch.setattr(color_trace, '描摹', lambda 源, 目标, 颜色, *参数: 调用.append((源, 目标, 颜色)))
+    目标列表 = [str(tmp_path / 'batch{0}.svg'.format(i)) for i in range(len(位图列表))]
+    color_trace.批量描摹(位图列表, 目标列表, 颜色列表, 0)
+    assert 调用 == list(zip(位图列表, 目标列表, 颜色列表))
@@ -0,0 +1,59 @@
+import collections
+
+import numpy as np
+import pytest
+
+
+def 逐像素去除(掩码, 遮挡):
+    """广度优先搜索掩码的 8 连通区域，去掉所有像素都在 遮挡 内的区域"""
+    高, 宽 = 掩码.shape
+    结果 = 掩码.copy()
+    已访问 = np.zeros_like(掩码)
+    for y in range(高):
+        for x in range(宽):
+            if not 掩码[y, x] or 已访问[y, x]:
+                continue
+            已访问[y, x] = True
+            区域 = [(y, x)]
+            待访问 = collections.deque(区域)
+            while 待访问:
+                cy, cx = 待访问.popleft()
+                for dy in (-1, 0, 1):
+                    for dx in (-1, 0, 1):
+                        ny, nx = cy + dy, cx + dx
+                        if 0 <= ny < 高 and 0 <= nx < 宽 and 掩码[ny, nx] and not 已访问[ny, nx]:
+                            已访问[ny, nx] = True
+                            区域.append((ny, nx))
+                            待访问.append((ny, nx))
+            if all(遮挡[py, px] for py, px in 区域):
+                for py, px in 区域:
+                    结果[py, px] = False
+    return 结果
+
+
+@pytest.mark.parametrize('种子', range(300))
+def test_去除被遮挡区域与逐像素搜索相同(color_trace, 种子):
+    随机数 = np.random.default_rng(种子)
+    高, 宽 = 随机数.integers(1, 16, size=2)
+    掩码 = 随机数.random((高, 宽)) < 随机数.uniform(0.1, 0.7)
+    # 遮挡大多覆盖整个区域，才会有区域被去掉
+    遮挡 = 随机数.random((高, 宽)) < 随机数.uniform(0.5, 1.0)
+    结果 = color_trace.去除被遮挡区域(掩码, 遮挡)
+    assert 结果.dtype == bool
+    np.testing.assert_array_equal(结果, 逐像素去除(掩码, 遮挡))
+
+
+def test_去除被遮挡区域对角相接的段连通(color_trace):
+    掩码 = np.array([[1, 0, 0],
+                   [0, 1, 0],
+                   [0, 0, 1]], dtype=bool)
+    遮挡 = np.eye(3, dtype=bool)
+    遮挡[2, 2] = False
+    # 三个像素对角相连，有一个露出，整个区域都保留
+    np.testing.assert_array_equal(color_trace.去除被遮挡区域(掩码, 遮挡), 掩码)
+    np.testing.assert_array_equal(color_trace.去除被遮挡区域(掩码, np.eye(3, dtype=bool)), np.zeros((3, 3), bool))
+
+
+def test_去除被遮挡区域空掩码(color_trace):
+    掩码 = np.zeros((4, 5), dtype=bool)
+    np.testing.assert_array_equal(color_trace.去除被遮挡区域(掩码, ~掩码), 掩码)
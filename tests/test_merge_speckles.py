@@ -0,0 +1,99 @@
+import collections
+
+import numpy as np
+import pytest
+
+相邻 = ((0, -1), (0, 1), (-1, 0), (1, 0))  # 左、右、上、下
+
+
+def 逐像素标记(索引图):
+    """广度优先搜索 4 连通的同色区域，返回每个像素所在区域的编号"""
+    高, 宽 = 索引图.shape
+    标记 = np.full((高, 宽), -1)
+    编号 = 0
+    for y in range(高):
+        for x in range(宽):
+            if 标记[y, x] >= 0:
+                continue
+            标记[y, x] = 编号
+            待访问 = collections.deque([(y, x)])
+            while 待访问:
+                cy, cx = 待访问.popleft()
+                for dy, dx in 相邻:
+                    ny, nx = cy + dy, cx + dx
+                    if (0 <= ny < 高 and 0 <= nx < 宽 and 标记[ny, nx] < 0
+                            and 索引图[ny, nx] == 索引图[y, x]):
+                        标记[ny, nx] = 编号
+                        待访问.append((ny, nx))
+            编号 += 1
+    return 标记
+
+
+def 同一划分(甲, 乙):
+    """两个标记把像素分成的区域是否相同"""
+    对应 = set(zip(甲.ravel().tolist(), 乙.ravel().tolist()))
+    return len(对应) == len(np.unique(甲)) == len(np.unique(乙))
+
+
+def 逐像素合并(索引图, 最小面积):
+    """一圈圈地填充小区域：每一圈中，与已定颜色的像素相邻的小区域像素，按左、右、上、下的顺序取第一个的颜色"""
+    标记 = 逐像素标记(索引图)
+    面积 = collections.Counter(标记.ravel().tolist())
+    小 = np.vectorize(lambda 号: 面积[号] < 最小面积)(标记)
+    if not 小.any() or 小.all():
+        return 索引图
+    高, 宽 = 索引图.shape
+    结果 = 索引图.copy()
+    while 小.any():
+        新小 = 小.copy()
+        for y, x in zip(*np.nonzero(小)):
+            for dy, dx in 相邻:
+                ny, nx = y + dy, x + dx  # 来源像素
+                if 0 <= ny < 高 and 0 <= nx < 宽 and not 小[ny, nx]:
+                    结果[y, x] = 结果[ny, nx]
+                    新小[y, x] = False
+                    break
+        小 = 新小
+    return 结果
+
+
+def 随机索引图(随机数, 最多颜色数=4):
+    高, 宽 = 随机数.integers(1, 14, size=2)
+    颜色数 = 随机数.integers(1, 最多颜色数 + 1)
+    if 随机数.random() < 0.5:
+        # 先生成小图再放大，得到较大的区域
+        小图 = 随机数.integers(0, 颜色数, size=(-(-高 // 2), -(-宽 // 2)))
+        return np.repeat(np.repeat(小图, 2, axis=0), 2, axis=1)[:高, :宽].astype(np.uint8)
+    return 随机数.integers(0, 颜色数, size=(高, 宽)).astype(np.uint8)
+
+
+@pytest.mark.parametrize('种子', range(200))
+def test_标记连通区域与逐像素搜索相同(color_trace, 种子):
+    索引图 = 随机索引图(np.random.default_rng(种子))
+    标记 = color_trace.标记连通区域(索引图)
+    assert 标记.shape == 索引图.shape
+    assert 同一划分(标记, 逐像素标记(索引图))
+
+
+def test_标记连通区域绕行的区域(color_trace):
+    # 螺旋形的区域需要多轮传播
+    索引图 = np.array([[1, 1, 1, 1, 1],
+                    [0, 0, 0, 0, 1],
+                    [1, 1, 1, 0, 1],
+                    [1, 0, 0, 0, 1],
+                    [1, 1, 1, 1, 1]], dtype=np.uint8)
+    assert 同一划分(color_trace.标记连通区域(索引图), 逐像素标记(索引图))
+
+
+@pytest.mark.parametrize('种子', range(200))
+def test_合并小区域与逐像素填充相同(color_trace, 种子):
+    随机数 = np.random.default_rng(种子)
+    索引图 = 随机索引图(随机数)
+    最小面积 = int(随机数.integers(1, 6))
+    np.testing.assert_array_equal(color_trace.合并小区域(索引图, 最小面积), 逐像素合并(索引图, 最小面积))
+
+
+def test_合并小区域没有大区域时不变(color_trace):
+    索引图 = np.array([[0, 1], [1, 0]], dtype=np.uint8)
+    np.testing.assert_array_equal(color_trace.合并小区域(索引图, 2), 索引图)
+    np.testing.assert_array_equal(color_trace.合并小区域(索引图, 1), 索引图)
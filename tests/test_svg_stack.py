@@ -0,0 +1,183 @@
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from svg_stack import svg_stack
+
+SVG = '{http://www.w3.org/2000/svg}'
+HREF = '{http://www.w3.org/1999/xlink}href'
+
+
+def 写入图层(路径, 路径数据, 颜色='#000000', 尺寸=(10, 10), 其他=''):
+    """写一个和 potrace 输出同样结构的 svg 文件"""
+    宽, 高 = 尺寸
+    with open(路径, 'w') as 文件:
+        文件.write('<?xml version="1.0" standalone="no"?>\n'
+                 '<svg version="1.0" xmlns="http://www.w3.org/2000/svg" '
+                 'width="{0}pt" height="{1}pt" viewBox="0 0 {0} {1}">\n'
+                 '<g fill="{2}">\n'.format(宽, 高, 颜色))
+        for d in 路径数据:
+            文件.write('<path d="{0}"/>\n'.format(d))
+        文件.write('</g>\n{0}</svg>\n'.format(其他))
+    return str(路径)
+
+
+def 合成(函数):
+    """调用 函数(输出)，解析写入的 svg"""
+    输出 = io.BytesIO()
+    函数(输出)
+    return ET.fromstring(输出.getvalue())
+
+
+def 路径列表(元素):
+    return [路径.get('d') for 路径 in 元素.iter(SVG + 'path')]
+
+
+def 可见帧(根, 时刻):
+    """按 SMIL 离散动画的规则，返回 时刻 (动画周期中的比例) 可见的帧 id"""
+    可见 = []
+    for 帧 in 根.findall(SVG + 'g'):
+        动画 = 帧.find(SVG + 'animate')
+        值 = 帧.get('visibility', 'visible')
+        if 动画 is not None:
+            for 关键时刻, 关键值 in zip(动画.get('keyTimes').split(';'), 动画.get('values').split(';')):
+                if float(关键时刻) <= 时刻:
+                    值 = 关键值
+        if 值 == 'visible':
+            可见.append(帧.get('id'))
+    return 可见
+
+
+def test_composite_frames共用图层并依次显示(tmp_path):
+    甲 = 写入图层(tmp_path / 'a.svg', ['M0 0L1 1z'], '#ff0000')
+    乙 = 写入图层(tmp_path / 'b.svg', ['M2 2L3 3z'], '#00ff00')
+    丙 = 写入图层(tmp_path / 'c.svg', ['M4 4L5 5z', 'M6 6L7 7z'], '#0000ff')
+    帧列表 = [[甲, 乙], [甲, 丙], [乙]]
+    根 = 合成(lambda 输出: svg_stack.composite_frames(帧列表, 输出, [100, 200, 100]))
+
+    assert 根.get('viewBox') == '0 0 10 10'
+    # 每个图层文件在 <defs> 中只存一次
+    图层 = 根.find(SVG + 'defs').findall(SVG + 'g')
+    assert [g.get('id') for g in 图层] == ['layer0', 'layer1', 'layer2']
+    assert [路径列表(g) for g in 图层] == [['M0 0L1 1z'], ['M2 2L3 3z'], ['M4 4L5 5z', 'M6 6L7 7z']]
+    assert [g.find(SVG + 'g').get('fill') for g in 图层] == ['#ff0000', '#00ff00', '#0000ff']
+
+    帧 = 根.findall(SVG + 'g')
+    assert [g.get('id') for g in 帧] == ['frame0', 'frame1', 'frame2']
+    assert [[use.get(HREF) for use in g.findall(SVG + 'use')] for g in 帧] == [
+        ['#layer0', '#layer1'], ['#layer0', '#layer2'], ['#layer1']]
+    for g in 帧:
+        动画 = g.find(SVG + 'animate')
+        assert 动画.get('attributeName') == 'visibility'
+        assert 动画.get('calcMode') == 'discrete'
+        assert 动画.get('repeatCount') == 'indefinite'
+        assert 动画.get('dur') == '400ms'
+
+    # 任何时刻都只有一帧可见，按时长依次轮换
+    for 时刻, 期望 in ((0, 'frame0'), (0.2, 'frame0'), (0.25, 'frame1'), (0.7, 'frame1'),
+                     (0.75, 'frame2'), (0.99, 'frame2')):
+        assert 可见帧(根, 时刻) == [期望]
+
+
+def test_composite_frames只有一帧时不加动画(tmp_path):
+    甲 = 写入图层(tmp_path / 'a.svg', ['M0 0L1 1z'])
+    根 = 合成(lambda 输出: svg_stack.composite_frames([[甲]], 输出, [100]))
+    帧 = 根.findall(SVG + 'g')
+    assert len(帧) == 1
+    assert 帧[0].find(SVG + 'animate') is None
+    assert 帧[0].get('visibility') is None
+    assert [use.get(HREF) for use in 帧[0].findall(SVG + 'use')] == ['#layer0']
+
+
+def test_composite_frames尺寸不同时报错(tmp_path):
+    甲 = 写入图层(tmp_path / 'a.svg', ['M0 0L1 1z'])
+    乙 = 写入图层(tmp_path / 'b.svg', ['M0 0L1 1z'], 尺寸=(12, 10))
+    with pytest.raises(ValueError):
+        合成(lambda 输出: svg_stack.composite_frames([[甲], [乙]], 输出, [100, 100]))
+
+
+def 展开符号(根, 符号):
+    """把符号中的 <use> 换回 <defs> 中的路径数据，返回符号中依次出现的路径数据"""
+    共用 = {路径.get('id'): 路径.get('d') for 路径 in 根.find(SVG + 'defs').findall(SVG + 'path')}
+    结果 = []
+    for 元素 in 符号.iter():
+        if 元素.tag == SVG + 'path':
+            结果.append(元素.get('d'))
+        elif 元素.tag == SVG + 'use' and 元素.get(HREF)[1:] in 共用:
+            结果.append(共用[元素.get(HREF)[1:]])
+    return 结果
+
+
+def test_composite_sprite共用路径只存一次(tmp_path):
+    文件列表 = [
+        写入图层(tmp_path / 'x.svg', ['M0 0L1 1z', 'M2 2L3 3z'], '#ff0000'),
+        写入图层(tmp_path / 'y.svg', ['M0 0L1 1z', 'M4 4L5 5z'], '#00ff00', 尺寸=(20, 16)),
+        # 同一个文件中重复的路径也只存一次
+        写入图层(tmp_path / 'z.svg', ['M6 6L7 7z', 'M6 6L7 7z'], '#0000ff'),
+    ]
+    根 = 合成(lambda 输出: svg_stack.composite_sprite(文件列表, ['x', 'y', 'z'], 输出))
+
+    共用 = 根.find(SVG + 'defs').findall(SVG + 'path')
+    assert sorted(路径.get('d') for 路径 in 共用) == ['M0 0L1 1z', 'M6 6L7 7z']
+    assert sorted(路径.get('id') for 路径 in 共用) == ['_p0', '_p1']
+
+    符号列表 = 根.findall(SVG + 'symbol')
+    assert [符号.get('id') for 符号 in 符号列表] == ['x', 'y', 'z']
+    assert [符号.get('viewBox') for 符号 in 符号列表] == ['0 0 10 10', '0 0 20 16', '0 0 10 10']
+    # 只出现一次的路径留在符号中，其余换成 <use>，填充色仍由符号中的组决定
+    assert 路径列表(符号列表[0]) == ['M2 2L3 3z']
+    assert 路径列表(符号列表[2]) == []
+    assert [符号.find(SVG + 'g').get('fill') for 符号 in 符号列表] == ['#ff0000', '#00ff00', '#0000ff']
+    for 符号 in 符号列表:
+        for use in 符号.iter(SVG + 'use'):
+            assert use.get(HREF) in ('#_p0', '#_p1')
+    assert [展开符号(根, 符号) for 符号 in 符号列表] == [
+        ['M0 0L1 1z', 'M2 2L3 3z'], ['M0 0L1 1z', 'M4 4L5 5z'], ['M6 6L7 7z', 'M6 6L7 7z']]
+
+
+def test_composite_sprite文件中的id加上符号前缀(tmp_path):
+    其他 = ('<g id="layer0"><path d="M8 8L9 9z"/></g>\n'
+          '<use xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="#layer0"/>\n')
+    文件列表 = [写入图层(tmp_path / 'a.svg', ['M0 0L1 1z'], 其他=其他),
+              写入图层(tmp_path / 'b.svg', ['M0 0L1 1z'])]
+    根 = 合成(lambda 输出: svg_stack.composite_sprite(文件列表, ['icon-a', 'icon-b'], 输出))
+    符号 = 根.find(SVG + 'symbol')
+    assert [g.get('id') for g in 符号.iter(SVG + 'g') if g.get('id')] == ['icon-a-layer0']
+    assert [use.get(HREF) for use in 符号.iter(SVG + 'use')] == ['#_p0', '#icon-a-layer0']
+
+
+def 写入裁剪图层(路径, 框, 比例=10):
+    """写一个从 框 = (x, y, 宽, 高) 的位图部分描摹出的图层，viewBox 是像素数的 比例 倍"""
+    _, _, 宽, 高 = 框
+    with open(路径, 'w') as 文件:
+        文件.write('<svg xmlns="http://www.w3.org/2000/svg" width="{0}pt" height="{1}pt" '
+                 'viewBox="0 0 {2} {3}"><path d="M0 0L1 1z"/></svg>\n'.format(宽, 高, 宽 * 比例, 高 * 比例))
+    return str(路径)
+
+
+def test_composite_layers把裁剪的图层移回原位(tmp_path):
+    框列表 = [(0, 0, 20, 10), (5, 2, 4, 3), (12, 7, 8, 3)]
+    文件列表 = [写入裁剪图层(tmp_path / 'l{0}.svg'.format(i), 框) for i, 框 in enumerate(框列表)]
+    # 第一个图层没有裁剪，用 None 表示
+    根 = 合成(lambda 输出: svg_stack.composite_layers(文件列表, 输出, boxes=[None] + 框列表[1:],
+                                                  canvas=(20, 10)))
+    assert float(根.get('width')[:-2]) == pytest.approx(20)
+    assert 根.get('width').endswith('pt')
+    assert [float(v) for v in 根.get('viewBox').split()] == pytest.approx([0, 0, 200, 100])
+    图层 = 根.findall(SVG + 'g')
+    assert [g.get('id') for g in 图层] == ['id0', 'id1', 'id2']
+    assert 图层[0].get('transform') is None
+    assert 图层[1].get('transform') == 'translate(50.000000,20.000000)'
+    assert 图层[2].get('transform') == 'translate(120.000000,70.000000)'
+
+
+def test_composite_layers裁剪时以最大的图层为比例(tmp_path):
+    # 没有完整的图层时，输出的大小按最大的部分换算到整个位图
+    框列表 = [(1, 1, 2, 2), (3, 0, 6, 5)]
+    文件列表 = [写入裁剪图层(tmp_path / 'l{0}.svg'.format(i), 框, 比例=4) for i, 框 in enumerate(框列表)]
+    根 = 合成(lambda 输出: svg_stack.composite_layers(文件列表, 输出, boxes=框列表, canvas=(10, 8)))
+    assert float(根.get('height')[:-2]) == pytest.approx(8)
+    assert [float(v) for v in 根.get('viewBox').split()] == pytest.approx([0, 0, 40, 32])
+    assert [g.get('transform') for g in 根.findall(SVG + 'g')] == [
+        'translate(4.000000,4.000000)', 'translate(12.000000,0.000000)']